@@ -151,13 +151,9 @@ def handle_bad_request(e):
 
 @entity.route('/.well-known/openid-federation')
 def wkof():
-    _fe = current_app.federation_entity
-    metadata = _fe.get_metadata()
-    _ctx = _fe.context
-    iss = sub = _ctx.entity_id
-    _statement = _ctx.create_entity_statement(
-        metadata=metadata, iss=iss, sub=sub, authority_hints=_fe.get_authority_hints(),
-        lifetime=_ctx.default_lifetime)
+    # Signed once, then again only when something in it changes or it's about to expire
+    _endpoint = current_app.federation_entity.get_endpoint('entity_configuration')
+    _statement = _endpoint.process_request({})["response"]
 
     response = make_response(_statement)
     response.headers['Content-Type'] = 'application/jose; charset=UTF-8'
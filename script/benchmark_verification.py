@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Measures how verifying trust chains and applying policies scales with the number of workers.
+A synthetic federation is built in memory: one trust anchor, a number of intermediates and
+leaves that each have all the intermediates as authority hints.
+"""
+import argparse
+import time
+
+from cryptojwt.key_jar import build_keyjar
+from cryptojwt.key_jar import KeyJar
+
+from fedservice.entity.function.parallel import apply_chain_policies
+from fedservice.entity.function.parallel import make_executor
+from fedservice.entity.function.parallel import verify_chains
+from fedservice.entity.function.policy import TrustChainPolicy
+from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.verification import verification_memo
+
+KEY_DEFS = [{"type": "RSA", "use": ["sig"]}]
+TA_ID = "https://ta.example.org"
+
+METADATA_POLICY = {
+    "openid_relying_party": {
+        "grant_types": {"subset_of": ["authorization_code", "refresh_token"]},
+        "contacts": {"add": ["ops@ta.example.org"]}
+    }
+}
+
+
+def build_chains(intermediates: int, leaves: int):
+    _keyjar = {}
+
+    def keys(entity_id):
+        if entity_id not in _keyjar:
+            _kj = build_keyjar(KEY_DEFS)
+            _kj.import_jwks(_kj.export_jwks(private=True), entity_id)
+            _keyjar[entity_id] = _kj
+        return _keyjar[entity_id]
+
+    def statement(iss, sub, **kwargs):
+        return create_entity_statement(iss, sub, keys(iss), jwks=keys(sub).export_jwks(),
+                                       **kwargs)
+
+    _im_ids = [f"https://im{i}.example.org" for i in range(intermediates)]
+    _ta_im = {_id: statement(TA_ID, _id, metadata_policy=METADATA_POLICY) for _id in _im_ids}
+    chains = []
+    for n in range(leaves):
+        _leaf_id = f"https://rp{n}.example.org"
+        _leaf_ec = statement(_leaf_id, _leaf_id, metadata={
+            "openid_relying_party": {
+                "grant_types": ["authorization_code"],
+                "contacts": [f"ops@rp{n}.example.org"]
+            }
+        })
+        for _im_id in _im_ids:
+            chains.append([_ta_im[_im_id], statement(_im_id, _leaf_id), _leaf_ec])
+    return chains, keys(TA_ID).export_jwks()
+
+
+def run(chains, anchor_jwks, spec):
+    verification_memo.clear()
+    _keyjar = KeyJar()
+    _keyjar.import_jwks(anchor_jwks, TA_ID)
+
+    def upstream_get(what, *args):
+        if what == "attribute" and args[0] == "keyjar":
+            return _keyjar
+        return None
+
+    _verifier = TrustChainVerifier(upstream_get)
+    _policy = TrustChainPolicy(None)
+    _executor = make_executor(spec)
+    try:
+        _start = time.perf_counter()
+        if _executor:
+            _trust_chains = verify_chains(_verifier, _keyjar, chains, _executor)
+            apply_chain_policies(_policy, _trust_chains, _executor)
+        else:
+            _trust_chains = [_verifier(_chain) for _chain in chains]
+            for _trust_chain in _trust_chains:
+                _policy(_trust_chain)
+        _elapsed = time.perf_counter() - _start
+    finally:
+        if _executor:
+            _executor.shutdown()
+
+    assert all(_trust_chains)
+    return _elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', dest='intermediates', type=int, default=4)
+    parser.add_argument('-l', dest='leaves', type=int, default=100)
+    parser.add_argument('-w', dest='workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    chains, anchor_jwks = build_chains(args.intermediates, args.leaves)
+    print(f"{len(chains)} trust chains")
+
+    _serial = run(chains, anchor_jwks, None)
+    print(f"{'serial':>8} {'':>3} {_serial:8.3f}s")
+    for _kind in ["thread", "process"]:
+        for _workers in args.workers:
+            _elapsed = run(chains, anchor_jwks,
+                           {"class": _kind, "kwargs": {"max_workers": _workers}})
+            print(f"{_kind:>8} {_workers:>3} {_elapsed:8.3f}s  x{_serial / _elapsed:.2f}")
@@ -4,28 +4,46 @@ __version__ = '5.1.0'
 from typing import Optional
 
 from fedservice.entity_statement.statement import chains2dict
+from fedservice.entity_statement.trust_chain_store import TrustChainStore
+
+
+def _trust_chain_store(federation_context) -> TrustChainStore:
+    # The federation entity's store if there is one to be found
+    from fedservice.entity.utils import get_federation_entity
+
+    _store = None
+    if getattr(federation_context, "upstream_get", None):
+        _federation_entity = get_federation_entity(federation_context)
+        if _federation_entity is not None:
+            _store = getattr(_federation_entity, "trust_chain", None)
+
+    if not isinstance(_store, TrustChainStore):
+        _store = getattr(federation_context, "trust_chain", None)
+        if not isinstance(_store, TrustChainStore):
+            _store = TrustChainStore()
+
+    federation_context.trust_chain = _store
+    return _store
 
 
 def save_trust_chains(federation_context, trust_chains):
     _tc_dict = chains2dict(trust_chains)
-    if getattr(federation_context, "trust_chain", None) is None:
-        federation_context.trust_chain = {}
+    _store = _trust_chain_store(federation_context)
 
+    _per_entity = {}
     for ta, tc in _tc_dict.items():
-        _ent = tc.iss_path[0]
-        if _ent not in federation_context.trust_chain:
-            federation_context.trust_chain[_ent] = {ta: tc}
-        else:
-            federation_context.trust_chain[_ent].update({ta: tc})
+        _per_entity.setdefault(tc.iss_path[0], []).append(tc)
 
+    for _ent, _trust_chains in _per_entity.items():
+        _store.update(_ent, _trust_chains)
 
-def get_trust_chain(federation_context, entity_id: str, trust_anchor: Optional[str] = ""):
-    trust_info = federation_context.trust_chain.get(entity_id, "")
-    if not trust_info:
-        return None
 
+def get_trust_chain(federation_context, entity_id: str, trust_anchor: Optional[str] = ""):
+    _store = _trust_chain_store(federation_context)
     if trust_anchor:
-        return trust_info.get(trust_anchor, None)
-    else:
-        return trust_info
+        return _store.get_trust_chain(entity_id, trust_anchor)
 
+    trust_info = _store.get(entity_id)
+    if not trust_info:
+        return None
+    return chains2dict(trust_info)
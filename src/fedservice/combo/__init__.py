@@ -9,9 +9,10 @@ from idpyoidc.configure import Configuration
 from idpyoidc.message import Message
 from idpyoidc.node import Unit
 from idpyoidc.server.util import execute
-from requests import request
 
 from fedservice.entity import FederationEntity
+from fedservice.httpc import make_httpc
+from fedservice.httpc import split_httpc_params
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +30,11 @@ class Combo(Unit):
         if not httpc_params:
             httpc_params = self._get_httpc_params(config)
 
+        # One connection pool shared by all the entity types
+        _pool_conf, httpc_params = split_httpc_params(httpc_params)
+        if httpc is None:
+            httpc = make_httpc(_pool_conf)
+
         Unit.__init__(self, config=config, httpc=httpc, issuer_id=self.entity_id, keyjar=keyjar,
                       httpc_params=httpc_params)
         self._part = {}
@@ -90,9 +96,6 @@ class FederationCombo(Combo):
                  keyjar: Optional[Union[KeyJar, bool]] = None,
                  httpc_params: Optional[dict] = None
                  ):
-        if httpc is None:
-            httpc = request
-
         if 'keyjar' not in config and 'key_conf' not in config:
             Combo.__init__(self, config=config, httpc=httpc, entity_id=entity_id, keyjar=False,
                            httpc_params=httpc_params)
@@ -196,6 +196,20 @@ FEDERATION_ENTITY_FUNCTIONS = {
             "allowed_delta": 600
         }
     },
+    "async_trust_chain_collector": {
+        "class": 'fedservice.entity.function.async_trust_chain_collector.AsyncTrustChainCollector',
+        "kwargs": {
+            "httpc": {"class": "fedservice.httpc.AsyncHTTPClient", "kwargs": {}}
+        }
+    },
+    "refresher": {
+        "class": 'fedservice.entity.function.refresher.StatementRefresher',
+        "kwargs": {}
+    },
+    "snapshot": {
+        "class": 'fedservice.entity.function.snapshot.CacheSnapshot',
+        "kwargs": {}
+    },
     'verifier': {
         'class': 'fedservice.entity.function.verifier.TrustChainVerifier',
         'kwargs': {}
@@ -3,14 +3,11 @@ from typing import Callable
 from typing import Optional
 from typing import Union
 
-from cryptojwt import as_unicode
 from cryptojwt import KeyJar
-from cryptojwt.jws.jws import factory
 from cryptojwt.utils import importer
 from idpyoidc.client.client_auth import client_auth_setup
 from idpyoidc.server.util import execute
 from idpyoidc.util import instantiate
-from requests import request
 
 from fedservice import message
 from fedservice.entity.function import apply_policies
@@ -18,6 +15,11 @@ from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import get_payload
 from fedservice.entity.function import get_verified_trust_chains
 from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function.parallel import make_executor
+from fedservice.entity_statement.key_store import LearnedKeyStore
+from fedservice.entity_statement.trust_chain_store import make_trust_chain_store
+from fedservice.httpc import make_httpc
+from fedservice.httpc import split_httpc_params
 
 __author__ = 'Roland Hedberg'
 
@@ -46,11 +48,15 @@ class FederationEntity(Unit):
                  authority_hints: Optional[Union[list, str, Callable]] = None,
                  persistence: Optional[dict] = None,
                  client_authn_methods: Optional[list] = None,
+                 trust_chain_store: Optional[dict] = None,
+                 executor: Optional[dict] = None,
+                 learned_keys: Optional[dict] = None,
                  **kwargs
                  ):
 
+        _pool_conf, httpc_params = split_httpc_params(httpc_params)
         if upstream_get is None and httpc is None:
-            httpc = request
+            httpc = make_httpc(_pool_conf)
 
         if not keyjar and not key_conf:
             keyjar = False
@@ -80,7 +86,21 @@ class FederationEntity(Unit):
         if client_authn_methods:
             self.context.client_authn_methods = client_auth_setup(client_authn_methods)
 
-        self.trust_chain = {}
+        # Verified trust chains per entity ID
+        self.trust_chain = make_trust_chain_store(trust_chain_store)
+        # Trust chains saved by the guises are kept in the same place
+        self.context.trust_chain = self.trust_chain
+
+        # Thread or process pool used to verify trust chains and apply policies in parallel
+        self.executor = make_executor(executor)
+
+        # Keys learned from entity statements are removed when they expire or are not used.
+        # The entity's own keys and those of the trust anchors are pinned.
+        self.key_store = LearnedKeyStore(**(learned_keys or {}))
+        self.key_store.pin("", entity_id)
+        _collector = self.get_function("trust_chain_collector")
+        if _collector:
+            self.key_store.pin(*_collector.trust_anchors.keys())
 
         self.context.provider_info = self.context.claims.get_server_metadata(
             endpoints=self.server.endpoint.values(),
@@ -219,9 +239,7 @@ class FederationEntity(Unit):
         return trust_chains[0]
 
     def get_payload(self, self_signed_statement):
-        _jws = as_unicode(self_signed_statement)
-        _jwt = factory(_jws)
-        return _jwt.jwt.payload()
+        return get_payload(self_signed_statement)
 
     def supported(self):
         _supports = self.context.supports()
@@ -260,6 +278,18 @@ class FederationEntity(Unit):
     def store_trust_chains(self, entity_id, chains):
         self.trust_chain[entity_id] = chains
 
+    def sweep(self) -> dict:
+        """
+        Remove expired statements from the trust chain collector's caches, expired
+        verified trust chains and the keys learned from expired statements.
+
+        :return: What was removed
+        """
+        res = self.function.trust_chain_collector.sweep()
+        res["keys"] = self.key_store.sweep(self.keyjar)
+        res["trust_chain"] = self.trust_chain.sweep()
+        return res
+
     def get_verified_metadata(self, entity_id: str, *args):
         _trust_chains = self.trust_chain.get(entity_id)
         if _trust_chains is None:
@@ -299,7 +329,9 @@ class FederationEntity(Unit):
 
             # add subjects key/-s to keyjar
             _kj = self.get_federation_entity().keyjar
+            _introduced = _es["sub"] not in _kj
             _kj = import_jwks(_kj, _es["jwks"], _es["sub"])
+            self.key_store.learned(_kj, _es["sub"], _es.get("exp"), _introduced)
 
             # Fetch Entity Configuration
             _ec = self.client.do_request("entity_configuration", entity_id=subordinate)
@@ -375,7 +407,7 @@ class FederationEntity(Unit):
         self.get_function("trust_chain_collector").trust_anchors = value
 
     def add_trust_anchor(self, entity_id, jwks):
-        if self.keyjar:
+        if self.keyjar is not None:
             _keyjar = self.keyjar
         elif self.upstream_get:
             _keyjar = self.upstream_get('attribute', 'keyjar')
@@ -384,6 +416,7 @@ class FederationEntity(Unit):
 
         _keyjar = import_jwks(_keyjar, jwks, entity_id)
         self.trust_anchors[entity_id] = jwks
+        self.key_store.pin(entity_id)
 
     def supports(self):
         res = {}
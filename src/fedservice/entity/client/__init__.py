@@ -23,10 +23,11 @@ from idpyoidc.exception import ParseError
 from idpyoidc.key_import import import_jwks
 from idpyoidc.message import Message
 from idpyoidc.node import ClientUnit
-from requests import request
 
 from fedservice.defaults import DEFAULT_FEDERATION_ENTITY_SERVICES
 from fedservice.entity import FederationContext
+from fedservice.httpc import make_httpc
+from fedservice.httpc import split_httpc_params
 
 logger = logging.getLogger(__name__)
 
@@ -253,12 +254,15 @@ class FederationClient(FederationClientEntity):
         elif config and 'client_type' in config:
             self.client_type = config["client_type"]
 
+        if not httpc_params:
+            httpc_params = config.get("httpc_params")
+        _pool_conf, httpc_params = split_httpc_params(httpc_params)
         if verify_ssl is False:
             # just ignore verify_ssl until it goes away
-            if httpc_params:
-                httpc_params["verify"] = False
-            else:
-                httpc_params = {"verify": False}
+            httpc_params["verify"] = False
+
+        if httpc is None:
+            httpc = make_httpc(_pool_conf)
 
         jwks_uri = jwks_uri or config.get('jwks_uri', '')
 
@@ -274,7 +278,7 @@ class FederationClient(FederationClientEntity):
             entity_id=entity_id,
         )
 
-        self.httpc = httpc or request
+        self.httpc = httpc
 
         if isinstance(config, Configuration):
             _add_ons = config.conf.get("add_ons")
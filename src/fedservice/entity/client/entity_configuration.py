@@ -4,7 +4,6 @@ from typing import Optional
 from typing import Union
 from urllib.parse import urlparse
 
-import requests
 from idpyoidc.client.configure import Configuration
 from idpyoidc.message import oauth2
 from idpyoidc.message.oauth2 import ResponseMessage
@@ -45,9 +44,20 @@ class EntityConfiguration(FederationService):
                  conf: Optional[Union[dict, Configuration]] = None):
         """The service that talks to the OIDC federation well-known endpoint."""
         FederationService.__init__(self, upstream_get, conf=conf)
-        self.httpc = requests.request
+        self._httpc = None
         self.httpc_params = {}
 
+    @property
+    def httpc(self):
+        # Use the HTTP client, and by that the connection pool, of the entity
+        if self._httpc is None:
+            return self.upstream_get("attribute", "httpc")
+        return self._httpc
+
+    @httpc.setter
+    def httpc(self, value):
+        self._httpc = value
+
     def get_request_parameters(
             self, request_args=None, method="", request_body_type="", authn_method="",
             tenant: Optional[bool] = False, **kwargs
@@ -1,23 +1,25 @@
+import asyncio
+import functools
 import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Executor
 from typing import Callable
 from typing import List
 from typing import Optional
 
-from cryptojwt import as_unicode
-from cryptojwt.jws.jws import factory
-from cryptojwt.jwt import JWT
-from cryptojwt.key_jar import KeyJar
 from idpyoidc.impexp import ImpExp
-from idpyoidc.key_import import import_jwks
 
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.verification import verify_self_signed
 
 logger = logging.getLogger(__name__)
 
 
 def unverified_entity_statement(signed_jwt):
-    _jws = factory(signed_jwt)
-    return _jws.jwt.payload()
+    return dict(signed_token(signed_jwt).payload)
 
 
 def verify_self_signed_signature(token):
@@ -29,12 +31,8 @@ def verify_self_signed_signature(token):
     :return: Payload of the signed JWT
     """
 
-    payload = unverified_entity_statement(token)
-    keyjar = KeyJar()
-    keyjar = import_jwks(keyjar, payload['jwks'], payload['iss'])
-
-    _jwt = JWT(key_jar=keyjar)
-    _val = _jwt.unpack(token)
+    token = signed_token(token)
+    _val = verify_self_signed(token)
     _val["_jws"] = token
     return _val
 
@@ -98,15 +96,39 @@ def collect_trust_chains(unit,
         return [], None
 
 
-def verify_trust_chains(unit, chains: List[List[str]], *entity_statements):
-    #
-    _verifier = get_federation_entity(unit).function.verifier
+def verify_trust_chains(unit, chains: List[List[str]], *entity_statements,
+                        executor: Optional[Executor] = None):
+    """
+    :param unit: A Unit instance
+    :param chains: Chains of entity statements, the trust anchor's first
+    :param entity_statements: Added to the end of each chain, normally the entity configuration
+    :param executor: If given the chains are verified in parallel by it. If not, the
+        federation entity's executor is used if it has one.
+    :return: List of verified TrustChain instances
+    """
+    _federation_entity = get_federation_entity(unit)
+    _verifier = _federation_entity.function.verifier
 
     logger.debug("verify_trust_chains")
+    if entity_statements:
+        for c in chains:
+            c.extend(entity_statements)
+
+    if executor is None:
+        executor = getattr(_federation_entity, "executor", None)
+    if executor and len({c[0] for c in chains}) > 1:
+        # One subtree per trust anchor statement is verified by each worker
+        from fedservice.entity.function.parallel import verify_chains
+
+        _keyjar = _verifier.upstream_get("attribute", "keyjar")
+        return [_tc for _tc in verify_chains(_verifier, _keyjar, chains, executor) if _tc]
+
+    if hasattr(_verifier, "verify_trust_chains"):
+        # Statements shared by several chains are only verified once
+        return [_tc for _tc in _verifier.verify_trust_chains(chains) if _tc]
+
     res = []
     for c in chains:
-        if entity_statements:
-            c.extend(entity_statements)
         trust_chain = _verifier(c)
         if trust_chain:
             res.append(trust_chain)
@@ -121,15 +143,26 @@ def verify_trust_chain(unit, chain: List[str]):
     return _verifier(chain)
 
 
-def apply_policies(unit, trust_chains):
+def apply_policies(unit, trust_chains, executor: Optional[Executor] = None):
     """
     Goes through the collected trust chains, verifies them and applies policies.
 
     :param unit: A Unit instance
     :param trust_chains: List of TrustChain instances
+    :param executor: If given the policies are applied in parallel by it. If not, the
+        federation entity's executor is used if it has one.
     :return: List of processed TrustChain instances
     """
-    _policy_applier = get_federation_entity(unit).function.policy
+    _federation_entity = get_federation_entity(unit)
+    _policy_applier = _federation_entity.function.policy
+
+    if executor is None:
+        executor = getattr(_federation_entity, "executor", None)
+    if executor and len(trust_chains) > 1:
+        from fedservice.entity.function.parallel import apply_chain_policies
+
+        apply_chain_policies(_policy_applier, trust_chains, executor)
+        return list(trust_chains)
 
     res = []
     for trust_chain in trust_chains:
@@ -139,9 +172,7 @@ def apply_policies(unit, trust_chains):
 
 
 def get_payload(self_signed_statement):
-    _jws = as_unicode(self_signed_statement)
-    _jwt = factory(_jws)
-    return _jwt.jwt.payload()
+    return dict(signed_token(self_signed_statement).payload)
 
 
 class Function(ImpExp):
@@ -151,7 +182,36 @@ class Function(ImpExp):
         self.upstream_get = upstream_get
 
 
+def resolve_trust_chains(unit, entity_id: str) -> list:
+    """
+    Get trust chains from the trusted resolvers. The chains are verified locally.
+
+    :param unit: A Unit instance
+    :param entity_id: The entity ID of the entity the trust chains should be for
+    :return: List of TrustChain instances with policies applied. Empty if none of the
+        resolvers gave a trust chain that could be verified.
+    """
+    _collector = get_federation_entity(unit).function.trust_chain_collector
+    for resolver in getattr(_collector, "trusted_resolvers", {}):
+        _chain = _collector.resolve(entity_id, resolver)
+        if not _chain:
+            continue
+        try:
+            trust_chains = verify_trust_chains(unit, [_chain])
+        except Exception as err:
+            logger.warning(f"Could not verify trust chain from {resolver}: {err}")
+            continue
+        if trust_chains:
+            logger.debug(f"Trust chain for {entity_id} resolved by {resolver}")
+            return apply_policies(unit, trust_chains)
+    return []
+
+
 def get_verified_trust_chains(unit, entity_id):
+    trust_chains = resolve_trust_chains(unit, entity_id)
+    if trust_chains:
+        return trust_chains
+
     chains, leaf_ec = collect_trust_chains(unit, entity_id)
     if len(chains) == 0:
         return []
@@ -161,6 +221,104 @@ def get_verified_trust_chains(unit, entity_id):
     return trust_chains
 
 
+# federation entity -> HTTP client -> asynchronous collector using it
+_async_collectors = weakref.WeakKeyDictionary()
+_async_collectors_lock = threading.Lock()
+# The number of HTTP clients per federation entity a collector is kept for
+ASYNC_COLLECTORS_PER_ENTITY = 8
+
+
+def _get_async_collector(federation_entity, httpc: Optional[Callable] = None):
+    from fedservice.entity.function.async_trust_chain_collector import AsyncTrustChainCollector
+
+    _collector = getattr(federation_entity.function, "async_trust_chain_collector", None)
+    if httpc:
+        if _collector and _collector.httpc == httpc:
+            return _collector
+
+        if _collector:
+            _httpc_params = _collector.httpc_params
+        else:
+            _httpc_params = {}
+
+        # Reused so that concurrent requests using the same client share in-flight requests
+        with _async_collectors_lock:
+            _collectors = _async_collectors.setdefault(federation_entity, OrderedDict())
+            _collector = _collectors.get(httpc)
+            if _collector:
+                _collectors.move_to_end(httpc)
+                return _collector
+
+            _upstream_get = federation_entity.function.trust_chain_collector.upstream_get
+            _collector = AsyncTrustChainCollector(upstream_get=_upstream_get, httpc=httpc,
+                                                  httpc_params=_httpc_params)
+            _collectors[httpc] = _collector
+            while len(_collectors) > ASYNC_COLLECTORS_PER_ENTITY:
+                _collectors.popitem(last=False)
+    elif _collector is None:
+        raise ValueError("No asynchronous trust chain collector and no HTTP client")
+    return _collector
+
+
+async def async_collect_trust_chains(unit,
+                                     entity_id: str,
+                                     signed_entity_configuration: Optional[str] = "",
+                                     stop_at: Optional[str] = "",
+                                     authority_hints: Optional[list] = None,
+                                     httpc: Optional[Callable] = None):
+    """
+    Same as :py:func:`collect_trust_chains` but all the HTTP requests are done using an
+    asynchronous HTTP client.
+
+    :param httpc: An asynchronous HTTP client. If not given the one configured for the
+        async_trust_chain_collector function is used.
+    """
+    _federation_entity = get_federation_entity(unit)
+    _collector = _get_async_collector(_federation_entity, httpc)
+
+    if signed_entity_configuration:
+        entity_configuration = verify_self_signed_signature(signed_entity_configuration)
+        if authority_hints:
+            entity_configuration["authority_hints"] = authority_hints
+        tree = await _collector.collect_tree(entity_id, entity_configuration, stop_at=stop_at)
+    else:
+        try:
+            _collector_response = await _collector(entity_id, stop_at=stop_at)
+        except Exception as err:
+            logger.error(f"Trust chain collection failed {err}")
+            raise (err)
+        if _collector_response:
+            tree, signed_entity_configuration = _collector_response
+        else:
+            tree = None
+
+    if tree:
+        chains = tree2chains(tree)
+        logger.debug("%d chains", len(chains))
+        return chains, signed_entity_configuration
+    elif tree == {}:
+        return [], signed_entity_configuration
+    else:
+        return [], None
+
+
+async def async_verify_trust_chains(unit, chains: List[List[str]], *entity_statements):
+    # Signature verification is CPU bound so keep it out of the event loop
+    _loop = asyncio.get_running_loop()
+    return await _loop.run_in_executor(
+        None, functools.partial(verify_trust_chains, unit, chains, *entity_statements))
+
+
+async def async_get_verified_trust_chains(unit, entity_id, httpc: Optional[Callable] = None):
+    chains, leaf_ec = await async_collect_trust_chains(unit, entity_id, httpc=httpc)
+    if len(chains) == 0:
+        return []
+
+    trust_chains = await async_verify_trust_chains(unit, chains, leaf_ec)
+    _loop = asyncio.get_running_loop()
+    return await _loop.run_in_executor(None, apply_policies, unit, trust_chains)
+
+
 def get_entity_endpoint(unit, entity_id, metadata_type, metadata_parameter):
     _federation_entity = get_federation_entity(unit)
     if entity_id in _federation_entity.trust_anchors:
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import weakref
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Union
+
+from idpyoidc.exception import MissingPage
+from idpyoidc.message import Message
+from idpyoidc.server.util import execute
+from requests.exceptions import ConnectionError
+
+from fedservice.entity.function import Function
+from fedservice.entity.function.trust_chain_collector import document_from_response
+from fedservice.entity.function.trust_chain_collector import get_endpoint
+from fedservice.entity.function.trust_chain_collector import TreeMemo
+from fedservice.entity.function.trust_chain_collector import verify_self_signed_signature
+from fedservice.entity.utils import get_federation_entity
+from fedservice.exception import FailedConfigurationRetrieval
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTrustChainCollector(Function):
+    """
+    Collects trust chains without blocking the event loop.
+
+    The HTTP client is an awaitable with the same call signature as :py:func:`requests.request`
+    (method, url, **kwargs) returning something with the attributes status_code, headers and
+    text. httpx.AsyncClient.request is one such client.
+    Caches, the negative cache and trust anchors are shared with the synchronous trust chain
+    collector of the federation entity. Concurrent requests for the same URL share one HTTP
+    request unless single flight is turned off for the synchronous collector.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 httpc: Optional[Callable] = None,
+                 httpc_params: Optional[dict] = None,
+                 **kwargs
+                 ):
+        Function.__init__(self, upstream_get)
+        if isinstance(httpc, dict):
+            httpc = execute(httpc)
+        self.httpc = httpc
+        self.httpc_params = httpc_params or {}
+        # event loop -> URL -> task fetching it. A task belongs to the loop it was created in.
+        self._in_flight = weakref.WeakKeyDictionary()
+        self.shared = 0
+
+    @property
+    def collector(self):
+        return get_federation_entity(self).function.trust_chain_collector
+
+    def _get_service(self, service):
+        federation_entity = get_federation_entity(self)
+        return federation_entity.client.get_service(service)
+
+    async def get_document(self, url: str):
+        """
+
+        :param url: Target URL
+        :return: Signed EntityStatement
+        """
+        if self.httpc is None:
+            raise ValueError("No asynchronous HTTP client")
+
+        if self.collector.in_flight is None:
+            return await self._get_document(url)
+
+        _in_flight = self._in_flight.setdefault(asyncio.get_running_loop(), {})
+        _task = _in_flight.get(url)
+        if _task is None:
+            _task = asyncio.ensure_future(self._get_document(url))
+            _in_flight[url] = _task
+            _task.add_done_callback(lambda _: _in_flight.pop(url, None))
+        else:
+            logger.debug(f"Waiting for in-flight request: {url}")
+            self.shared += 1
+        # One waiter being cancelled must not cancel the request for the others
+        return await asyncio.shield(_task)
+
+    async def _get_document(self, url: str):
+        _negative_cache = self.collector.negative_cache
+        _negative_cache.check(url)
+
+        logger.debug(f"Using HTTPC Params: {self.httpc_params}")
+        try:
+            response = await self.httpc("GET", url, **self.httpc_params)
+            _document = document_from_response(url, response)
+        except (MissingPage, FailedConfigurationRetrieval, ConnectionError) as err:
+            _negative_cache.add(url, err)
+            raise
+
+        _negative_cache.remove(url)
+        return _document
+
+    async def get_entity_configuration(self, entity_id):
+        """
+        Get configuration information about an entity from itself.
+
+        :param entity_id: About whom the entity statement should be
+        :return: Configuration information as a signed JWT
+        """
+        logger.debug(f"--get_configuration_information({entity_id})")
+        _serv = self._get_service('entity_configuration')
+        _res = _serv.get_request_parameters(request_args={"entity_id": entity_id})
+        logger.debug(f"Get configuration from: {_res['url']}")
+        try:
+            self_signed_config = await self.get_document(_res['url'])
+        except MissingPage:  # if tenant involved
+            _tres = _serv.get_request_parameters(request_args={"entity_id": entity_id}, tenant=True)
+            logger.debug(f"Get configuration from (tenant): '{entity_id}'")
+            if _tres["url"] != _res["url"]:
+                self_signed_config = await self.get_document(_tres["url"])
+            else:
+                raise MissingPage(f"No such page: '{_tres['url']}'")
+
+        return self_signed_config
+
+    async def get_federation_fetch_endpoint(self, intermediate: str) -> str:
+        logger.debug(f'--get_federation_fetch_endpoint({intermediate})')
+        _collector = self.collector
+        _entity_config = _collector.config_cache[intermediate]
+        if _entity_config:
+            fed_fetch_endpoint = get_endpoint("fetch", _entity_config)
+        else:
+            fed_fetch_endpoint = None
+
+        if not fed_fetch_endpoint:
+            signed_entity_config = await self.get_entity_configuration(intermediate)
+            if signed_entity_config is None:
+                return ''
+
+            entity_config = verify_self_signed_signature(signed_entity_config)
+            fed_fetch_endpoint = get_endpoint("fetch", entity_config)
+            entity_config["_jws"] = signed_entity_config
+            _collector.config_cache[intermediate] = entity_config
+
+        return fed_fetch_endpoint
+
+    async def get_entity_statement(self, fetch_endpoint, issuer, subject):
+        """
+        Get Entity Statement by one entity about another or about itself
+
+        :param fetch_endpoint: The federation fetch endpoint
+        :param issuer: Who should issue the entity statement
+        :param subject: About whom the entity statement should be
+        :return: A signed JWT
+        """
+        _serv = self._get_service('entity_statement')
+        _res = _serv.get_request_parameters(subject=subject, fetch_endpoint=fetch_endpoint,
+                                            issuer=issuer)
+        return await self.get_document(_res['url'])
+
+    async def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        _collector = self.collector
+        # Expired statements are weeded out by the synchronous collector
+        entity_statement = _collector._cached_entity_statement(entity, authority,
+                                                               revalidate=False)
+
+        if entity_statement is None:
+            fed_fetch_endpoint = await self.get_federation_fetch_endpoint(authority)
+            if not fed_fetch_endpoint:
+                return None
+            entity_statement = await self.get_entity_statement(fed_fetch_endpoint, authority,
+                                                               entity)
+            _collector._store_entity_statement(entity, authority, entity_statement)
+
+        return entity_statement
+
+    async def collect_tree(self,
+                           entity_id: str,
+                           entity_configuration: Union[dict, Message],
+                           seen: Optional[list] = None,
+                           max_superiors: Optional[int] = 1,
+                           stop_at: Optional[str] = "",
+                           memo: Optional[TreeMemo] = None) -> Optional[dict]:
+        """
+        Collect superiors one level at the time. Sibling branches are collected concurrently.
+
+        :param entity_id: The entity ID
+        :param entity_configuration: Entity Configuration as a dictionary
+        :param seen: A list of authorities that this process has seen.
+        :param max_superiors: The maximum number of superiors.
+        :param stop_at: The ID of the trust anchor at which the trust chain should stop.
+        :param memo: Sub-trees already collected during this run.
+        :return: Dictionary of superiors
+        """
+        superior = {}
+        if seen is None:
+            seen = []
+        if memo is None:
+            memo = TreeMemo()
+
+        if 'authority_hints' not in entity_configuration:
+            logger.debug("No authority for this entity")
+            return superior
+        elif entity_configuration['iss'] == stop_at:
+            logger.debug("Reached trust anchor")
+            return superior
+
+        _authorities = []
+        for authority in entity_configuration['authority_hints']:
+            if authority in seen or authority == entity_id:  # loop ?!
+                logger.warning(f"Loop detected at {authority}, not following it")
+                memo.loop_cut(seen)
+            elif authority not in _authorities:
+                _authorities.append(authority)
+
+        _branches = await asyncio.gather(
+            *[self.collect_branch(entity_id, authority, seen, max_superiors, stop_at=stop_at,
+                                  memo=memo)
+              for authority in _authorities])
+
+        for authority, branch in zip(_authorities, _branches):
+            superior[authority] = branch
+
+        return superior
+
+    async def collect_branch(self, entity, authority, seen=None, max_superiors=10, stop_at="",
+                             memo=None):
+        """
+        Collect an entity statement about an entity submitted by another entity, the authority.
+
+        :param authority: An authority from the authority_hints
+        :param stop_at: When this entity ID is reached stop processing
+        :param entity: The ID of the entity
+        :param seen: A list of authorities that this process has seen.
+        :param max_superiors: The maximum number of superiors allowed.
+        :param memo: Sub-trees already collected during this run.
+        :return:
+        """
+        logger.debug(f'Get view of "{entity}" from "{authority}"')
+        if entity == authority and entity in self.collector.trust_anchors:
+            return None
+
+        if seen is None:
+            _seen = []
+        else:
+            _seen = seen[:]
+
+        _seen.append(authority)
+
+        entity_statement = await self._get_entity_statement(entity, authority)
+
+        if entity_statement:
+            if memo is None:
+                memo = TreeMemo()
+            _tree = memo.get(authority)
+            if _tree is None:
+                _entity_configuration = self.collector.config_cache[authority]
+                _tree = await self.collect_tree(authority,
+                                                _entity_configuration,
+                                                stop_at=stop_at,
+                                                seen=_seen,
+                                                max_superiors=max_superiors,
+                                                memo=memo)
+                memo.add(authority, _tree)
+            return entity_statement, _tree
+        else:
+            return None
+
+    async def __call__(self,
+                       entity_id: str,
+                       max_superiors: Optional[int] = 10,
+                       seen: Optional[List[str]] = None,
+                       stop_at: Optional[str] = ''):
+        _collector = self.collector
+        entity_config = _collector.config_cache.get(entity_id, None)
+        if entity_config and not _collector.too_old(entity_config):
+            signed_entity_config = entity_config.get("_jws")
+        else:
+            signed_entity_config = None
+
+        if not signed_entity_config:
+            signed_entity_config = await self.get_entity_configuration(entity_id)
+            if not signed_entity_config:
+                logger.warning(f"Could not find any entity configuration for {entity_id}")
+                return None
+            entity_config = verify_self_signed_signature(signed_entity_config)
+            entity_config['_jws'] = signed_entity_config
+            _collector.config_cache[entity_id] = entity_config
+
+        _tree = await self.collect_tree(entity_id, entity_config, seen=seen,
+                                        max_superiors=max_superiors, stop_at=stop_at)
+        return _tree, signed_entity_config
@@ -0,0 +1,138 @@
+"""
+Verifying trust chains and applying policies to them is CPU bound. When there are many
+independent chains the work can be spread over a pool of threads or processes.
+"""
+import functools
+import logging
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Union
+
+from cryptojwt import KeyJar
+from idpyoidc.key_import import import_jwks
+from idpyoidc.util import instantiate
+
+from fedservice.entity.function.verifier import add_subject_keys
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.statement import TrustChain
+
+logger = logging.getLogger(__name__)
+
+
+def make_executor(spec: Optional[Union[dict, Executor]] = None) -> Optional[Executor]:
+    """
+    :param spec: A dictionary with the keys class and kwargs. The class is either "thread",
+        "process" or the name of an Executor class. If not given no executor is used.
+    :return: An Executor instance or None
+    """
+    if not spec:
+        return None
+    if isinstance(spec, Executor):
+        return spec
+
+    _class = spec.get("class", "thread")
+    _kwargs = dict(spec.get("kwargs", {}))
+    if _class == "thread":
+        _kwargs.setdefault("thread_name_prefix", "trust_chain_verifier")
+        return ThreadPoolExecutor(**_kwargs)
+    elif _class == "process":
+        return ProcessPoolExecutor(**_kwargs)
+    return instantiate(_class, **_kwargs)
+
+
+def _verify_subtree(verifier_class: type, anchor_keys: dict, chains: List[List[str]]
+                    ) -> List[Optional[TrustChain]]:
+    # Run in a worker thread or process. Knows nothing but the keys of the trust anchor.
+    keyjar = KeyJar()
+    for entity_id, jwks in anchor_keys.items():
+        keyjar = import_jwks(keyjar, jwks, entity_id)
+
+    def upstream_get(what, *args):
+        if what == "attribute" and args and args[0] == "keyjar":
+            return keyjar
+        return None
+
+    _verifier = verifier_class(upstream_get)
+    if hasattr(_verifier, "verify_trust_chains"):
+        # Statements shared by the chains in the subtree are only verified once
+        return _verifier.verify_trust_chains(chains)
+    return [_verifier(chain) for chain in chains]
+
+
+def _apply_policy(policy_class: type, trust_chain: TrustChain) -> TrustChain:
+    # Run in a worker process
+    policy_class(None)(trust_chain)
+    return trust_chain
+
+
+def verify_chains(verifier: Callable, keyjar: KeyJar, chains: List[List[str]],
+                  executor: Executor) -> List[Optional[TrustChain]]:
+    """
+    Verifies trust chains in parallel.
+
+    The chains are arranged in subtrees, one per trust anchor statement, and each subtree is
+    verified by a worker. Within a subtree statements shared by several chains are only
+    verified once. A worker, thread or process, is given a key jar of its own that only
+    contains the keys of the trust anchor. The keys found in the verified chains are then
+    added to the federation key jar.
+
+    :param verifier: A TrustChainVerifier instance
+    :param keyjar: The federation key jar
+    :param chains: Chains of entity statements
+    :param executor: Where the work is done
+    :return: A TrustChain instance or None for each chain, in the same order as the chains
+    """
+    # trust anchor statement -> indexes of the chains that start with it
+    _subtrees = {}
+    for i, chain in enumerate(chains):
+        _subtrees.setdefault(chain[0], []).append(i)
+
+    _anchor_keys = []
+    for _statement in _subtrees:
+        _anchor = signed_token(_statement).payload['iss']
+        if _anchor in keyjar:
+            _anchor_keys.append({_anchor: keyjar.export_jwks(issuer_id=_anchor)})
+        else:
+            _anchor_keys.append({})
+
+    _worker = functools.partial(_verify_subtree, verifier.__class__)
+    _chains = [[chains[i] for i in _index] for _index in _subtrees.values()]
+    res = [None] * len(chains)
+    for _index, _verified in zip(_subtrees.values(),
+                                 executor.map(_worker, _anchor_keys, _chains)):
+        for i, trust_chain in zip(_index, _verified):
+            res[i] = trust_chain
+
+    _key_store = verifier.upstream_get("attribute", "key_store")
+    with verifier._lock:
+        for trust_chain in res:
+            if trust_chain:
+                for statement in trust_chain.verified_chain:
+                    if _key_store:
+                        _key_store.used(statement['iss'])
+                    add_subject_keys(keyjar, statement, _key_store)
+    return res
+
+
+def apply_chain_policies(policy_applier: Callable, trust_chains: List[TrustChain],
+                         executor: Executor):
+    """
+    Applies the metadata policies of trust chains in parallel. The trust chains are updated
+    in place, like when it's done one at a time.
+
+    :param policy_applier: A TrustChainPolicy instance
+    :param trust_chains: TrustChain instances
+    :param executor: Where the work is done
+    """
+    if not isinstance(executor, ProcessPoolExecutor):
+        list(executor.map(policy_applier, trust_chains))
+        return
+
+    _worker = functools.partial(_apply_policy, policy_applier.__class__)
+    for trust_chain, _processed in zip(trust_chains, executor.map(_worker, trust_chains)):
+        trust_chain.metadata = _processed.metadata
+        trust_chain.combined_policy = _processed.combined_policy
@@ -1,5 +1,15 @@
+import copy
+import hashlib
+import json
 import logging
+import threading
+from collections import OrderedDict
+from typing import Iterable
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import Union
 
 from fedservice.entity.function import Function
 from fedservice.entity.function import PolicyError
@@ -242,61 +252,190 @@ def combine(superior: dict, subordinate: dict) -> dict:
     return superior
 
 
-def op_place(operator_name, policy_operators, index):
-    while True:
-        operator = policy_operators[index]
-        if operator.name == operator_name:
-            return index
-        index += 1
-        if index >= len(policy_operators):
-            break
-    return None
+class PolicyPlan(object):
+    """
+    A combined policy compiled into the policy operators to run per claim, in evaluation order.
+    Applying the plan gives the same result as applying the combined policy but what has to be
+    done for each claim is only worked out once.
+    """
+
+    def __init__(self, policy: dict, policy_operators: list):
+        """
+        :param policy: A dictionary with metadata and metadata_policy as keys
+        :param policy_operators: The policy operators in evaluation order
+        """
+        self.policy = policy
+        self.metadata = policy.get("metadata") or {}
+        self.metadata_policy = policy.get("metadata_policy") or {}
+        self._position = {_op.name: i for i, _op in enumerate(policy_operators)}
+        # (claim, [(position, operator)]) for the claims there are operators for
+        self.steps = []
+        for claim, claim_policy in self.metadata_policy.items():
+            _operators = [(i, _op) for i, _op in enumerate(policy_operators)
+                          if _op.name in claim_policy]
+            if _operators:
+                self.steps.append((claim, _operators))
+
+    def run(self, metadata: dict) -> dict:
+        """
+        Run the policy operators on the metadata. The metadata is changed in place.
+        """
+        for claim, operators in self.steps:
+            _skip_to = 0
+            for position, operator in operators:
+                if position < _skip_to:
+                    continue
+                _next = operator(claim, metadata, self.metadata_policy)
+                if _next:
+                    # Operators in between are not run
+                    _skip_to = self._position[_next]
+        return metadata
+
+    def apply(self, metadata: dict) -> dict:
+        """
+        Apply the plan on metadata.
+
+        :param metadata: Metadata statements
+        :return: A metadata statement that adheres to the policy
+        """
+        if self.metadata:
+            _metadata = copy.deepcopy(self.metadata)
+            _metadata.update(metadata)
+            metadata = _metadata
+
+        if self.metadata_policy:
+            metadata = self.run(metadata)
+
+        return metadata
+
 
 def apply_metadata_policy(metadata, metadata_policy, policy_operators):
     """
     Apply a metadata policy to a metadata statement.
     """
+    return PolicyPlan({"metadata_policy": metadata_policy}, policy_operators).run(metadata)
 
-    policy_set = set(metadata_policy.keys())
-    # metadata_set = set(metadata.keys())
 
-    # Metadata claims that there exists a policy for
-    for claim in policy_set:
-        i = 0
-        while True:
-            _policy_op = policy_operators[i]
-            if _policy_op.name in metadata_policy.get(claim, {}):
-                _next = _policy_op(claim, metadata, metadata_policy)
-                if _next:
-                    i = op_place(_next, policy_operators, i)
-                    continue
-            i += 1
-            if i >= len(policy_operators):
-                break
+def apply_policy_batch(policy: Union[dict, PolicyPlan],
+                       leaves: Iterable[dict],
+                       policy_operators: Optional[list] = None
+                       ) -> Iterator[Tuple[Optional[dict], Optional[PolicyError]]]:
+    """
+    Apply one combined policy to the metadata of many leaves. The policy is compiled once and
+    shared by all the leaves. The results are produced one leaf at a time, in the same order
+    as the leaves, so the leaves can be read from and the results written to a stream.
+    The leaves' metadata is not changed.
+
+    :param policy: A combined policy, a dictionary with metadata and metadata_policy as keys,
+        or a compiled one.
+    :param leaves: The metadata of the leaves for one entity type
+    :param policy_operators: The policy operators in evaluation order. Only used if the policy
+        has to be compiled.
+    :return: For each leaf a tuple of the metadata after the policy has been applied and None,
+        or None and the PolicyError that was raised.
+    """
+    if isinstance(policy, PolicyPlan):
+        plan = policy
+    else:
+        plan = PolicyPlan(policy, policy_operators or construct_evaluation_sequence())
 
+    for metadata in leaves:
+        try:
+            # The leaf's values may be lists that end up in the result, so they are copied too
+            yield plan.apply(copy.deepcopy(metadata)), None
+        except PolicyError as err:
+            yield None, err
+
+
+def plan_key(chain: List[dict], entity_type: str, scope: Optional[tuple] = ()) -> tuple:
+    """
+    The key under which the compiled policy of a sequence of superior statements is kept.
+    Only what the statements say about the entity type matters, so each statement is
+    represented by a digest of its metadata and metadata_policy for that entity type.
+
+    :param chain: Entity statements, the trust anchor's first
+    :param entity_type: The entity type
+    :param scope: Identifies how the policies are combined and compiled, see
+        :py:func:`plan_scope`. Plans compiled differently never share a key.
+    :return: A tuple of digests followed by the entity type and the scope
+    """
+    res = []
+    for statement in chain:
+        _part = [statement.get("metadata_policy", {}).get(entity_type),
+                 statement.get("metadata", {}).get(entity_type)]
+        _json = json.dumps(_part, sort_keys=True)
+        res.append(hashlib.sha256(_json.encode("utf-8")).hexdigest())
+    res.append(entity_type)
+    res.extend(scope)
+    return tuple(res)
+
+
+def _qualified_name(cls: type) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
 
-    # In policy but not in metadata
-    # for claim in policy_set.difference(metadata_set):
-    #     if "value" in metadata_policy[claim]:
-    #         metadata[claim] = metadata_policy[claim]['value']
-    #     elif "add" in metadata_policy[claim]:
-    #         metadata[claim] = metadata_policy[claim]['add']
-    #     elif "default" in metadata_policy[claim]:
-    #         metadata[claim] = metadata_policy[claim]['default']
-    #
-    #     if claim not in metadata:
-    #         if "essential" in metadata_policy[claim] and metadata_policy[claim]["essential"]:
-    #             raise PolicyError(f"Essential claim '{claim}' missing")
 
-    return metadata
+def plan_scope(policy_class: type, policy_operators: list) -> tuple:
+    """
+    :param policy_class: The class that combines the policies
+    :param policy_operators: The policy operators in evaluation order
+    :return: The class followed by the operators, each one by name and class
+    """
+    res = [_qualified_name(policy_class)]
+    res.extend(f"{_op.name}={_qualified_name(_op.__class__)}" for _op in policy_operators)
+    return tuple(res)
 
 
+class PolicyPlanCache(object):
+    """
+    Compiled policies, least recently used first. Leaves below the same intermediates share
+    the superior statements and therefore the compiled policy.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 1000):
+        """
+        :param max_entries: The maximum number of compiled policies kept. 0 means no limit.
+        """
+        self.max_entries = max_entries
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[PolicyPlan]:
+        with self._lock:
+            plan = self._db.get(key)
+            if plan is None:
+                self.misses += 1
+            else:
+                self._db.move_to_end(key)
+                self.hits += 1
+            return plan
+
+    def add(self, key: tuple, plan: PolicyPlan):
+        with self._lock:
+            self._db[key] = plan
+            self._db.move_to_end(key)
+            while self.max_entries and len(self._db) > self.max_entries:
+                self._db.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._db.clear()
+
+    def __len__(self):
+        return len(self._db)
+
+
+# Shared by all TrustChainPolicy instances in the process
+policy_plan_cache = PolicyPlanCache()
+
 
 class TrustChainPolicy(Function):
 
     def __init__(self, upstream_get):
         Function.__init__(self, upstream_get)
         self.policy_operators = construct_evaluation_sequence()
+        self.plan_cache = policy_plan_cache
 
     def gather_policies(self, chain, entity_type):
         """
@@ -340,23 +479,29 @@ class TrustChainPolicy(Function):
         :return: A metadata statement that adheres to a metadata policy
         """
 
-        _metadata = policy.get("metadata", None)
-        if _metadata:
-            _metadata = _metadata.copy()
-            _metadata.update(metadata)
-            metadata = _metadata
-
-        _metadata_policy = policy.get('metadata_policy', None)
-        if _metadata_policy:
-            metadata = apply_metadata_policy(metadata, _metadata_policy, self.policy_operators)
+        return PolicyPlan(policy, self.policy_operators).apply(metadata)
 
-        # All that are in metadata but not in policy should just remain
-        # metadata.update(policy.get('metadata', {}))
+    def compile(self, chain: List[dict], entity_type: str) -> PolicyPlan:
+        """
+        Combine the metadata policies in a sequence of superior statements and compile the
+        result. Compiled policies are cached.
 
-        return metadata
+        :param chain: A list of Entity Statements, the trust anchor's first
+        :param entity_type: Which Entity Type the policies are for
+        :return: A PolicyPlan instance
+        """
+        # The operators may have been replaced after the instance was created
+        _key = plan_key(chain, entity_type, plan_scope(self.__class__, self.policy_operators))
+        plan = self.plan_cache.get(_key)
+        if plan is None:
+            plan = PolicyPlan(self.gather_policies(chain, entity_type), self.policy_operators)
+            self.plan_cache.add(_key, plan)
+        return plan
 
     def _policy(self, trust_chain: TrustChain, entity_type: str):
-        combined_policy = self.gather_policies(trust_chain.verified_chain[:-1], entity_type)
+        plan = self.compile(trust_chain.verified_chain[:-1], entity_type)
+        # The plan is shared, the trust chain gets a copy of its policy
+        combined_policy = copy.deepcopy(plan.policy)
         logger.debug("Combined policy: %s", combined_policy)
         try:
             # This should be the entity configuration
@@ -364,9 +509,10 @@ class TrustChainPolicy(Function):
         except KeyError:
             return None
         else:
-            # apply the combined metadata policies on the metadata
+            # apply the combined metadata policies on the metadata. The verified statement
+            # is not to be changed.
             trust_chain.combined_policy[entity_type] = combined_policy
-            _metadata = self.apply_policy(metadata, combined_policy)
+            _metadata = plan.apply(copy.deepcopy(metadata))
             logger.debug(f"After applied policy: {_metadata}")
             return _metadata
 
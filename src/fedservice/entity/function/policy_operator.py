@@ -1,3 +1,5 @@
+import copy
+
 from fedservice.entity.function import PolicyError
 
 POLICY_APPLICATION_ORDER = ['value', 'add', 'default', 'one_of', 'subset_of', 'superset_of', 'essential']
@@ -32,8 +34,8 @@ class Value(PolicyOperator):
     default_next = "essential"
 
     def __call__(self, claim, metadata, metadata_policy):
-        # value overrides everything
-        metadata[claim] = metadata_policy[claim][self.name]
+        # value overrides everything. The policy may be shared so its values are copied.
+        metadata[claim] = copy.deepcopy(metadata_policy[claim][self.name])
         return self.next
 
 
@@ -62,7 +64,7 @@ class Add(PolicyOperator):
         if claim in metadata:
             metadata[claim] = list(union(metadata[claim], metadata_policy[claim][self.name]))
         else:
-            metadata[claim] = metadata_policy[claim][self.name]
+            metadata[claim] = copy.deepcopy(metadata_policy[claim][self.name])
 
 class Default(PolicyOperator):
     name = "default"
@@ -70,7 +72,7 @@ class Default(PolicyOperator):
 
     def __call__(self, claim, metadata, metadata_policy):
         if claim not in metadata:
-            metadata[claim] = metadata_policy[claim][self.name]
+            metadata[claim] = copy.deepcopy(metadata_policy[claim][self.name])
 
 
 class SubsetOf(PolicyOperator):
@@ -0,0 +1,244 @@
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity.function import Function
+from fedservice.entity.function import get_verified_trust_chains
+from fedservice.entity.function.trust_chain_collector import cache_key
+from fedservice.entity.utils import get_federation_entity
+
+logger = logging.getLogger(__name__)
+
+CONFIG = "config"
+STATEMENT = "statement"
+
+
+def trust_chain_dependencies(trust_chain) -> List[tuple]:
+    """
+    The cached statements a trust chain was built from.
+
+    :param trust_chain: A :py:class:`fedservice.entity_statement.statement.TrustChain` instance
+    :return: List of (type, cache key) tuples
+    """
+    _path = trust_chain.iss_path
+    res = [(CONFIG, _path[0])]
+    for i in range(len(_path) - 1):
+        res.append((STATEMENT, cache_key(_path[i + 1], _path[i])))
+    return res
+
+
+class StatementRefresher(Function):
+    """
+    Re-fetches cached entity configurations and subordinate statements in the background,
+    before they become too old to be used. Trust chains stored by the federation entity that
+    were built from a statement that has changed are verified again.
+
+    A statement is due when there are less than refresh_ahead seconds left until
+    exp - allowed_delta. A random amount of up to jitter seconds is added per statement so
+    statements that were collected together are not all fetched at the same time.
+    When running in the background expired statements and trust chains are also removed
+    each round.
+    If fetching a statement fails it is tried again after retry_backoff seconds, doubling the
+    wait after each failure up to retry_max seconds.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 refresh_ahead: Optional[int] = 120,
+                 interval: Optional[int] = 30,
+                 max_workers: Optional[int] = 4,
+                 jitter: Optional[int] = 30,
+                 autostart: Optional[bool] = False,
+                 retry_backoff: Optional[int] = 10,
+                 retry_max: Optional[int] = 300,
+                 **kwargs):
+        Function.__init__(self, upstream_get)
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.max_workers = max_workers
+        self.jitter = jitter
+        self.retry_backoff = retry_backoff
+        self.retry_max = retry_max
+        self._due = {}
+        self._done = {}
+        # key -> (exp, number of failures, when to try again)
+        self._retry = {}
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        if autostart:
+            self.start()
+
+    @property
+    def collector(self):
+        return get_federation_entity(self).function.trust_chain_collector
+
+    def _due_at(self, key: tuple, exp: int, allowed_delta: int) -> int:
+        # The jitter is picked once per version of a statement
+        _due = self._due.get(key)
+        if _due is None or _due[0] != exp:
+            _offset = random.randint(0, self.jitter) if self.jitter else 0
+            _due = (exp, exp - allowed_delta - self.refresh_ahead - _offset)
+            self._due[key] = _due
+        return _due[1]
+
+    def due(self) -> List[tuple]:
+        """
+        Find the cached statements that should be fetched again now.
+
+        :return: List of (type, cache key, exp) tuples
+        """
+        _collector = self.collector
+        _now = utc_time_sans_frac()
+        res = []
+
+        for typ, _cache in [(CONFIG, _collector.config_cache),
+                            (STATEMENT, _collector.entity_statement_cache)]:
+            for key in list(_cache.keys()):
+                _exp = _cache.expires_at(key)
+                if _exp is None:
+                    continue
+                res.append(((typ, key), _exp, _cache))
+
+        # Forget about statements that are no longer cached
+        _known = {_key for _key, _, _ in res}
+        for _store in [self._due, self._done, self._retry]:
+            for _key in [k for k in _store.keys() if k not in _known]:
+                del _store[_key]
+
+        _due = []
+        for _key, _exp, _cache in res:
+            if self._done.get(_key) == _exp:
+                # Already tried, got the same statement back
+                continue
+            _retry = self._retry.get(_key)
+            if _retry and _retry[0] == _exp and _now < _retry[2]:
+                # Failed recently
+                continue
+            if _now >= self._due_at(_key, _exp, _cache.allowed_delta):
+                _due.append((_key[0], _key[1], _exp))
+        return _due
+
+    def refresh(self, typ: str, key: str, exp: int) -> bool:
+        """
+        Fetch one statement again.
+
+        :return: True if the statement changed
+        """
+        _collector = self.collector
+        try:
+            if typ == CONFIG:
+                _old = _collector.config_cache.get(key, {}).get("_jws")
+                _config = _collector.refresh_entity_configuration(key)
+                _new = _config["_jws"] if _config else None
+                _new_exp = _collector.config_cache.expires_at(key)
+            else:
+                authority, entity = key.split("!!", 1)
+                _old = _collector.entity_statement_cache.get(key)
+                _new = _collector.refresh_entity_statement(entity, authority)
+                _new_exp = _collector.entity_statement_cache.expires_at(key)
+        except Exception as err:
+            _retry = self._retry.get((typ, key))
+            _failures = _retry[1] + 1 if _retry and _retry[0] == exp else 1
+            _wait = min(self.retry_backoff * 2 ** (_failures - 1), self.retry_max)
+            logger.warning(f"Refreshing {key} failed: {err}, trying again in {_wait} seconds")
+            self._retry[(typ, key)] = (exp, _failures, utc_time_sans_frac() + _wait)
+            return False
+
+        self._retry.pop((typ, key), None)
+        self._done[(typ, key)] = _new_exp
+        return _new is not None and _new != _old
+
+    def run_once(self) -> List[tuple]:
+        """
+        Fetch all statements that are due and verify the trust chains that depend on
+        the ones that changed.
+
+        :return: List of (type, cache key) tuples for the statements that changed
+        """
+        with self._lock:
+            _due = self.due()
+            if not _due:
+                return []
+
+            logger.debug(f"Refreshing {len(_due)} statements")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="statement_refresher")
+            _futures = {self._executor.submit(self.refresh, *item): item for item in _due}
+            wait(_futures)
+
+            _changed = [(item[0], item[1]) for fut, item in _futures.items() if fut.result()]
+            if _changed:
+                self.reverify(_changed)
+            return _changed
+
+    def reverify(self, changed: List[tuple]):
+        """
+        Verify the stored trust chains that were built from changed statements again.
+
+        :param changed: List of (type, cache key) tuples
+        """
+        _federation_entity = get_federation_entity(self)
+        _changed = set(changed)
+        for entity_id, trust_chains in list(_federation_entity.trust_chain.items()):
+            _affected = False
+            for trust_chain in trust_chains:
+                if _changed.intersection(trust_chain_dependencies(trust_chain)):
+                    _affected = True
+                    break
+            if not _affected:
+                continue
+
+            logger.debug(f"Verifying the trust chains for {entity_id} again")
+            try:
+                _trust_chains = get_verified_trust_chains(_federation_entity, entity_id)
+            except Exception as err:
+                logger.warning(f"Could not verify trust chains for {entity_id}: {err}")
+                _trust_chains = []
+
+            if _trust_chains:
+                _federation_entity.store_trust_chain(entity_id, _trust_chains)
+            else:
+                # Will be collected again when needed
+                _federation_entity.trust_chain.pop(entity_id, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as err:
+                logger.exception(f"Statement refresh failed: {err}")
+            try:
+                get_federation_entity(self).sweep()
+            except Exception as err:
+                logger.exception(f"Removing expired statements failed: {err}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="statement_refresher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
@@ -0,0 +1,70 @@
+import logging
+import threading
+from typing import Any
+from typing import Callable
+
+from fedservice.exception import FedServiceError
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that are made with the same key.
+    The first caller does the work. Callers that arrive while that work is in progress
+    wait for it to finish and get the same result. If the work fails each of them gets an
+    exception of its own, of the same type and chained to the one the first caller got.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key: str, func: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            _call = self._calls.get(key)
+            if _call is None:
+                _call = _Call()
+                self._calls[key] = _call
+                _leader = True
+            else:
+                self.shared += 1
+                _leader = False
+
+        if not _leader:
+            logger.debug(f"Waiting for in-flight request: {key}")
+            _call.event.wait()
+            if _call.error is not None:
+                # The same instance raised in several threads would get its traceback mangled
+                _msg = f"In-flight request for {key} failed: {_call.error}"
+                try:
+                    _new = type(_call.error)(_msg)
+                except Exception:
+                    _new = FedServiceError(_msg)
+                raise _new from _call.error
+            return _call.result
+
+        try:
+            _call.result = func(*args, **kwargs)
+        except Exception as err:
+            _call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            _call.event.set()
+
+        return _call.result
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._calls.keys())
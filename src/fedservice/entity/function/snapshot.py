@@ -0,0 +1,182 @@
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Callable
+from typing import Optional
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity.function import Function
+from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.statement import TrustChain
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+CACHES = ["config_cache", "entity_statement_cache"]
+
+
+class CacheSnapshot(Function):
+    """
+    Keeps a copy of the trust chain collector's caches and the verified trust chains in a file,
+    so that a restarted process doesn't have to fetch and verify everything again.
+
+    The snapshot is written every interval seconds and when the process exits. At start it is
+    read in the background. What is in the snapshot is only used for statements and trust chains
+    that have not been collected since the start. Expired statements and trust chains are
+    skipped.
+    """
+
+    def __init__(self,
+                 upstream_get: Callable,
+                 path: Optional[str] = "",
+                 interval: Optional[int] = 300,
+                 autostart: Optional[bool] = False,
+                 **kwargs):
+        """
+        :param path: The snapshot file
+        :param interval: Seconds between writes of the snapshot. 0 means that it's only
+            written when the process exits.
+        :param autostart: Whether to start loading and saving right away
+        """
+        Function.__init__(self, upstream_get)
+        self.path = path
+        self.interval = interval
+        self.loaded = threading.Event()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        if autostart:
+            self.start()
+
+    def snapshot(self) -> dict:
+        _federation_entity = get_federation_entity(self)
+        _collector = _federation_entity.function.trust_chain_collector
+        info = {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": utc_time_sans_frac(),
+        }
+        for _cache in CACHES:
+            info[_cache] = getattr(_collector, _cache).dump()
+        info["trust_chain"] = {
+            entity_id: [_chain.dump() for _chain in trust_chains]
+            for entity_id, trust_chains in list(_federation_entity.trust_chain.items())
+        }
+        return info
+
+    def save(self, path: Optional[str] = "") -> str:
+        """
+        Write the snapshot. A new file is written and then moved into place so a reader never
+        sees half a snapshot.
+
+        :param path: Where to write it if not the configured place
+        :return: The name of the file
+        """
+        _path = path or self.path
+        with self._lock:
+            _info = self.snapshot()
+            _dir = os.path.dirname(os.path.abspath(_path))
+            _fd, _tmp = tempfile.mkstemp(dir=_dir, prefix=".snapshot")
+            try:
+                with os.fdopen(_fd, "w") as fp:
+                    json.dump(_info, fp, separators=(",", ":"))
+                os.replace(_tmp, _path)
+            except Exception:
+                os.unlink(_tmp)
+                raise
+        logger.debug(f"Snapshot written to {_path}")
+        return _path
+
+    def restore(self, path: Optional[str] = "") -> int:
+        """
+        Read a snapshot. Statements and trust chains that are already known are not replaced.
+
+        :param path: Where to read it from if not the configured place
+        :return: The number of statements and trust chains that were added
+        """
+        _path = path or self.path
+        try:
+            return self._restore(_path)
+        finally:
+            self.loaded.set()
+
+    def _restore(self, path: str) -> int:
+        try:
+            with open(path) as fp:
+                _info = json.load(fp)
+        except FileNotFoundError:
+            logger.debug(f"No snapshot in {path}")
+            return 0
+
+        if _info.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Ignoring snapshot in {path} with unknown version")
+            return 0
+
+        _now = utc_time_sans_frac()
+        _federation_entity = get_federation_entity(self)
+        _collector = _federation_entity.function.trust_chain_collector
+        _added = 0
+        for _cache_name in CACHES:
+            _cache = getattr(_collector, _cache_name)
+            _stored = ESCache().load(_info.get(_cache_name, {}))
+            for key in _stored.keys():
+                _record = _stored.backend.get(key)
+                if _record["exp"] is not None and _now >= _record["exp"]:
+                    continue
+                if key in _cache:
+                    continue
+                _cache.set(key, _record["value"], exp=_record["exp"],
+                           http_info=_record.get("http"))
+                _added += 1
+
+        for entity_id, trust_chains in _info.get("trust_chain", {}).items():
+            if entity_id in _federation_entity.trust_chain:
+                continue
+            _live = [TrustChain().load(_chain) for _chain in trust_chains]
+            _live = [_chain for _chain in _live if not _chain.exp or _chain.exp > _now]
+            if _live:
+                _federation_entity.store_trust_chain(entity_id, _live)
+                _added += 1
+
+        logger.info(f"Loaded {_added} items from the snapshot in {path}")
+        return _added
+
+    def _run(self):
+        try:
+            self.restore()
+        except Exception as err:
+            logger.exception(f"Could not load the snapshot: {err}")
+
+        if not self.interval:
+            return
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as err:
+                logger.exception(f"Could not write the snapshot: {err}")
+
+    def _at_exit(self):
+        self.stop()
+        try:
+            self.save()
+        except Exception as err:
+            logger.exception(f"Could not write the snapshot: {err}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache_snapshot", daemon=True)
+        self._thread.start()
+        atexit.register(self._at_exit)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        atexit.unregister(self._at_exit)
@@ -1,14 +1,16 @@
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from ssl import SSLError
 from typing import Callable
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 
 from cryptojwt import JWT
 from cryptojwt import KeyJar
-from cryptojwt.jws.jws import factory
 from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.exception import MissingPage
 from idpyoidc.key_import import import_jwks
@@ -17,20 +19,23 @@ from requests.exceptions import ConnectionError
 
 from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import Function
+from fedservice.entity.function import unverified_entity_statement
 from fedservice.entity.function import verify_trust_chains
+from fedservice.entity.function.single_flight import SingleFlight
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.backend import make_backend
+from fedservice.entity_statement.cache import conditional_headers
 from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.cache import http_cache_info
+from fedservice.entity_statement.cache import NegativeCache
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.verification import verify_self_signed
 from fedservice.exception import FailedConfigurationRetrieval
 from fedservice.utils import statement_is_expired
 
 logger = logging.getLogger(__name__)
 
-
-def unverified_entity_statement(signed_jwt):
-    _jws = factory(signed_jwt)
-    if not _jws:
-        raise ValueError(f"Not a proper signed JWT: {signed_jwt}")
-    return _jws.jwt.payload()
+SIGNED_CONTENT_TYPES = ["application/entity-statement+jwt", "application/resolve-response+jwt"]
 
 
 def verify_self_signed_signature(statement):
@@ -42,14 +47,7 @@ def verify_self_signed_signature(statement):
     :return: Payload of the signed JWT
     """
 
-    payload = unverified_entity_statement(statement)
-    keyjar = KeyJar()
-    if payload['iss'] not in keyjar:
-        keyjar = import_jwks(keyjar, payload['jwks'], payload['iss'])
-
-    _jwt = JWT(key_jar=keyjar)
-    _val = _jwt.unpack(statement)
-    return _val
+    return verify_self_signed(statement)
 
 
 def get_endpoint(endpoint_type, config):
@@ -57,12 +55,68 @@ def get_endpoint(endpoint_type, config):
     return _fe.get(f"federation_{endpoint_type}_endpoint")
 
 
+def document_from_response(url: str, response) -> str:
+    """
+    Picks the signed statement out of a HTTP response.
+
+    :param url: The URL the request was sent to
+    :param response: A response with the attributes status_code, headers and text
+    :return: Signed EntityStatement
+    """
+    if response.status_code == 200:
+        _content_type = response.headers['Content-Type']
+        if not [_typ for _typ in SIGNED_CONTENT_TYPES if _typ in _content_type]:
+            logger.warning(f"Wrong Content-Type: {_content_type}")
+        return signed_token(response.text)
+    elif response.status_code == 404:
+        raise MissingPage(f"No such page: '{url}'")
+    else:
+        raise FailedConfigurationRetrieval()
+
+
 def cache_key(authority, entity):
     return f"{authority}!!{entity}"
 
 
-def time_key(authority, entity):
-    return f"{authority}!exp!{entity}"
+def per_cache(settings: dict, cache: str) -> dict:
+    """
+    A setting is either one value used for all caches or a dictionary with a value per cache.
+    """
+    res = {}
+    for key, val in settings.items():
+        if isinstance(val, dict):
+            res[key] = val.get(cache, 0)
+        else:
+            res[key] = val
+    return res
+
+
+class TreeMemo(object):
+    """
+    The sub-trees collected during one collection run, per authority.
+    When several authorities share a superior the sub-tree above that superior is only
+    collected once. A sub-tree where a loop was cut off depends on the path it was reached
+    through and is therefore not remembered.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tree = {}
+        self._partial = set()
+
+    def get(self, authority: str) -> Optional[dict]:
+        with self._lock:
+            return self._tree.get(authority)
+
+    def add(self, authority: str, tree: dict):
+        with self._lock:
+            if authority not in self._partial:
+                self._tree[authority] = tree
+
+    def loop_cut(self, path: List[str]):
+        # Every sub-tree along the path contains the cut
+        with self._lock:
+            self._partial.update(path)
 
 
 class TrustChainCollector(Function):
@@ -72,15 +126,61 @@ class TrustChainCollector(Function):
                  trust_anchors: dict,
                  allowed_delta: int = 300,
                  keyjar: Optional[KeyJar] = None,
+                 max_workers: Optional[int] = 0,
+                 single_flight: Optional[bool] = True,
+                 negative_cache: Optional[dict] = None,
+                 trusted_resolvers: Optional[Union[dict, list]] = None,
+                 stale_while_revalidate: Optional[Union[int, dict]] = 0,
+                 max_cache_entries: Optional[Union[int, dict]] = 0,
+                 max_cache_bytes: Optional[Union[int, dict]] = 0,
+                 cache_backend: Optional[dict] = None,
                  **kwargs
                  ):
         Function.__init__(self, upstream_get)
-        self.trust_anchors = trust_anchors
+        # A copy, the configuration may be shared by several entities
+        self.trust_anchors = dict(trust_anchors)
+        # Resolvers that are asked for a trust chain before collecting it hop by hop.
+        # Entity ID of the resolver -> {"anchor": ..., "endpoint": ...}
+        self.trusted_resolvers = {}
+        if isinstance(trusted_resolvers, list):
+            trusted_resolvers = {_id: {} for _id in trusted_resolvers}
+        for _id, _spec in (trusted_resolvers or {}).items():
+            _spec = dict(_spec or {})
+            # A trust anchor is by default asked about chains that ends with itself
+            _spec.setdefault("anchor", _id)
+            self.trusted_resolvers[_id] = _spec
         self.allowed_delta = allowed_delta
-        self.config_cache = ESCache(allowed_delta=allowed_delta)
-        self.entity_statement_cache = ESCache(allowed_delta=allowed_delta)
-        # should not have a Key Jar of its own
-        if keyjar:
+        # Stale-while-revalidate grace window and cache bounds, for both caches or per cache
+        _settings = {"grace": stale_while_revalidate, "max_entries": max_cache_entries,
+                     "max_bytes": max_cache_bytes}
+        # Where the cached statements are kept, e.g. in a database shared by several processes
+        self.config_cache = ESCache(
+            allowed_delta=allowed_delta, backend=make_backend(cache_backend, "config_cache"),
+            **per_cache(_settings, "config_cache"))
+        self.entity_statement_cache = ESCache(
+            allowed_delta=allowed_delta,
+            backend=make_backend(cache_backend, "entity_statement_cache"),
+            **per_cache(_settings, "entity_statement_cache"))
+        # Where stale statements are refreshed, created when the first refresh is needed
+        self._background = None
+        self.config_cache.set_refresher(self.refresh_entity_configuration, self._get_background)
+        self.entity_statement_cache.set_refresher(self._refresh_cached_statement,
+                                                  self._get_background)
+        # The number of threads used to collect sibling branches concurrently.
+        # 0 means that the tree is collected serially.
+        self.max_workers = max_workers
+        self._executor = None
+        self._branch_slots = None
+        self._executor_lock = threading.Lock()
+        # Concurrent requests for the same URL share one HTTP request
+        if single_flight:
+            self.in_flight = SingleFlight()
+        else:
+            self.in_flight = None
+        # URLs that recently could not be fetched
+        self.negative_cache = NegativeCache(**(negative_cache or {}))
+        # should not have a Key Jar of its own. An empty KeyJar is falsy.
+        if keyjar is not None:
             self.keyjar = keyjar
         else:
             self.keyjar = None
@@ -88,6 +188,42 @@ class TrustChainCollector(Function):
         for id, keys in trust_anchors.items():
             keyjar = import_jwks(keyjar, keys, id)
 
+    def _get_executor(self) -> Optional[ThreadPoolExecutor]:
+        if not self.max_workers:
+            return None
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="trust_chain_collector")
+                self._branch_slots = threading.BoundedSemaphore(self.max_workers)
+        return self._executor
+
+    def _get_background(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(max_workers=2,
+                                                      thread_name_prefix="cache_refresh")
+        return self._background
+
+    def close(self, wait: Optional[bool] = True):
+        """
+        Shut down the threads used for collecting branches and refreshing cached statements.
+        They are created anew if needed after this.
+        """
+        with self._executor_lock:
+            _executors = [self._executor, self._background]
+            self._executor = self._background = self._branch_slots = None
+        for _executor in _executors:
+            if _executor is not None:
+                _executor.shutdown(wait=wait)
+
+    def _run_in_slot(self, func: Callable, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._branch_slots.release()
+
     def _get_service(self, service):
         federation_entity = get_federation_entity(self)
         return federation_entity.client.get_service(service)
@@ -96,9 +232,45 @@ class TrustChainCollector(Function):
         """
 
         :param url: Target URL
-        :param httpc_args: Arguments for the HTTP call.
         :return: Signed EntityStatement
         """
+        _document, _ = self.fetch_document(url)
+        return _document
+
+    def fetch_document(self, url: str,
+                       validators: Optional[dict] = None) -> Tuple[Optional[str], Optional[dict]]:
+        """
+        Fetch a document and the HTTP caching information that came with it.
+
+        :param url: Target URL
+        :param validators: HTTP caching information from an earlier response. If it contains
+            an ETag or a Last-Modified value a conditional request is sent.
+        :return: Tuple of signed EntityStatement and HTTP caching information. The signed
+            EntityStatement is None if the server answered 304 Not Modified.
+        """
+        if self.in_flight:
+            _key = url
+            _headers = conditional_headers(validators)
+            if _headers:
+                _key = f"{url}#{_headers.get('If-None-Match', '')}#" \
+                       f"{_headers.get('If-Modified-Since', '')}"
+            return self.in_flight.do(_key, self._get_document, url, validators)
+        else:
+            return self._get_document(url, validators)
+
+    def _get_document(self, url: str, validators: Optional[dict] = None):
+        self.negative_cache.check(url)
+
+        try:
+            _res = self._fetch_document(url, validators)
+        except (MissingPage, FailedConfigurationRetrieval, ConnectionError) as err:
+            self.negative_cache.add(url, err)
+            raise
+
+        self.negative_cache.remove(url)
+        return _res
+
+    def _fetch_document(self, url: str, validators: Optional[dict] = None):
         _keyjar = self.upstream_get('attribute', 'keyjar')
 
         _httpc_params = _keyjar.httpc_params
@@ -108,6 +280,12 @@ class TrustChainCollector(Function):
             _httpc_params = federation_entity.httpc_params
             logger.debug(f"federation_entity.httpc_params: {_httpc_params}")
 
+        _headers = conditional_headers(validators)
+        if _headers:
+            _httpc_params = _httpc_params.copy()
+            _headers.update(_httpc_params.get("headers", {}))
+            _httpc_params["headers"] = _headers
+
         logger.debug(f"Using HTTPC Params: {_httpc_params}")
         try:
             response = self.upstream_get('attribute', 'httpc')("GET", url, **_httpc_params)
@@ -115,21 +293,49 @@ class TrustChainCollector(Function):
             logger.error(f'Could not connect to {url}:{err}')
             raise
 
-        if response.status_code == 200:
-            if 'application/entity-statement+jwt' not in response.headers['Content-Type']:
-                logger.warning(f"Wrong Content-Type: {response.headers['Content-Type']}")
-            return response.text
-        elif response.status_code == 404:
-            raise MissingPage(f"No such page: '{url}'")
-        else:
-            raise FailedConfigurationRetrieval()
+        if response.status_code == 304 and _headers:
+            logger.debug(f"Not modified: {url}")
+            return None, http_cache_info(url, response)
 
-    def get_entity_configuration(self, entity_id):
+        return document_from_response(url, response), http_cache_info(url, response)
+
+    def _revalidate(self, cache: ESCache, key: str, exp: int) -> Optional[Tuple[str, bool]]:
+        """
+        Use a conditional request to find out whether a cached statement is still current.
+
+        :param cache: The cache the statement is kept in
+        :param key: The cache key
+        :param exp: When the cached statement expires
+        :return: None if revalidation was not possible otherwise a tuple of the signed statement
+            to use and a boolean that is True if it is a new statement.
+        """
+        if not cache.revalidatable(key, exp):
+            return None
+
+        _info = cache.get_http_info(key)
+        try:
+            _document, _new_info = self.fetch_document(_info["url"], validators=_info)
+        except Exception as err:
+            logger.debug(f"Revalidation of {_info['url']} failed: {err}")
+            return None
+
+        if _document is None:
+            cache.not_modified(key, _new_info)
+            _cached = cache.get(key)
+            if isinstance(_cached, dict):
+                return _cached["_jws"], False
+            return _cached, False
+
+        cache.set_http_info(key, _new_info)
+        return _document, True
+
+    def get_entity_configuration(self, entity_id, http_info: Optional[dict] = None):
         """
         Get configuration information about an entity from itself.
         The configuration information is in the format of an Entity Statement
 
         :param entity_id: About whom the entity statement should be
+        :param http_info: If given it's updated with the HTTP caching information in the response
         :return: Configuration information as a signed JWT
         """
         logger.debug(f"--get_configuration_information({entity_id})")
@@ -141,7 +347,7 @@ class TrustChainCollector(Function):
             #     logger.debug("Use SelfSignedCert support")
             #     self_signed_config = self.do_ssc_seq(_url, entity_id)
             # else:
-            self_signed_config = self.get_document(_res['url'])
+            self_signed_config, _info = self.fetch_document(_res['url'])
         except MissingPage:  # if tenant involved
             _tres = _serv.get_request_parameters(request_args={"entity_id": entity_id}, tenant=True)
             logger.debug(f"Get configuration from (tenant): '{entity_id}'")
@@ -149,7 +355,7 @@ class TrustChainCollector(Function):
                 # if self.use_ssc:
                 #     self_signed_config = self.do_ssc_seq(_tenant_url, entity_id)
                 # else:
-                self_signed_config = self.get_document(_tres["url"])
+                self_signed_config, _info = self.fetch_document(_tres["url"])
                 logger.debug(f'Self signed statement: {self_signed_config}')
             else:
                 raise MissingPage(f"No such page: '{_tres['url']}'")
@@ -163,8 +369,30 @@ class TrustChainCollector(Function):
             logger.exception(err)
             raise
 
+        if http_info is not None and _info:
+            http_info.update(_info)
         return self_signed_config
 
+    def _revalidated_configuration(self, entity_id: str) -> Optional[dict]:
+        _cached = self.config_cache.get(entity_id)
+        if not isinstance(_cached, dict) or "_jws" not in _cached:
+            return None
+
+        _res = self._revalidate(self.config_cache, entity_id, _cached["exp"])
+        if _res is None:
+            return None
+
+        _signed_entity_config, _changed = _res
+        if not _changed:
+            logger.debug(f"Entity configuration for {entity_id} still current")
+            return _cached
+
+        _http_info = self.config_cache.get_http_info(entity_id)
+        entity_config = verify_self_signed_signature(_signed_entity_config)
+        entity_config["_jws"] = _signed_entity_config
+        self.config_cache.set(entity_id, entity_config, http_info=_http_info)
+        return entity_config
+
     def get_metadata(self, entity_id):
         _ec = None
         if entity_id in self.config_cache:
@@ -183,36 +411,70 @@ class TrustChainCollector(Function):
 
     def get_federation_fetch_endpoint(self, intermediate: str) -> str:
         logger.debug(f'--get_federation_fetch_endpoint({intermediate})')
+        return self.get_federation_endpoint(intermediate, "fetch")
+
+    def get_federation_endpoint(self, entity_id: str, endpoint_type: str) -> str:
+        """
+        Find a federation endpoint in the entity configuration of an entity.
+
+        :param entity_id: The entity ID
+        :param endpoint_type: The type of endpoint, e.g. fetch, resolve or list
+        :return: The endpoint URL or an empty string
+        """
         # In cache ??
-        _entity_config = self.config_cache[intermediate]
+        _entity_config = self.config_cache[entity_id]
+        if not _entity_config:
+            _entity_config = self._revalidated_configuration(entity_id)
         if _entity_config:
             logger.debug(f'Cached info: {_entity_config}')
             # will return None if cached information is outdated
-            fed_fetch_endpoint = get_endpoint("fetch", _entity_config)
+            _endpoint = get_endpoint(endpoint_type, _entity_config)
         else:
-            fed_fetch_endpoint = None
+            _endpoint = None
 
-        if not fed_fetch_endpoint:
-            signed_entity_config = self.get_entity_configuration(intermediate)
-            if signed_entity_config is None:
+        if not _endpoint:
+            entity_config = self._fetch_entity_configuration(entity_id)
+            if entity_config is None:
                 return ''
+            _endpoint = get_endpoint(endpoint_type, entity_config)
+
+        return _endpoint
 
-            entity_config = verify_self_signed_signature(signed_entity_config)
-            logger.debug(f'Verified self signed statement: {entity_config}')
-            fed_fetch_endpoint = get_endpoint("fetch", entity_config)
-            # update cache
-            entity_config["_jws"] = signed_entity_config
-            self.config_cache[intermediate] = entity_config
+    def _fetch_entity_configuration(self, entity_id: str) -> Optional[dict]:
+        _http_info = {}
+        signed_entity_config = self.get_entity_configuration(entity_id, _http_info)
+        if not signed_entity_config:
+            return None
 
-        return fed_fetch_endpoint
+        entity_config = verify_self_signed_signature(signed_entity_config)
+        logger.debug(f'Verified self signed statement: {entity_config}')
+        entity_config["_jws"] = signed_entity_config
+        # update cache
+        self.config_cache.set(entity_id, entity_config, http_info=_http_info)
+        return entity_config
 
-    def get_entity_statement(self, fetch_endpoint, issuer, subject):
+    def refresh_entity_configuration(self, entity_id: str) -> Optional[dict]:
+        """
+        Get a new copy of an entity configuration, whether the cached one is still usable or not.
+        A conditional request is used if possible.
+
+        :param entity_id: The entity ID
+        :return: The verified entity configuration
+        """
+        entity_config = self._revalidated_configuration(entity_id)
+        if entity_config is None:
+            entity_config = self._fetch_entity_configuration(entity_id)
+        return entity_config
+
+    def get_entity_statement(self, fetch_endpoint, issuer, subject,
+                             http_info: Optional[dict] = None):
         """
         Get Entity Statement by one entity about another or about itself
 
         :param fetch_endpoint: The federation fetch endpoint
         :param issuer: Who should issue the entity statement
         :param subject: About whom the entity statement should be
+        :param http_info: If given it's updated with the HTTP caching information in the response
         :return: A signed JWT
         """
         _serv = self._get_service('entity_statement')
@@ -222,14 +484,18 @@ class TrustChainCollector(Function):
         # if self.use_ssc:
         #     signed_entity_statement = self.do_ssc_seq(_url, issuer)
         # else:
-        return self.get_document(_res['url'])
+        _document, _info = self.fetch_document(_res['url'])
+        if http_info is not None and _info:
+            http_info.update(_info)
+        return _document
 
     def collect_tree(self,
                      entity_id: str,
                      entity_configuration: Union[dict, Message],
                      seen: Optional[list] = None,
                      max_superiors: Optional[int] = 1,
-                     stop_at: Optional[str] = "") -> Optional[dict]:
+                     stop_at: Optional[str] = "",
+                     memo: Optional[TreeMemo] = None) -> Optional[dict]:
         """
         Collect superiors one level at the time
 
@@ -239,11 +505,14 @@ class TrustChainCollector(Function):
             loops. Also used to control the allowed depth.
         :param max_superiors: The maximum number of superiors.
         :param stop_at: The ID of the trust anchor at which the trust chain should stop.
+        :param memo: Sub-trees already collected during this run.
         :return: Dictionary of superiors
         """
         superior = {}
         if seen is None:
             seen = []
+        if memo is None:
+            memo = TreeMemo()
 
         logger.debug(f'Collect superiors to: {entity_id}')
         logger.debug(f'Collect based on: {entity_configuration}')
@@ -254,51 +523,155 @@ class TrustChainCollector(Function):
             logger.debug("Reached trust anchor")
             return superior
 
+        _authorities = []
         for authority in entity_configuration['authority_hints']:
-            if authority in seen:  # loop ?!
-                logger.warning(f"Loop detected at {authority}")
-            superior[authority] = self.collect_branch(entity_id, authority, seen,
-                                                      max_superiors, stop_at=stop_at)
+            if authority in seen or authority == entity_id:  # loop ?!
+                logger.warning(f"Loop detected at {authority}, not following it")
+                memo.loop_cut(seen)
+            elif authority not in _authorities:
+                _authorities.append(authority)
+
+        _executor = self._get_executor()
+        if _executor is None or len(_authorities) < 2:
+            for authority in _authorities:
+                superior[authority] = self.collect_branch(entity_id, authority, seen,
+                                                          max_superiors, stop_at=stop_at,
+                                                          memo=memo)
+            return superior
+
+        # Hand sibling branches over to the worker threads as long as there are free ones.
+        # A branch that can't get a worker is collected by this thread. That way a thread
+        # never waits for work that is queued behind itself.
+        _pending = {}
+        for authority in _authorities[1:]:
+            if self._branch_slots.acquire(blocking=False):
+                _pending[authority] = _executor.submit(self._run_in_slot, self.collect_branch,
+                                                       entity_id, authority, seen,
+                                                       max_superiors, stop_at=stop_at,
+                                                       memo=memo)
+
+        _branch = {}
+        for authority in _authorities:
+            if authority not in _pending:
+                _branch[authority] = self.collect_branch(entity_id, authority, seen,
+                                                         max_superiors, stop_at=stop_at,
+                                                         memo=memo)
+
+        # Build the result in authority_hints order so the tree looks exactly like
+        # the one collected serially.
+        for authority in _authorities:
+            if authority in _pending:
+                superior[authority] = _pending[authority].result()
+            else:
+                superior[authority] = _branch[authority]
 
         return superior
 
-    def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
-        # Try to get the entity statement from the cache
+    def _cached_entity_statement(self, entity: str, authority: str,
+                                 revalidate: Optional[bool] = True) -> Optional[str]:
         _cache_key = cache_key(authority, entity)
+        # Only returns the statement if it's not too old
         entity_statement = self.entity_statement_cache[_cache_key]
 
         if entity_statement is not None:
             logger.debug("Have cached statement")
-            # Verify that the cached statement is not too old
-            _now = utc_time_sans_frac()
-            _time_key = time_key(authority, entity)
-            _exp = self.entity_statement_cache[_time_key]
-            if _now > (_exp - self.allowed_delta):
+            # Statements kept outside the process come back as plain strings
+            return signed_token(entity_statement)
+
+        # A statement that can be revalidated is kept in the cache after it has become stale
+        _exp = self.entity_statement_cache.expires_at(_cache_key)
+        if _exp is not None and revalidate:
+            entity_statement = self._revalidated_entity_statement(entity, authority, _exp)
+            if entity_statement is None:
                 logger.debug("Cached entity statement timed out")
-                del self.entity_statement_cache[_cache_key]
-                del self.entity_statement_cache[_time_key]
-                entity_statement = None
+                # Another thread may have removed it already
+                self.entity_statement_cache.pop(_cache_key, None)
+
+        return entity_statement
+
+    def _revalidated_entity_statement(self, entity: str, authority: str,
+                                      exp: int) -> Optional[str]:
+        _cache_key = cache_key(authority, entity)
+        _res = self._revalidate(self.entity_statement_cache, _cache_key, exp)
+        if _res is None:
+            return None
+
+        entity_statement, _changed = _res
+        if _changed:
+            _http_info = self.entity_statement_cache.get_http_info(_cache_key)
+            self._store_entity_statement(entity, authority, entity_statement, _http_info)
+        return signed_token(entity_statement)
+
+    def _get_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        # Try to get the entity statement from the cache
+        entity_statement = self._cached_entity_statement(entity, authority)
 
         if entity_statement is None:
             logger.debug(f"Have not seen '{authority}' before")
-            # The entity configuration for authority is collected at this point
-            # It's stored in config_cache
-            fed_fetch_endpoint = self.get_federation_fetch_endpoint(authority)
-            if not fed_fetch_endpoint:
-                return None
-            logger.debug(f"Federation fetch endpoint: '{fed_fetch_endpoint}' for '{authority}'")
-            entity_statement = self.get_entity_statement(fed_fetch_endpoint, authority, entity)
-            # entity_statement is a signed JWT
-            statement = unverified_entity_statement(entity_statement)
-            logger.debug(
-                f"Unverified entity statement from {fed_fetch_endpoint} about {entity}: "
-                f"{statement}")
-            self.entity_statement_cache[_cache_key] = entity_statement
-            self.entity_statement_cache[time_key(authority, entity)] = statement["exp"]
+            entity_statement = self._fetch_entity_statement(entity, authority)
+
+        return entity_statement
 
+    def _fetch_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        # The entity configuration for authority is collected at this point
+        # It's stored in config_cache
+        fed_fetch_endpoint = self.get_federation_fetch_endpoint(authority)
+        if not fed_fetch_endpoint:
+            return None
+        logger.debug(f"Federation fetch endpoint: '{fed_fetch_endpoint}' for '{authority}'")
+        _http_info = {}
+        entity_statement = self.get_entity_statement(fed_fetch_endpoint, authority, entity,
+                                                      _http_info)
+        # entity_statement is a signed JWT
+        self._store_entity_statement(entity, authority, entity_statement, _http_info)
         return entity_statement
 
-    def collect_branch(self, entity, authority, seen=None, max_superiors=10, stop_at=""):
+    def _refresh_cached_statement(self, key: str) -> Optional[str]:
+        authority, entity = key.split("!!", 1)
+        return self.refresh_entity_statement(entity, authority)
+
+    def sweep(self) -> dict:
+        """
+        Remove expired statements from the caches.
+
+        :return: The keys of the removed statements per cache
+        """
+        return {
+            "config_cache": self.config_cache.sweep(),
+            "entity_statement_cache": self.entity_statement_cache.sweep()
+        }
+
+    @property
+    def stale_served(self) -> int:
+        """The number of times a stale statement was used while it was refreshed."""
+        return self.config_cache.stale_served + self.entity_statement_cache.stale_served
+
+    def refresh_entity_statement(self, entity: str, authority: str) -> Optional[str]:
+        """
+        Get a new copy of a subordinate statement, whether the cached one is still usable or not.
+        A conditional request is used if possible.
+
+        :param entity: The subject of the statement
+        :param authority: The issuer of the statement
+        :return: The signed statement
+        """
+        _exp = self.entity_statement_cache.expires_at(cache_key(authority, entity))
+        if _exp:
+            entity_statement = self._revalidated_entity_statement(entity, authority, _exp)
+            if entity_statement:
+                return entity_statement
+        return self._fetch_entity_statement(entity, authority)
+
+    def _store_entity_statement(self, entity: str, authority: str, entity_statement: str,
+                                http_info: Optional[dict] = None):
+        entity_statement = signed_token(entity_statement)
+        statement = entity_statement.payload
+        logger.debug(f"Unverified entity statement from {authority} about {entity}: {statement}")
+        self.entity_statement_cache.set(cache_key(authority, entity), entity_statement,
+                                        exp=statement["exp"], http_info=http_info)
+
+    def collect_branch(self, entity, authority, seen=None, max_superiors=10, stop_at="",
+                       memo=None):
         """
         Collect an entity statement about an entity submitted by another entity, the authority.
         This consist of first finding the fed_fetch_endpoint URL for the authority and then
@@ -310,6 +683,7 @@ class TrustChainCollector(Function):
         :param seen: A list of authorities that this process has seen. This to capture
             loops. Also used to control the allowed depth.
         :param max_superiors: The maximum number of superiors allowed.
+        :param memo: Sub-trees already collected during this run.
         :return:
         """
 
@@ -331,15 +705,73 @@ class TrustChainCollector(Function):
         entity_statement = self._get_entity_statement(entity, authority)
 
         if entity_statement:
-            _entity_configuration = self.config_cache[authority]
-            return entity_statement, self.collect_tree(authority,
-                                                       _entity_configuration,
-                                                       stop_at=stop_at,
-                                                       seen=_seen,
-                                                       max_superiors=max_superiors)
+            if memo is None:
+                memo = TreeMemo()
+            _tree = memo.get(authority)
+            if _tree is None:
+                _entity_configuration = self.config_cache[authority]
+                _tree = self.collect_tree(authority,
+                                          _entity_configuration,
+                                          stop_at=stop_at,
+                                          seen=_seen,
+                                          max_superiors=max_superiors,
+                                          memo=memo)
+                memo.add(authority, _tree)
+            else:
+                logger.debug(f"Already collected the superiors of {authority}")
+            return entity_statement, _tree
         else:
             return None
 
+    def resolve(self, entity_id: str, resolver: str) -> Optional[List[str]]:
+        """
+        Ask a trusted resolver for a trust chain for an entity.
+        The response must be signed with a key the keyjar has for the resolver. The trust chain
+        in the response is not trusted on its own, it is verified like any collected chain.
+
+        :param entity_id: The entity ID of the entity the trust chain should be for
+        :param resolver: The entity ID of the resolver
+        :return: The statements of the trust chain ordered from the trust anchor down to the
+            entity configuration of the entity. None if the resolver could not be used.
+        """
+        _spec = self.trusted_resolvers[resolver]
+        try:
+            _endpoint = _spec.get("endpoint") or self.get_federation_endpoint(resolver, "resolve")
+            if not _endpoint:
+                logger.debug(f"{resolver} has no resolve endpoint")
+                return None
+
+            _serv = self._get_service('resolve')
+            _res = _serv.get_request_parameters(
+                request_args={"sub": entity_id, "anchor": _spec["anchor"]}, endpoint=_endpoint)
+            _response = self.get_document(_res['url'])
+
+            _keyjar = self.keyjar
+            if _keyjar is None:
+                _keyjar = self.upstream_get('attribute', 'keyjar')
+            _payload = JWT(key_jar=_keyjar).unpack(_response)
+        except Exception as err:
+            logger.warning(f"Resolving {entity_id} using {resolver} failed: {err}")
+            return None
+
+        if _payload.get("iss") != resolver or _payload.get("sub") != entity_id:
+            logger.warning(f"Resolve response from {resolver} not about {entity_id}")
+            return None
+
+        _chain = _payload.get("trust_chain")
+        if not _chain:
+            logger.debug(f"No trust chain in the resolve response from {resolver}")
+            return None
+
+        _chain = list(_chain)
+        # The trust anchor's entity configuration may be at the end.
+        if len(_chain) > 1:
+            _top = unverified_entity_statement(_chain[-1])
+            if _top["iss"] == _top["sub"]:
+                _chain = _chain[:-1]
+        _chain.reverse()
+        return _chain
+
     def too_old(self, statement):
         now = time.time()
         if now >= statement["exp"] + self.allowed_delta:
@@ -362,21 +794,17 @@ class TrustChainCollector(Function):
 
         if not signed_entity_config:
             # get leaf Entity Configuration
-            signed_entity_config = self.get_entity_configuration(entity_id)
-            if not signed_entity_config:
+            entity_config = self._fetch_entity_configuration(entity_id)
+            if not entity_config:
                 logger.warning(f"Could not find any entity configuration for {entity_id}")
                 return None
-            entity_config = verify_self_signed_signature(signed_entity_config)
-            logger.debug(f'Verified self signed statement: {entity_config}')
-            entity_config['_jws'] = signed_entity_config
-            # update cache
-            self.config_cache[entity_id] = entity_config
+            signed_entity_config = entity_config['_jws']
 
         return self.collect_tree(entity_id, entity_config, seen=seen, max_superiors=max_superiors,
                                  stop_at=stop_at), signed_entity_config
 
     def add_trust_anchor(self, entity_id, jwks):
-        if self.keyjar:
+        if self.keyjar is not None:
             _keyjar = self.keyjar
         elif self.upstream_get:
             _keyjar = self.upstream_get('attribute', 'keyjar')
@@ -3,7 +3,6 @@ from typing import Callable
 from typing import Optional
 
 from cryptojwt import KeyJar
-from cryptojwt.jws.jws import factory
 from idpyoidc.key_import import import_jwks
 
 from fedservice import message
@@ -12,6 +11,8 @@ from fedservice.entity.function import Function
 from fedservice.entity.function import get_payload
 from fedservice.entity.function import get_verified_trust_chains
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.verification import verify_signature
 from fedservice.utils import statement_is_expired
 
 logger = logging.getLogger(__name__)
@@ -36,6 +37,7 @@ class TrustMarkVerifier(Function):
         :returns: TrustClaim message instance if OK otherwise None
         """
 
+        trust_mark = signed_token(trust_mark)
         payload = get_payload(trust_mark)
         _trust_mark = message.TrustMark(**payload)
         # Verify that everything that should be there, are there
@@ -67,19 +69,22 @@ class TrustMarkVerifier(Function):
         # Now try to verify the signature on the trust_mark
         # should have the necessary keys
         _federation_entity = get_federation_entity(self)
-        _jwt = factory(trust_mark)
+        _jwt = trust_mark.jws
         keyjar = _federation_entity.get_attribute('keyjar')
 
         keys = keyjar.get_jwt_verify_keys(_jwt.jwt)
         if not keys:
             _trust_chains = apply_policies(_federation_entity, _trust_chains)
-            keyjar = import_jwks(keyjar,
-                                 _trust_chains[0].verified_chain[-1]["jwks"],
-                                 _trust_chains[0].iss_path[0])
+            _issuer = _trust_chains[0].iss_path[0]
+            _introduced = _issuer not in keyjar
+            keyjar = import_jwks(keyjar, _trust_chains[0].verified_chain[-1]["jwks"], _issuer)
+            _key_store = _federation_entity.get_attribute('key_store')
+            if _key_store:
+                _key_store.learned(keyjar, _issuer, _trust_chains[0].exp, _introduced)
             keys = keyjar.get_jwt_verify_keys(_jwt.jwt)
 
         try:
-            _mark = _jwt.verify_compact(trust_mark, keys=keys)
+            _mark = verify_signature(trust_mark, keys)
         except Exception as err:
             return None
         else:
@@ -96,9 +101,9 @@ class TrustMarkVerifier(Function):
         if trust_mark['id'] not in ta_fe_metadata['trust_mark_owners']:
             return None
 
-        _delegation = factory(trust_mark['delegation'])
+        _delegation = signed_token(trust_mark['delegation'])
         tm_owner_info = ta_fe_metadata['trust_mark_owners'][trust_mark['id']]
         _key_jar = KeyJar()
         _key_jar = import_jwks(_key_jar, tm_owner_info['jwks'], tm_owner_info['sub'])
-        keys = _key_jar.get_jwt_verify_keys(_delegation.jwt)
-        return _delegation.verify_compact(keys=keys)
+        keys = _key_jar.get_jwt_verify_keys(_delegation.jws.jwt)
+        return verify_signature(_delegation, keys)
@@ -1,28 +1,101 @@
 import logging
+import threading
 from typing import Callable
 from typing import List
+from typing import Optional
 
 from cryptojwt import KeyBundle
 from cryptojwt.exception import MissingKey
-from cryptojwt.jws.jws import factory
 
 from fedservice.entity.function import Function
 from fedservice.entity.utils import get_federation_entity
+from fedservice.entity_statement.constraints import apply_constraints
+from fedservice.entity_statement.constraints import initial_restrictions
+from fedservice.entity_statement.constraints import leaf_meets_restrictions
 from fedservice.entity_statement.constraints import meets_restrictions
+from fedservice.entity_statement.key_store import LearnedKeyStore
+from fedservice.entity_statement.signed_token import signed_token
 from fedservice.entity_statement.statement import TrustChain
+from fedservice.entity_statement.verification import verify_signature
 from fedservice.exception import UnknownTrustAnchor
 
 logger = logging.getLogger(__name__)
 
 
+def add_subject_keys(keyjar, statement: dict, key_store: Optional[LearnedKeyStore] = None):
+    """
+    Adds the keys of the subject of a verified entity statement to the federation key jar.
+
+    :param keyjar: The federation key jar
+    :param statement: A verified entity statement
+    :param key_store: If given it's told about the keys
+    """
+    if 'jwks' not in statement:
+        return
+
+    _introduced = statement['sub'] not in keyjar
+    _kb = KeyBundle(keys=statement['jwks']['keys'])
+    try:
+        old = keyjar.get_issuer_keys(statement['sub'])
+    except KeyError:
+        keyjar.add_kb(statement['sub'], _kb)
+    else:
+        new = [k for k in _kb if k not in old]
+        if new:
+            _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in new]
+            logger.debug(
+                "New keys added to the federation key jar for '{}': {}".format(
+                    statement['sub'], _key_spec)
+            )
+            # Only add keys to the KeyJar if they are not already there.
+            _kb.set(new)
+            keyjar.add_kb(statement['sub'], _kb)
+
+    if key_store:
+        key_store.learned(keyjar, statement['sub'], statement.get('exp'), _introduced)
+
+
+class _TrustChainNode(object):
+    """An entity statement in the tree built from a set of trust chains."""
+
+    def __init__(self):
+        self.children = {}
+        self.verified = False
+        self.trusted = None
+        self.payload = None
+        self._restrictions = None
+        self._applied = False
+
+    def child(self, entity_statement: str) -> "_TrustChainNode":
+        try:
+            return self.children[entity_statement]
+        except KeyError:
+            _node = self.children[entity_statement] = _TrustChainNode()
+            return _node
+
+    def restrictions_after(self, restrictions: Optional[dict]) -> Optional[dict]:
+        """
+        The restrictions that apply to the statements after this one. Since all chains through
+        this statement have the same statements before it, they are only worked out once.
+
+        :param restrictions: The restrictions before this statement
+        """
+        if not self._applied:
+            if restrictions is not None:
+                self._restrictions = apply_constraints(self.payload, restrictions)
+            self._applied = True
+        return self._restrictions
+
+
 class TrustChainVerifier(Function):
 
     def __init__(self, upstream_get: Callable):
         Function.__init__(self, upstream_get)
+        # Chains may be verified in several threads at the same time
+        self._lock = threading.Lock()
 
     def trusted_anchor(self, entity_statement):
-        _jwt = factory(entity_statement)
-        payload = _jwt.jwt.payload()
+        payload = signed_token(entity_statement).payload
         _federation_entity = get_federation_entity(self)
         if _federation_entity:
             if payload['iss'] not in _federation_entity.keyjar:
@@ -40,6 +113,39 @@ class TrustChainVerifier(Function):
 
         return True
 
+    def verify_statement(self, entity_statement, keyjar):
+        """
+        Verifies the signature of one entity statement and adds the keys of the subject to
+        the key jar.
+
+        :param entity_statement: A signed entity statement
+        :param keyjar: The federation key jar. Must contain the issuer's keys.
+        :return: The verified payload or None if the statement is not a signed JWT
+        """
+        entity_statement = signed_token(entity_statement)
+        _jwt = entity_statement.jws
+        if not _jwt:
+            return None
+
+        logger.debug(f"JWS header: {entity_statement.header}", )
+        logger.debug(f"JWS payload: {entity_statement.payload}")
+        keys = keyjar.get_jwt_verify_keys(_jwt.jwt)
+        if keys == []:
+            logger.error(f'No keys matching: {_jwt.jwt.headers}')
+            logger.debug(f"keyjar contains: {keyjar}")
+            raise MissingKey(f'No keys matching: {_jwt.jwt.headers}')
+
+        _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in keys]
+        logger.debug("Possible verification keys: %s", _key_spec)
+        res = verify_signature(entity_statement, keys)
+        logger.debug("Verified entity statement: %s", res)
+        _key_store = self.upstream_get("attribute", "key_store")
+        if _key_store:
+            _key_store.used(res['iss'])
+        with self._lock:
+            add_subject_keys(keyjar, res, _key_store)
+        return res
+
     def verify_trust_chain(self, entity_statement_list):
         """
         Verifies the trust chain. Works its way down from the Trust Anchor to the leaf.
@@ -58,50 +164,69 @@ class TrustChainVerifier(Function):
         n = len(entity_statement_list) - 1
         _keyjar = self.upstream_get("attribute", "keyjar")
         for entity_statement in entity_statement_list:
-            _jwt = factory(entity_statement)
-            if _jwt:
-                logger.debug(f"JWS header: {_jwt.jwt.headers}", )
-                logger.debug(f"JWS payload: {_jwt.jwt.payload()}")
-                keys = _keyjar.get_jwt_verify_keys(_jwt.jwt)
-                if keys == []:
-                    logger.error(f'No keys matching: {_jwt.jwt.headers}')
-                    logger.debug(f"keyjar contains: {_keyjar}")
-                    raise MissingKey(f'No keys matching: {_jwt.jwt.headers}')
-
-                _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in keys]
-                logger.debug("Possible verification keys: %s", _key_spec)
-                res = _jwt.verify_compact(keys=keys)
-                logger.debug("Verified entity statement: %s", res)
-                try:
-                    _jwks = res['jwks']
-                except KeyError:
-                    if len(ves) != n:
-                        raise ValueError('Missing signing JWKS')
-                else:
-                    _kb = KeyBundle(keys=_jwks['keys'])
-                    try:
-                        old = _keyjar.get_issuer_keys(res['sub'])
-                    except KeyError:
-                        _keyjar.add_kb(res['sub'], _kb)
-                    else:
-                        new = [k for k in _kb if k not in old]
-                        if new:
-                            _key_spec = [f'{k.kty}:{k.use}:{k.kid}' for k in new]
-                            logger.debug(
-                                "New keys added to the federation key jar for '{}': {}".format(
-                                    res['sub'], _key_spec)
-                            )
-                            # Only add keys to the KeyJar if they are not already there.
-                            _kb.set(new)
-                            _keyjar.add_kb(res['sub'], _kb)
-
-                ves.append(res)
+            res = self.verify_statement(entity_statement, _keyjar)
+            if res is None:
+                continue
+            if 'jwks' not in res and len(ves) != n:
+                raise ValueError('Missing signing JWKS')
+            ves.append(res)
 
         if ves and meets_restrictions(ves):
             return ves
         else:
             return []
 
+    def verify_trust_chains(self, chains: List[List[str]]) -> List[Optional[TrustChain]]:
+        """
+        Verifies a set of trust chains. Chains often start the same way, with the statements
+        issued by the trust anchor and the intermediates. The chains are therefore arranged as a
+        tree rooted in the trust anchor's statements and every statement in the tree is verified
+        once. The result is the same as calling this instance with one chain at a time.
+
+        :param chains: Chains of entity statements. Each ordered like the argument to
+            :py:meth:`__call__`.
+        :return: A TrustChain instance or None for each chain, in the same order as the chains
+        """
+        logger.debug("verify_trust_chains")
+        _keyjar = self.upstream_get("attribute", "keyjar")
+        _root = _TrustChainNode()
+        res = []
+        for chain in chains:
+            node = _root.child(chain[0])
+            if node.trusted is None:
+                node.trusted = self.trusted_anchor(chain[0])
+            if not node.trusted:
+                # Trust chain ending in a trust anchor I don't know.
+                logger.debug("Unknown trust anchor")
+                res.append(None)
+                continue
+
+            n = len(chain) - 1
+            ves = []
+            node = _root
+            previous = None
+            restrictions = initial_restrictions()
+            for entity_statement in chain:
+                node = node.child(entity_statement)
+                if not node.verified:
+                    node.payload = self.verify_statement(entity_statement, _keyjar)
+                    node.verified = True
+                if node.payload is None:
+                    continue
+                if 'jwks' not in node.payload and len(ves) != n:
+                    raise ValueError('Missing signing JWKS')
+                if previous is not None:
+                    restrictions = previous.restrictions_after(restrictions)
+                ves.append(dict(node.payload))
+                previous = node
+
+            if ves and restrictions is not None and leaf_meets_restrictions(ves[-1],
+                                                                            restrictions):
+                res.append(self.trust_chain(chain, ves))
+            else:
+                res.append(None)
+        return res
+
     def trust_chain_expires_at(self, trust_chain):
         exp = -1
         for entity_statement in trust_chain:
@@ -125,6 +250,9 @@ class TrustChainVerifier(Function):
         if not verified_trust_chain:
             return None
 
+        return self.trust_chain(chain, verified_trust_chain)
+
+    def trust_chain(self, chain: List[str], verified_trust_chain: List[dict]) -> TrustChain:
         _expires_at = self.trust_chain_expires_at(verified_trust_chain)
 
         trust_chain = TrustChain(exp=_expires_at, verified_chain=verified_trust_chain)
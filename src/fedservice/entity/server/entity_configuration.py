@@ -6,6 +6,8 @@ from idpyoidc.message import Message
 
 from fedservice.entity.utils import get_federation_entity
 from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.statement_cache import fingerprint
+from fedservice.entity_statement.statement_cache import SignedStatementCache
 from idpyoidc.message import oauth2
 from idpyoidc.server import Endpoint
 
@@ -25,35 +27,59 @@ class EntityConfiguration(Endpoint):
     provider_info_attributes = None
     auth_method_attribute = ""
 
-    def __init__(self, upstream_get, **kwargs):
+    def __init__(self, upstream_get, statement_cache: Optional[Union[bool, dict]] = True,
+                 **kwargs):
+        """
+        :param statement_cache: Whether the signed Entity Configuration should be cached, or the
+            arguments to the SignedStatementCache.
+        """
         Endpoint.__init__(self, upstream_get=upstream_get, **kwargs)
+        if isinstance(statement_cache, dict):
+            self.statement_cache = SignedStatementCache(**statement_cache)
+        elif statement_cache:
+            self.statement_cache = SignedStatementCache()
+        else:
+            self.statement_cache = None
 
-    def process_request(self, request=None, **kwargs):
+    def entity_configuration(self) -> str:
+        """
+        The signed Entity Configuration. It's only signed again if the metadata, trust marks,
+        authority hints or signing keys have changed or if the one in use is about to expire.
+        """
         _server = self.upstream_get("unit")
         _fed_entity = get_federation_entity(self)
         _entity_id = _fed_entity.get_attribute('entity_id')
+        _keyjar = _fed_entity.get_attribute('keyjar')
 
         if _fed_entity.upstream_get:
             _metadata = _fed_entity.upstream_get("metadata")
         else:
             _metadata = _fed_entity.get_metadata()
 
+        _authority_hints = _server.upstream_get('authority_hints')
+        if isinstance(_authority_hints, Callable):
+            _authority_hints = _authority_hints()
+
+        args = {"metadata": _metadata, "authority_hints": _authority_hints}
         if _fed_entity.context.trust_marks:
             if isinstance(_fed_entity.context.trust_marks, Callable):
-                args = {"trust_marks": _fed_entity.context.get_trust_marks()}
+                args["trust_marks"] = _fed_entity.context.get_trust_marks()
             else:
-                args = {"trust_marks": _fed_entity.context.trust_marks}
-        else:
-            args = {}
+                args["trust_marks"] = _fed_entity.context.trust_marks
+        if _fed_entity.context.default_lifetime:
+            args["lifetime"] = _fed_entity.context.default_lifetime
 
-        _ec = create_entity_statement(iss=_entity_id,
-                                      sub=_entity_id,
-                                      key_jar=_fed_entity.get_attribute('keyjar'),
-                                      metadata=_metadata,
-                                      authority_hints=_server.upstream_get('authority_hints'),
-                                      **args
-                                      )
-        return {"response": _ec}
+        def _sign():
+            return create_entity_statement(iss=_entity_id, sub=_entity_id, key_jar=_keyjar,
+                                           **args)
+
+        if self.statement_cache is None:
+            return _sign()
+        _fingerprint = fingerprint(args, _keyjar.export_jwks())
+        return self.statement_cache(_entity_id, _entity_id, _fingerprint, _sign)
+
+    def process_request(self, request=None, **kwargs):
+        return {"response": self.entity_configuration()}
 
     def response_info(
         self,
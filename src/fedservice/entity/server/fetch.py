@@ -1,9 +1,14 @@
 import logging
+from typing import Callable
+from typing import Optional
+from typing import Union
 
 from idpyoidc.message import oidc
 from idpyoidc.server.endpoint import Endpoint
 
 from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.statement_cache import fingerprint
+from fedservice.entity_statement.statement_cache import SignedStatementCache
 from fedservice.exception import UnknownEntity
 from fedservice.message import EntityStatement
 
@@ -18,12 +23,34 @@ class Fetch(Endpoint):
     name = "fetch"
     endpoint_name = "federation_fetch_endpoint"
 
-    def __init__(self, upstream_get, **kwargs):
+    def __init__(self, upstream_get, statement_cache: Optional[Union[bool, dict]] = True,
+                 **kwargs):
+        """
+        :param statement_cache: Whether signed statements should be cached, or the arguments
+            to the SignedStatementCache.
+        """
         Endpoint.__init__(self, upstream_get=upstream_get, **kwargs)
+        if isinstance(statement_cache, dict):
+            self.statement_cache = SignedStatementCache(**statement_cache)
+        elif statement_cache:
+            self.statement_cache = SignedStatementCache()
+        else:
+            self.statement_cache = None
 
     def get_policy(self, entity_id):
         pass
 
+    def _sign(self, iss, sub, keyjar, args):
+        # A statement is only signed if the information that goes into it or the signing keys
+        # have changed since last time or if the last one is about to expire.
+        def _sign():
+            return create_entity_statement(iss=iss, sub=sub, key_jar=keyjar, **args)
+
+        if self.statement_cache is None:
+            return _sign()
+        _fingerprint = fingerprint(args, keyjar.export_jwks())
+        return self.statement_cache(iss, sub, _fingerprint, _sign)
+
     def process_request(self, request=None, **kwargs):
         _context = self.upstream_get("context")
         _issuer = request.get("iss")
@@ -35,12 +62,12 @@ class Fetch(Endpoint):
         if not _sub or _sub == _issuer:
             _server = self.upstream_get("server")
             _entity = _server.upstream_get('unit')
-            _metadata = _entity.get_metadata()
-            _es = create_entity_statement(iss=_entity.context.entity_id,
-                                          sub=_entity.context.entity_id,
-                                          key_jar=_keyjar,
-                                          metadata=_metadata,
-                                          authority_hints=self.upstream_get('authority_hints'))
+            _authority_hints = self.upstream_get('authority_hints')
+            if isinstance(_authority_hints, Callable):
+                _authority_hints = _authority_hints()
+            _es = self._sign(_entity.context.entity_id, _entity.context.entity_id, _keyjar,
+                             {"metadata": _entity.get_metadata(),
+                              "authority_hints": _authority_hints})
         else:
             _server = self.upstream_get("unit")
             # Contains jwks and possibly entity type and authority_hints
@@ -75,12 +102,8 @@ class Fetch(Endpoint):
                         _policy = None
 
             if _policy:
+                _response = dict(_response)
                 _response.update(_policy)
 
-            _es = create_entity_statement(iss=_issuer,
-                                          sub=_sub,
-                                          key_jar=_keyjar,
-                                          **_response
-                                          )
+            _es = self._sign(_issuer, _sub, _keyjar, _response)
         return {"response_msg": _es}
-
@@ -0,0 +1,283 @@
+"""
+Where cached statements are kept. The default is a dictionary in the process. With the SQLite
+backend several processes, e.g. the workers of a WSGI server, share what has been fetched and
+verified.
+"""
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+from typing import Optional
+
+from idpyoidc.util import instantiate
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(object):
+    """
+    Stores cache records. A record is a dictionary with at least the keys
+    value, exp (may be None) and size.
+    """
+
+    def get(self, key: str) -> Optional[dict]:
+        raise NotImplementedError()
+
+    def set(self, key: str, record: dict):
+        raise NotImplementedError()
+
+    def delete(self, key: str) -> Optional[dict]:
+        """
+        :return: The removed record or None if there was none
+        """
+        raise NotImplementedError()
+
+    def touch(self, key: str):
+        """Mark a record as the most recently used."""
+        raise NotImplementedError()
+
+    def keys(self) -> List[str]:
+        raise NotImplementedError()
+
+    def size(self) -> int:
+        """The total size of the records."""
+        raise NotImplementedError()
+
+    def expired(self, now: int) -> List[str]:
+        """
+        The keys of the records that have expired. The caller is expected to remove them.
+        """
+        raise NotImplementedError()
+
+    def least_recently_used(self) -> Optional[str]:
+        raise NotImplementedError()
+
+    def clear(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class DictBackend(CacheBackend):
+    """
+    Keeps the records in a dictionary, least recently used first. A heap ordered by expiration
+    time makes it cheap to find the records that have expired.
+    """
+
+    def __init__(self, **kwargs):
+        self._db = {}
+        self._size = 0
+        # (exp, key) tuples. Entries for records that have since been replaced or removed are
+        # skipped when they reach the top.
+        self._expiry = []
+        self._lock = threading.RLock()
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._db.get(key)
+
+    def set(self, key: str, record: dict):
+        with self._lock:
+            self.delete(key)
+            self._db[key] = record
+            self._size += record["size"]
+            if record["exp"] is not None:
+                heapq.heappush(self._expiry, (record["exp"], key))
+                if len(self._expiry) > 2 * len(self._db) + 64:
+                    self._compact()
+
+    def _compact(self):
+        self._expiry = [(r["exp"], k) for k, r in self._db.items() if r["exp"] is not None]
+        heapq.heapify(self._expiry)
+
+    def delete(self, key: str) -> Optional[dict]:
+        with self._lock:
+            _record = self._db.pop(key, None)
+            if _record is not None:
+                self._size -= _record["size"]
+            return _record
+
+    def touch(self, key: str):
+        with self._lock:
+            if key in self._db:
+                self._db[key] = self._db.pop(key)
+
+    def keys(self) -> List[str]:
+        return list(self._db.keys())
+
+    def size(self) -> int:
+        return self._size
+
+    def expired(self, now: int) -> List[str]:
+        res = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _exp, key = heapq.heappop(self._expiry)
+                _record = self._db.get(key)
+                if _record is None or _record["exp"] != _exp:
+                    continue
+                # Setting a record again with the same expiration time adds an identical
+                # entry, those come off the heap one after the other
+                if res and res[-1] == key:
+                    continue
+                res.append(key)
+        return res
+
+    def least_recently_used(self) -> Optional[str]:
+        try:
+            return next(iter(self._db))
+        except StopIteration:
+            return None
+
+    def __len__(self):
+        return len(self._db)
+
+    def __contains__(self, key):
+        return key in self._db
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Keeps the records in an SQLite database file. The database is used in WAL mode so readers
+    are not blocked by a writer. Each process and thread gets a connection of its own.
+    Values must be possible to serialize as JSON.
+    Marking records as used is batched so a read doesn't have to be followed by a write.
+    """
+
+    def __init__(self, path: str, namespace: Optional[str] = "default",
+                 timeout: Optional[float] = 30.0, touch_batch: Optional[int] = 100, **kwargs):
+        """
+        :param path: The database file
+        :param namespace: Records with different namespaces are kept apart. Allows several
+            caches to use the same file.
+        :param timeout: How long to wait for a lock held by someone else
+        :param touch_batch: How many records are marked as used in one write. The pending
+            ones are always written before the least recently used record is looked for.
+        """
+        self.path = path
+        self.namespace = namespace
+        self.timeout = timeout
+        self.touch_batch = touch_batch
+        self._local = threading.local()
+        # key -> when it was used
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        # A connection must not be used in a forked child
+        _pid = os.getpid()
+        if getattr(self._local, "pid", None) == _pid:
+            return self._local.connection
+
+        _conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, record TEXT NOT NULL, exp INTEGER, "
+            "size INTEGER NOT NULL, used REAL NOT NULL, PRIMARY KEY (namespace, key))")
+        _conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (namespace, used)")
+        _conn.execute("CREATE INDEX IF NOT EXISTS cache_exp ON cache (namespace, exp)")
+        self._local.connection = _conn
+        self._local.pid = _pid
+        return _conn
+
+    def _execute(self, statement: str, *args) -> sqlite3.Cursor:
+        return self._connection().execute(statement, (self.namespace,) + args)
+
+    def get(self, key: str) -> Optional[dict]:
+        _row = self._execute(
+            "SELECT record, exp, size FROM cache WHERE namespace = ? AND key = ?",
+            key).fetchone()
+        if _row is None:
+            return None
+        _record = json.loads(_row[0])
+        _record["exp"] = _row[1]
+        _record["size"] = _row[2]
+        return _record
+
+    def set(self, key: str, record: dict):
+        with self._touch_lock:
+            self._touched.pop(key, None)
+        _record = {k: v for k, v in record.items() if k not in ["exp", "size"]}
+        self._execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, record, exp, size, used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            key, json.dumps(_record), record["exp"], record["size"], time.time())
+
+    def delete(self, key: str) -> Optional[dict]:
+        _record = self.get(key)
+        if _record is not None:
+            self._execute("DELETE FROM cache WHERE namespace = ? AND key = ?", key)
+        return _record
+
+    def touch(self, key: str):
+        with self._touch_lock:
+            self._touched[key] = time.time()
+            if len(self._touched) < self.touch_batch:
+                return
+        self._flush_touched()
+
+    def _flush_touched(self):
+        with self._touch_lock:
+            _touched = self._touched
+            self._touched = {}
+        if _touched:
+            self._connection().executemany(
+                "UPDATE cache SET used = ? WHERE namespace = ? AND key = ?",
+                [(_used, self.namespace, _key) for _key, _used in _touched.items()])
+
+    def keys(self) -> List[str]:
+        return [r[0] for r in self._execute("SELECT key FROM cache WHERE namespace = ?")]
+
+    def size(self) -> int:
+        return self._execute("SELECT COALESCE(SUM(size), 0) FROM cache WHERE namespace = ?"
+                             ).fetchone()[0]
+
+    def expired(self, now: int) -> List[str]:
+        return [r[0] for r in self._execute(
+            "SELECT key FROM cache WHERE namespace = ? AND exp IS NOT NULL AND exp <= ?", now)]
+
+    def least_recently_used(self) -> Optional[str]:
+        self._flush_touched()
+        _row = self._execute(
+            "SELECT key FROM cache WHERE namespace = ? ORDER BY used LIMIT 1").fetchone()
+        if _row is None:
+            return None
+        return _row[0]
+
+    def clear(self):
+        self._execute("DELETE FROM cache WHERE namespace = ?")
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM cache WHERE namespace = ?").fetchone()[0]
+
+    def __contains__(self, key):
+        return self._execute("SELECT 1 FROM cache WHERE namespace = ? AND key = ?",
+                             key).fetchone() is not None
+
+
+def make_backend(spec: Optional[dict] = None, namespace: Optional[str] = "default"):
+    """
+    :param spec: A dictionary with the keys class and kwargs. If not given a DictBackend is used.
+    :param namespace: Used if the backend is shared with others
+    :return: A CacheBackend instance
+    """
+    # An empty backend is falsy
+    if isinstance(spec, CacheBackend):
+        return spec
+    if not spec:
+        return DictBackend()
+
+    _kwargs = dict(spec.get("kwargs", {}))
+    _kwargs.setdefault("namespace", namespace)
+    return instantiate(spec["class"], **_kwargs)
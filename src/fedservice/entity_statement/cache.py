@@ -1,55 +1,568 @@
+import json
 import logging
+import threading
 from typing import Any
+from typing import Callable
+from typing import List
 from typing import Optional
+from typing import Union
 
 from cryptojwt.jwt import utc_time_sans_frac
 from idpyoidc.impexp import ImpExp
 
+from fedservice.entity_statement.backend import CacheBackend
+from fedservice.entity_statement.backend import make_backend
+from fedservice.exception import FailedConfigurationRetrieval
+
 logger = logging.getLogger(__name__)
 
 
+def _get_header(response, name: str) -> Optional[str]:
+    _headers = getattr(response, "headers", None) or {}
+    _val = _headers.get(name)
+    if _val is None:
+        # A plain dictionary is case-sensitive
+        for key, val in _headers.items():
+            if key.lower() == name.lower():
+                return val
+    return _val
+
+
+def parse_cache_control(value: str) -> dict:
+    directives = {}
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "=" in part:
+            _name, _val = part.split("=", 1)
+            directives[_name.strip().lower()] = _val.strip().strip('"')
+        else:
+            directives[part.lower()] = True
+    return directives
+
+
+def http_cache_info(url: str, response) -> Optional[dict]:
+    """
+    Collects the HTTP caching information in a response.
+
+    :param url: The URL the response came from
+    :param response: A HTTP response
+    :return: A dictionary with the caching information or None if the response may not be cached
+    """
+    _info = {"url": url, "fetched_at": utc_time_sans_frac()}
+    _cache_control = _get_header(response, "Cache-Control")
+    if _cache_control:
+        _directives = parse_cache_control(_cache_control)
+        if "no-store" in _directives:
+            return None
+        _info["cache_control"] = _cache_control
+        if "no-cache" in _directives:
+            _info["max_age"] = 0
+        elif "max-age" in _directives:
+            try:
+                _info["max_age"] = int(_directives["max-age"])
+            except ValueError:
+                pass
+
+    for attr, header in [("etag", "ETag"), ("last_modified", "Last-Modified")]:
+        _val = _get_header(response, header)
+        if _val:
+            _info[attr] = _val
+
+    return _info
+
+
+def conditional_headers(http_info: Optional[dict]) -> dict:
+    headers = {}
+    if http_info:
+        if http_info.get("etag"):
+            headers["If-None-Match"] = http_info["etag"]
+        if http_info.get("last_modified"):
+            headers["If-Modified-Since"] = http_info["last_modified"]
+    return headers
+
+
+def _size(value) -> int:
+    """A rough estimate of how much room a cached value takes."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict) and isinstance(value.get("_jws"), str):
+        # The signed version is about as large as the decoded one
+        return 2 * len(value["_jws"])
+    return len(json.dumps(value, default=str))
+
+
 class ESCache(ImpExp):
+    """
+    Cache for entity configurations and entity statements.
+
+    There is one record per statement holding the statement, its expiration time, its size and
+    the HTTP caching information. If the cache is bounded, by the number of entries and/or the
+    total size of the cached statements, room is made for a new statement by first
+    removing expired statements and then the least recently used ones.
+
+    The records are kept by a :py:class:`fedservice.entity_statement.backend.CacheBackend`,
+    by default in a dictionary. Expired statements are removed in bulk by :py:meth:`sweep`,
+    which is run every sweep_interval seconds when statements are added.
+    """
+
     parameter = {
         "_db": {},
-        "allowed_delta": 0
+        "allowed_delta": 0,
+        "grace": 0,
+        "max_entries": 0,
+        "max_bytes": 0,
+        "sweep_interval": 0
     }
 
-    def __init__(self, allowed_delta=300):
+    def __init__(self,
+                 allowed_delta: Optional[int] = 300,
+                 grace: Optional[int] = 0,
+                 max_entries: Optional[int] = 0,
+                 max_bytes: Optional[int] = 0,
+                 backend: Optional[Union[dict, CacheBackend]] = None,
+                 sweep_interval: Optional[int] = 60):
+        """
+        :param allowed_delta: Safety margin. A statement is not used when it is closer to its
+            expiration time than this.
+        :param grace: Stale-while-revalidate window. For this many seconds after it has become
+            stale a statement may still be used, as long as it has not expired, while it's
+            refreshed in the background.
+        :param max_entries: The maximum number of statements kept. 0 means no limit.
+        :param max_bytes: The maximum total size of the statements kept. 0 means no limit.
+        :param backend: Where the records are kept. Either a CacheBackend instance or a
+            specification with class and kwargs. The bounds apply to everything in the backend,
+            also what other processes have added.
+        :param sweep_interval: How often expired statements are removed. 0 means that it's
+            only done when :py:meth:`sweep` is called.
+        """
         ImpExp.__init__(self)
-        self._db = {}
+        # key -> {"value": ..., "exp": ..., "size": ..., "http": ...}
+        self.backend = make_backend(backend)
         self.allowed_delta = allowed_delta
+        self.grace = grace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.stale_served = 0
+        self.sweep_interval = sweep_interval
+        self._last_sweep = utc_time_sans_frac()
+        self._refresher = None
+        self._executor = None
+        self._refreshing = set()
+        self._lock = threading.RLock()
+
+    def set(self, key, value, exp: Optional[int] = None, http_info: Optional[dict] = None):
+        """
+        Add a statement to the cache.
+
+        :param key: Cache key
+        :param value: The statement, signed or not
+        :param exp: When the statement expires. If not given and the value is a dictionary
+            the exp claim is used.
+        :param http_info: HTTP caching information from the response the statement came in
+        """
+        if exp is None and isinstance(value, dict):
+            exp = value.get("exp")
+        _record = {"value": value, "exp": exp, "size": _size(value)}
+        if http_info:
+            _record["http"] = http_info
+        with self._lock:
+            self.backend.set(key, _record)
+            self._make_room(keep=key)
+
+        if self.sweep_interval and utc_time_sans_frac() >= self._last_sweep + self.sweep_interval:
+            self.sweep()
 
     def __setitem__(self, key, value):
-        self._db[key] = value
+        self.set(key, value)
+
+    def _remove(self, key) -> Optional[dict]:
+        return self.backend.delete(key)
+
+    def _over_limit(self) -> bool:
+        if self.max_entries and len(self.backend) > self.max_entries:
+            return True
+        if self.max_bytes and self.backend.size() > self.max_bytes:
+            return True
+        return False
+
+    def _make_room(self, keep=None):
+        if not self._over_limit():
+            return
+
+        _now = utc_time_sans_frac()
+        for key in self.backend.expired(_now):
+            if key != keep and self._remove(key) is not None:
+                self.expired += 1
+
+        while self._over_limit():
+            key = self.backend.least_recently_used()
+            if key is None or key == keep:
+                # The new statement alone is larger than allowed, it's still kept
+                break
+            self._remove(key)
+            self.evictions += 1
 
     def __getitem__(self, item):
-        try:
-            statement = self._db[item]
-        except KeyError:
-            return None
-        else:
-            if isinstance(statement, dict):
+        with self._lock:
+            _record = self.backend.get(item)
+            if _record is None:
+                self.misses += 1
+                return None
+
+            _exp = _record["exp"]
+            if _exp is not None:
                 # verify that the statement is recent enough
                 _now = utc_time_sans_frac()
-                if _now < (statement["exp"] - self.allowed_delta):
-                    return statement
+                if _now < self.fresh_until(item, _exp):
+                    pass
+                elif self.use_stale(item, _exp):
+                    pass
+                elif self.revalidatable(item, _exp):
+                    # Keep it around, a conditional request may extend its life
+                    self.misses += 1
+                    return None
                 else:
-                    del self._db[item]
+                    self._remove(item)
+                    self.misses += 1
                     return None
-            else:
-                return statement
+
+            self.hits += 1
+            if self.max_entries or self.max_bytes:
+                # Only needed when the least recently used statements are evicted
+                self.backend.touch(item)
+            return _record["value"]
 
     def __delitem__(self, key):
-        del self._db[key]
+        with self._lock:
+            if self._remove(key) is None:
+                raise KeyError(key)
+
+    def pop(self, key, default: Optional[Any] = None):
+        with self._lock:
+            _record = self._remove(key)
+        if _record is None:
+            return default
+        return _record["value"]
+
+    def sweep(self) -> List[str]:
+        """
+        Remove all statements that have expired.
+
+        :return: The keys of the removed statements
+        """
+        _now = utc_time_sans_frac()
+        res = []
+        with self._lock:
+            self._last_sweep = _now
+            for key in self.backend.expired(_now):
+                if self._remove(key) is not None:
+                    res.append(key)
+            self.expired += len(res)
+        if res:
+            logger.debug(f"Removed {len(res)} expired statements")
+        return res
+
+    def _live(self, key) -> Optional[dict]:
+        _record = self.backend.get(key)
+        if _record is None:
+            return None
+        if _record["exp"] is not None and utc_time_sans_frac() >= _record["exp"]:
+            self._remove(key)
+            self.expired += 1
+            return None
+        return _record
+
+    def expires_at(self, key) -> Optional[int]:
+        _record = self.backend.get(key)
+        if _record is None:
+            return None
+        return _record["exp"]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "stale_served": self.stale_served,
+            "entries": len(self.backend),
+            "bytes": self.backend.size()
+        }
+
+    @property
+    def _db(self) -> dict:
+        # What is dumped
+        return {key: self.backend.get(key) for key in self.backend.keys()}
+
+    @_db.setter
+    def _db(self, records: dict):
+        # What is loaded
+        for key, record in records.items():
+            if record is not None:
+                self.backend.set(key, record)
+
+    def set_refresher(self, refresher: Callable, executor):
+        """
+        :param refresher: Called with the key of a stale statement. Is expected to fetch a new
+            version of the statement and store it in this cache.
+        :param executor: Where the refresher is run, e.g. a ThreadPoolExecutor, or a callable
+            that returns it when the first refresh is needed
+        """
+        self._refresher = refresher
+        self._executor = executor
+
+    def use_stale(self, key, exp: int) -> bool:
+        """
+        Decides whether a stale statement can be used. If so a background refresh is started
+        unless one is already running for the statement.
+
+        :param key: Cache key
+        :param exp: When the statement expires
+        :return: True if the statement can be used
+        """
+        if not self.grace or self._refresher is None:
+            return False
+
+        _now = utc_time_sans_frac()
+        if _now >= exp or _now >= self.fresh_until(key, exp) + self.grace:
+            return False
+
+        with self._lock:
+            self.stale_served += 1
+            if key in self._refreshing:
+                return True
+            self._refreshing.add(key)
+
+        logger.debug(f"Serving stale {key} while refreshing it")
+        try:
+            _executor = self._executor
+            if callable(_executor):
+                _executor = _executor()
+            _future = _executor.submit(self._refresher, key)
+        except Exception as err:
+            logger.warning(f"Could not refresh {key} in the background: {err}")
+            self._refresh_done(key)
+        else:
+            _future.add_done_callback(lambda fut: self._refresh_done(key, fut))
+        return True
+
+    def _refresh_done(self, key, future=None):
+        with self._lock:
+            self._refreshing.discard(key)
+        if future is not None and future.exception():
+            logger.warning(f"Background refresh of {key} failed: {future.exception()}")
+
+    def refreshing(self) -> list:
+        with self._lock:
+            return list(self._refreshing)
+
+    def set_http_info(self, key, http_info: Optional[dict]):
+        with self._lock:
+            _record = self.backend.get(key)
+            if _record is None:
+                return
+            if http_info:
+                _record["http"] = http_info
+            else:
+                _record.pop("http", None)
+            self.backend.set(key, _record)
+
+    def get_http_info(self, key) -> Optional[dict]:
+        _record = self.backend.get(key)
+        if _record is None:
+            return None
+        return _record.get("http")
+
+    def fresh_until(self, key, exp: int) -> int:
+        """
+        Calculates until when a cached statement can be used without asking the source.
+        Cache-Control max-age, or no-cache, can make the time shorter but only if the statement
+        can be revalidated using a conditional request. Otherwise, and after a successful
+        revalidation, the statement is never used closer to its expiration time than
+        allowed_delta.
+
+        :param key: Cache key
+        :param exp: When the statement expires
+        :return: A time stamp
+        """
+        _limit = exp - self.allowed_delta
+        _info = self.get_http_info(key)
+        if not _info or not (_info.get("etag") or _info.get("last_modified")):
+            return _limit
+
+        _max_age = _info.get("max_age")
+        if _max_age is None:
+            return _limit
+        return min(_limit, _info["fetched_at"] + _max_age)
+
+    def revalidatable(self, key, exp: int) -> bool:
+        _info = self.get_http_info(key)
+        if not _info or not (_info.get("etag") or _info.get("last_modified")):
+            return False
+        # A revalidated statement is not used any closer to its expiration time than others
+        return utc_time_sans_frac() < exp - self.allowed_delta
+
+    def not_modified(self, key, http_info: Optional[dict] = None):
+        """
+        The source says the cached statement is still the current one.
+
+        :param key: Cache key
+        :param http_info: HTTP caching information from the 304 response
+        """
+        _info = (self.get_http_info(key) or {}).copy()
+        if http_info:
+            _info.update({k: v for k, v in http_info.items() if v is not None})
+        _info["fetched_at"] = utc_time_sans_frac()
+        _info["revalidated"] = True
+        self.set_http_info(key, _info)
 
     def keys(self):
-        return self._db.keys()
+        return self.backend.keys()
 
     def __len__(self):
-        return len(self._db)
+        return len(self.backend)
 
     def __contains__(self, item):
-        return item in self._db
+        return self._live(item) is not None
 
     def get(self, key, default: Optional[Any] = None):
-        return self._db.get(key, default)
+        """
+        Get a cached statement that has not expired without checking whether it's still usable.
+        """
+        _record = self._live(key)
+        if _record is None:
+            return default
+        return _record["value"]
+
+
+# Seconds a failed URL is left alone after the first failure, by exception class name
+DEFAULT_NEGATIVE_TTL = {
+    "MissingPage": 300,
+    "FailedConfigurationRetrieval": 60,
+    "ConnectionError": 30
+}
+
+
+class NegativeCache(object):
+    """
+    Remembers URLs that could not be fetched.
+    A URL that has failed is not contacted again until its backoff window has passed.
+    The window starts at the TTL for the type of error and doubles (backoff_factor) for
+    every consecutive failure up to max_ttl.
+    At most max_entries URLs are remembered, the ones that failed the longest time ago are
+    forgotten first.
+    """
+
+    def __init__(self,
+                 ttl: Optional[dict] = None,
+                 default_ttl: Optional[int] = 30,
+                 max_ttl: Optional[int] = 3600,
+                 backoff_factor: Optional[int] = 2,
+                 max_entries: Optional[int] = 10000):
+        self.ttl = DEFAULT_NEGATIVE_TTL.copy()
+        if ttl:
+            self.ttl.update(ttl)
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.backoff_factor = backoff_factor
+        self.max_entries = max_entries
+        # URL -> failure information, the most recent failure last
+        self._db = {}
+        self._lock = threading.Lock()
+
+    def error_ttl(self, error: Exception) -> int:
+        # Walk the class hierarchy so subclasses get the TTL of a known parent
+        for cls in type(error).__mro__:
+            if cls.__name__ in self.ttl:
+                return self.ttl[cls.__name__]
+        return self.default_ttl
+
+    def add(self, url: str, error: Exception):
+        _now = utc_time_sans_frac()
+        with self._lock:
+            _entry = self._db.pop(url, None)
+            if _entry:
+                _failures = _entry["failures"] + 1
+            else:
+                _failures = 1
+            _window = min(self.error_ttl(error) * self.backoff_factor ** (_failures - 1),
+                          self.max_ttl)
+            self._db[url] = {
+                "error": error,
+                "failures": _failures,
+                "failed_at": _now,
+                "until": _now + _window
+            }
+            if self.max_entries and len(self._db) > self.max_entries:
+                self._evict(_now)
+        logger.debug(f"Negative cache: {url} failed {_failures} time(s), backing off {_window}s")
+
+    def get(self, url: str) -> Optional[Exception]:
+        """
+        :param url: The URL
+        :return: The error from the last attempt if the URL is within its backoff window
+        """
+        _entry = self._db.get(url)
+        if _entry and utc_time_sans_frac() < _entry["until"]:
+            return _entry["error"]
+        return None
+
+    def check(self, url: str):
+        """
+        Raises an exception if the URL is within its backoff window. The exception is of the
+        same type as the one from the last attempt and chained to it.
+
+        :param url: The URL
+        """
+        _error = self.get(url)
+        if _error is None:
+            return
+
+        _msg = f"Not trying {url} again yet, it failed with: {_error}"
+        logger.debug(_msg)
+        try:
+            _new = type(_error)(_msg)
+        except Exception:
+            _new = FailedConfigurationRetrieval(_msg)
+        raise _new from _error
+
+    def _evict(self, now: int):
+        # Those whose backoff window has passed go first
+        for url in [_url for _url, _entry in self._db.items() if _entry["until"] <= now]:
+            del self._db[url]
+        while len(self._db) > self.max_entries:
+            del self._db[next(iter(self._db))]
+
+    def remove(self, url: str):
+        with self._lock:
+            self._db.pop(url, None)
+
+    def purge(self, url: Optional[str] = ""):
+        """
+        Forget about failures.
+
+        :param url: If given only this URL is forgotten otherwise everything is.
+        """
+        with self._lock:
+            if url:
+                self._db.pop(url, None)
+            else:
+                self._db = {}
+
+    def items(self):
+        return [(k, v.copy()) for k, v in self._db.items()]
+
+    def keys(self):
+        return list(self._db.keys())
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def __len__(self):
+        return len(self._db)
@@ -1,4 +1,5 @@
 from typing import List
+from typing import Optional
 from typing import Union
 
 from idpyoidc.message import Message
@@ -51,6 +52,83 @@ def more_specific(a, b):
     return False
 
 
+def host_labels(url: str) -> List[str]:
+    """
+    :return: The labels of the host name in an entity identifier, the top level domain first
+    """
+    _labels = remove_scheme(url).split('.')
+    _labels.reverse()
+    return _labels
+
+
+class DomainTrie(object):
+    """
+    Entity identifiers and domains, as used in naming constraints, kept in a trie keyed by the
+    host labels in reverse order. An entity identifier matches an entry if the entry's labels
+    are the first of its own. The empty label a domain, like 'https://.example.com', starts
+    with matches any label. Same result as :py:func:`more_specific` but finding the entries an
+    entity identifier matches costs the number of labels in the identifier, not the number of
+    entries.
+    """
+
+    def __init__(self, entries: Optional[List[str]] = None):
+        # label -> node. The indexes of the entries that end in a node are kept under None.
+        self._root = {}
+        self.entries = []
+        self._length = []
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry: str):
+        _labels = host_labels(entry)
+        node = self._root
+        for label in _labels:
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(len(self.entries))
+        self.entries.append(entry)
+        self._length.append(len(_labels))
+
+    @staticmethod
+    def _below(node: dict) -> List[int]:
+        res = []
+        _nodes = [node]
+        while _nodes:
+            _node = _nodes.pop()
+            for label, value in _node.items():
+                if label is None:
+                    res.extend(value)
+                else:
+                    _nodes.append(value)
+        return res
+
+    def matching(self, entity_id: str) -> List[int]:
+        """
+        :return: The indexes of the entries the entity identifier matches, in the order the
+            entries were added
+        """
+        _labels = host_labels(entity_id)
+        res = []
+        _nodes = [(self._root, 0)]
+        while _nodes:
+            node, depth = _nodes.pop()
+            res.extend(node.get(None, []))
+            if depth == len(_labels):
+                continue
+            label = _labels[depth]
+            if label in node:
+                _nodes.append((node[label], depth + 1))
+            if label != "" and "" in node:
+                # Whatever follows the empty label is not compared
+                res.extend([i for i in self._below(node[""]) if self._length[i] <= len(_labels)])
+        return sorted(set(res))
+
+    def match(self, entity_id: str) -> bool:
+        return bool(self.matching(entity_id))
+
+    def __len__(self):
+        return len(self.entries)
+
+
 # def add_permitted(new_permitted, permitted):
 #     _updated = []
 #     for _new in new_permitted:
@@ -63,17 +141,16 @@ def more_specific(a, b):
 
 
 def update_specs(new_constraints: list, old_constraints: list):
+    _old = DomainTrie(old_constraints)
+    # old index -> the new that are more specific
+    _replacements = {}
+    for _new in new_constraints:
+        for i in _old.matching(_new):
+            _replacements.setdefault(i, []).append(_new)
+
     _updated = []
-    _replaced = False
-    for _old in old_constraints:
-        _replaced = False
-        for _new in new_constraints:
-            if more_specific(_new, _old):
-                _updated.append(_new)
-                _replaced = True
-
-        if not _replaced:
-            _updated.append(_old)
+    for i, _spec in enumerate(old_constraints):
+        _updated.extend(_replacements.get(i, [_spec]))
     return _updated
 
 
@@ -85,7 +162,7 @@ def add_constraints(new_constraints: dict, naming_constraints: dict):
 
             continue
         else:
-            if not new_constraints[key]:
+            if not new_constraints.get(key):
                 continue
 
         naming_constraints[key] = update_specs(new_constraints[key], naming_constraints[key])
@@ -119,56 +196,113 @@ def permitted(subject_id: str, permitted_id: List[str]):
     return False
 
 
-def meets_restrictions(trust_chain: List[EntityStatement]) -> bool:
+def initial_restrictions() -> dict:
     """
-    Verifies that the trust chain fulfills the constraints specified in it.
+    :return: The restrictions in force before any statement in a trust chain has been seen
+    """
+    return {
+        "max_path_length": 0,
+        "max_assigned": False,
+        "naming_constraints": {
+            "permitted": None,
+            "excluded": None
+        },
+        # The naming constraints compiled into DomainTrie instances
+        "matchers": {
+            "permitted": None,
+            "excluded": None
+        }
+    }
 
-    :param trust_chain: A sequence of entity statements. The order is such that the leaf's is the
-        last. The trust anchor's the first.
-    :return: True is the constraints are fulfilled. False otherwise
+
+def _matchers(naming_constraints: dict, restrictions: dict) -> dict:
+    # Lists that have not changed since the statement before keep their tries
+    _before = restrictions.get("matchers", {})
+    res = {}
+    for key in ['permitted', 'excluded']:
+        _list = naming_constraints.get(key)
+        if not _list:
+            res[key] = None
+        elif _before.get(key) is not None and _list is restrictions["naming_constraints"].get(key):
+            res[key] = _before[key]
+        else:
+            res[key] = DomainTrie(_list)
+    return res
+
+
+def _meets_naming_constraints(subject_id: str, matchers: dict) -> bool:
+    # if explicitly excluded return False
+    if matchers["excluded"] and matchers["excluded"].match(subject_id):
+        return False
+
+    # If there is a list of permitted it must be in there
+    if matchers["permitted"] and not matchers["permitted"].match(subject_id):
+        return False
+
+    return True
+
+
+def apply_constraints(statement: Union[dict, Message], restrictions: dict) -> Optional[dict]:
     """
+    Adds the constraints of a statement that is not the last in a trust chain to the
+    restrictions given by the statements before it.
 
-    current_max_path_length = 0
-    max_assigned = False
-    naming_constraints = {
-        "permitted": None,
-        "excluded": None
-    }
+    :param statement: An entity statement
+    :param restrictions: The restrictions before this statement. Not modified.
+    :return: The restrictions after this statement or None if the statement breaks them
+    """
+    try:
+        _constraints = statement['constraints']
+    except KeyError:
+        return restrictions
 
-    for statement in trust_chain[:-1]:  # All but the last
-        try:
-            _constraints = statement['constraints']
-        except KeyError:
-            continue
+    current_max_path_length = calculate_path_length(_constraints,
+                                                    restrictions["max_path_length"],
+                                                    restrictions["max_assigned"])
 
-        current_max_path_length = calculate_path_length(_constraints, current_max_path_length,
-                                                        max_assigned)
+    if current_max_path_length < 0:
+        return None
 
-        if current_max_path_length < 0:
-            return False
+    naming_constraints = update_naming_constraints(_constraints,
+                                                   dict(restrictions["naming_constraints"]))
+    _naming_matchers = _matchers(naming_constraints, restrictions)
 
-        naming_constraints = update_naming_constraints(_constraints, naming_constraints)
+    if not _meets_naming_constraints(statement['sub'], _naming_matchers):
+        return None
 
-        # if explicitly excluded return False
-        if 'excluded' in naming_constraints and naming_constraints['excluded']:
-            if excluded(statement['sub'], naming_constraints['excluded']):
-                return False
+    return {
+        "max_path_length": current_max_path_length,
+        "max_assigned": restrictions["max_assigned"],
+        "naming_constraints": naming_constraints,
+        "matchers": _naming_matchers
+    }
 
-        # If there is a list of permitted it must be in there
-        if 'permitted' in naming_constraints and naming_constraints['permitted']:
-            if not permitted(statement['sub'], naming_constraints["permitted"]):
-                return False
 
-    # Now check the leaf entity
-    statement = trust_chain[-1]
-    # if explicitly excluded return False
-    if 'excluded' in naming_constraints and naming_constraints['excluded']:
-        if excluded(statement['sub'], naming_constraints['excluded']):
-            return False
+def leaf_meets_restrictions(statement: Union[dict, Message], restrictions: dict) -> bool:
+    """
+    Checks the last statement in a trust chain against the restrictions given by the
+    statements before it.
+    """
+    _naming_matchers = restrictions.get("matchers")
+    if _naming_matchers is None:
+        _naming_matchers = _matchers(restrictions["naming_constraints"], {})
+    return _meets_naming_constraints(statement['sub'], _naming_matchers)
 
-    # If there is a list of permitted it must be in there
-    if 'permitted' in naming_constraints and naming_constraints['permitted']:
-        if not permitted(statement['sub'], naming_constraints["permitted"]):
+
+def meets_restrictions(trust_chain: List[EntityStatement]) -> bool:
+    """
+    Verifies that the trust chain fulfills the constraints specified in it.
+
+    :param trust_chain: A sequence of entity statements. The order is such that the leaf's is the
+        last. The trust anchor's the first.
+    :return: True is the constraints are fulfilled. False otherwise
+    """
+
+    restrictions = initial_restrictions()
+    for statement in trust_chain[:-1]:  # All but the last
+        restrictions = apply_constraints(statement, restrictions)
+        if restrictions is None:
             return False
 
-    return True
+    # Now check the leaf entity
+    return leaf_meets_restrictions(trust_chain[-1], restrictions)
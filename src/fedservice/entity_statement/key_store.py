@@ -0,0 +1,112 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+from typing import Optional
+
+from cryptojwt import KeyJar
+from cryptojwt.jwt import utc_time_sans_frac
+
+logger = logging.getLogger(__name__)
+
+
+class LearnedKeyStore(object):
+    """
+    Keeps track of the keys that have been added to the federation key jar from verified
+    entity statements. The keys of an entity are removed from the key jar when the statement
+    that introduced them has expired or, if there is a limit to the number of entities, when
+    they are the least recently used.
+    Keys that were in the key jar before they were learned from a statement, like the trust
+    anchors' and the entity's own, are pinned and never removed.
+    """
+
+    def __init__(self, max_issuers: Optional[int] = 0, pinned: Optional[List[str]] = None,
+                 **kwargs):
+        """
+        :param max_issuers: The maximum number of entities whose keys are kept. 0 means no limit.
+        :param pinned: Entity IDs whose keys must never be removed
+        """
+        self.max_issuers = max_issuers
+        self._pinned = set(pinned or [])
+        # entity ID -> expiration time, least recently used first
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expired = 0
+
+    def pin(self, *entity_ids: str):
+        with self._lock:
+            for entity_id in entity_ids:
+                self._pinned.add(entity_id)
+                self._db.pop(entity_id, None)
+
+    def is_pinned(self, entity_id: str) -> bool:
+        return entity_id in self._pinned
+
+    def learned(self, keyjar: KeyJar, entity_id: str, exp: Optional[int] = None,
+                introduced: Optional[bool] = True):
+        """
+        Record that keys for an entity has been added to the key jar.
+
+        :param keyjar: The federation key jar
+        :param entity_id: Who the keys belong to
+        :param exp: When the statement that carried the keys expires
+        :param introduced: Whether there were no keys for the entity in the key jar before
+        """
+        with self._lock:
+            if entity_id in self._pinned:
+                return
+            if entity_id not in self._db:
+                if not introduced:
+                    # Put there by someone else
+                    self._pinned.add(entity_id)
+                    return
+            elif exp and self._db[entity_id]:
+                # Valid as long as one of the statements carrying them is
+                exp = max(exp, self._db[entity_id])
+            self._db[entity_id] = exp
+            self._db.move_to_end(entity_id)
+            while self.max_issuers and len(self._db) > self.max_issuers:
+                _entity_id, _ = self._db.popitem(last=False)
+                self._remove(keyjar, _entity_id)
+                self.evictions += 1
+
+    def used(self, entity_id: str):
+        """Mark the keys of an entity as the most recently used."""
+        with self._lock:
+            if entity_id in self._db:
+                self._db.move_to_end(entity_id)
+
+    @staticmethod
+    def _remove(keyjar: KeyJar, entity_id: str):
+        logger.debug(f"Removing the keys of {entity_id} from the federation key jar")
+        if entity_id in keyjar:
+            del keyjar[entity_id]
+
+    def sweep(self, keyjar: KeyJar, now: Optional[int] = 0) -> List[str]:
+        """
+        Remove the keys introduced by statements that have expired.
+
+        :return: The entity IDs whose keys were removed
+        """
+        _now = now or utc_time_sans_frac()
+        res = []
+        with self._lock:
+            for entity_id, exp in list(self._db.items()):
+                if exp and exp <= _now:
+                    del self._db[entity_id]
+                    self._remove(keyjar, entity_id)
+                    res.append(entity_id)
+            self.expired += len(res)
+        return res
+
+    def issuers(self) -> List[str]:
+        return list(self._db.keys())
+
+    def stats(self) -> dict:
+        return {
+            "issuers": len(self._db),
+            "pinned": len(self._pinned),
+            "evictions": self.evictions,
+            "expired": self.expired
+        }
@@ -0,0 +1,62 @@
+from typing import Optional
+from typing import Union
+
+from cryptojwt import as_unicode
+from cryptojwt.jws.jws import factory
+
+
+class SignedToken(str):
+    """
+    A signed JWT in compact serialization that remembers what it looks like parsed.
+    Since it's a string it can be used, stored and compared like one. The header and payload
+    are decoded the first time they are needed and never again.
+    """
+
+    @property
+    def jws(self):
+        """
+        A :py:class:`cryptojwt.jws.jws.JWS` instance with the token unpacked or None if this
+        is not a signed JWT.
+        """
+        try:
+            return self._jws
+        except AttributeError:
+            self._jws = factory(str(self))
+            return self._jws
+
+    def _jwt(self):
+        _jws = self.jws
+        if not _jws:
+            raise ValueError(f"Not a proper signed JWT: {str(self)}")
+        return _jws.jwt
+
+    @property
+    def header(self) -> dict:
+        return self._jwt().headers
+
+    @property
+    def payload(self) -> dict:
+        """The decoded payload. It's shared by all users of the token so must not be modified."""
+        try:
+            return self._payload
+        except AttributeError:
+            self._payload = self._jwt().payload()
+            return self._payload
+
+    @property
+    def signing_input(self) -> bytes:
+        return b".".join(self._jwt().b64part[:2])
+
+    def __reduce__(self):
+        # Parsed information is not copied, it's rebuilt when needed
+        return self.__class__, (str(self),)
+
+
+def signed_token(token: Union[str, bytes, SignedToken]) -> Optional[SignedToken]:
+    """
+    :param token: A signed JWT
+    :return: The same token as a SignedToken instance
+    """
+    if isinstance(token, SignedToken) or token is None:
+        return token
+    return SignedToken(as_unicode(token))
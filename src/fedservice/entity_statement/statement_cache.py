@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable
+from typing import List
+from typing import Optional
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity_statement.signed_token import signed_token
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*parts) -> str:
+    """
+    :param parts: JSON serializable pieces of information
+    :return: A digest that changes if any of the pieces change
+    """
+    _json = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(_json.encode("utf-8")).hexdigest()
+
+
+class SignedStatementCache(object):
+    """
+    Signed statements, one per issuer and subject, kept so they don't have to be signed again
+    for every request. A statement is signed anew when what went into it has changed, which is
+    found out by comparing fingerprints of the information, or when it's about to expire.
+    """
+
+    def __init__(self, refresh_before: Optional[int] = 3600, max_entries: Optional[int] = 0,
+                 max_versions: Optional[int] = 1000, **kwargs):
+        """
+        :param refresh_before: A statement that expires within this many seconds is signed anew
+        :param max_entries: The maximum number of statements kept. 0 means no limit.
+        :param max_versions: The maximum number of versions remembered for statements that
+            have been evicted or invalidated. If it's forgotten the version starts over at 1.
+        """
+        self.refresh_before = refresh_before
+        self.max_entries = max_entries
+        self.max_versions = max_versions
+        # (issuer, subject) -> {"jws", "exp", "fingerprint", "version"}
+        self._db = {}
+        # (issuer, subject) -> version of a statement that is no longer kept, least recently
+        # removed first
+        self._version = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.signed = 0
+        self.changed = 0
+        self.expiring = 0
+        self.invalidated = 0
+
+    def get(self, iss: str, sub: str, fingerprint: str) -> Optional[str]:
+        """
+        :return: The signed statement if it's still usable, otherwise None
+        """
+        with self._lock:
+            _record = self._db.get((iss, sub))
+            if _record is None:
+                return None
+            if _record["fingerprint"] != fingerprint:
+                self.changed += 1
+                return None
+            if _record["exp"] - utc_time_sans_frac() <= self.refresh_before:
+                self.expiring += 1
+                return None
+            self.hits += 1
+            return _record["jws"]
+
+    def add(self, iss: str, sub: str, fingerprint: str, jws: str):
+        _record = {"jws": jws, "exp": signed_token(jws).payload["exp"], "fingerprint": fingerprint}
+        with self._lock:
+            _old = self._db.pop((iss, sub), None)
+            if _old:
+                _record["version"] = _old["version"] + 1
+            else:
+                _record["version"] = self._version.pop((iss, sub), 0) + 1
+            self._db[(iss, sub)] = _record
+            self.signed += 1
+            while self.max_entries and len(self._db) > self.max_entries:
+                # The one that was signed the longest time ago
+                self._remove(next(iter(self._db)))
+
+    def _remove(self, key: tuple):
+        # The version is kept so it keeps increasing if the statement is signed again
+        self._version[key] = self._db.pop(key)["version"]
+        while len(self._version) > self.max_versions:
+            self._version.popitem(last=False)
+
+    def version(self, iss: str, sub: str) -> int:
+        """
+        :return: The version of the signed statement in use, it's increased every time the
+            statement is signed. 0 if there is none.
+        """
+        _record = self._db.get((iss, sub))
+        if _record is None:
+            return 0
+        return _record["version"]
+
+    def __call__(self, iss: str, sub: str, fingerprint: str, sign: Callable[[], str]) -> str:
+        """
+        :param iss: The issuer of the statement
+        :param sub: The subject of the statement
+        :param fingerprint: Fingerprint of the information the statement is built from
+        :param sign: Creates and signs the statement
+        :return: A signed statement
+        """
+        jws = self.get(iss, sub, fingerprint)
+        if jws is None:
+            jws = sign()
+            self.add(iss, sub, fingerprint, jws)
+        return jws
+
+    def invalidate(self, sub: Optional[str] = "", iss: Optional[str] = "") -> List[tuple]:
+        """
+        Remove signed statements so they are signed anew the next time they are asked for.
+        Without arguments all statements are removed.
+
+        :param sub: Only statements about this subject
+        :param iss: Only statements issued by this issuer
+        :return: The (issuer, subject) pairs of the removed statements
+        """
+        with self._lock:
+            res = [_key for _key in self._db
+                   if (not iss or _key[0] == iss) and (not sub or _key[1] == sub)]
+            for _key in res:
+                self._remove(_key)
+            self.invalidated += len(res)
+        if res:
+            logger.debug(f"Signed statements invalidated: {res}")
+        return res
+
+    def __len__(self):
+        return len(self._db)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "signed": self.signed,
+            "changed": self.changed,
+            "expiring": self.expiring,
+            "invalidated": self.invalidated,
+            "entries": len(self._db)
+        }
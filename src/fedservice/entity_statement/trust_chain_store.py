@@ -0,0 +1,317 @@
+import json
+import logging
+import threading
+from typing import List
+from typing import Optional
+from typing import Union
+
+from cryptojwt.jwt import utc_time_sans_frac
+
+from fedservice.entity_statement.backend import CacheBackend
+from fedservice.entity_statement.backend import DictBackend
+from fedservice.entity_statement.backend import make_backend
+from fedservice.entity_statement.statement import TrustChain
+
+logger = logging.getLogger(__name__)
+
+
+def _hops(trust_chain: TrustChain) -> List[tuple]:
+    # The (issuer, subject) pairs of the statements in the chain. The entity's own
+    # configuration is (entity ID, entity ID).
+    _path = trust_chain.iss_path
+    res = [(_path[0], _path[0])]
+    for i in range(len(_path) - 1):
+        res.append((_path[i + 1], _path[i]))
+    return res
+
+
+class TrustChainStore(object):
+    """
+    Verified trust chains per entity ID and trust anchor. Behaves like the dictionary
+    :py:attr:`fedservice.entity.FederationEntity.trust_chain` once was, with the difference
+    that trust chains that have expired are never handed out.
+
+    If the store is bounded, by the number of entities and/or the total size of the trust chains,
+    room is made for new trust chains by first removing expired ones and then those least
+    recently used. With a backend that is shared between processes a trust chain verified by
+    one of them can be used by all.
+
+    Each record says which trust anchors its trust chains end in and who issued the statements
+    in them. With a dictionary as backend the entity IDs are also indexed by issuer, so
+    invalidating the trust chains that contain a statement doesn't have to look at all of them.
+    """
+
+    def __init__(self,
+                 backend: Optional[Union[dict, CacheBackend]] = None,
+                 max_entries: Optional[int] = 0,
+                 max_bytes: Optional[int] = 0):
+        """
+        :param backend: Either a CacheBackend instance or a specification with class and kwargs.
+        :param max_entries: The maximum number of entities whose trust chains are kept.
+            0 means no limit.
+        :param max_bytes: The maximum total size of the trust chains kept. 0 means no limit.
+        """
+        self.backend = make_backend(backend, "trust_chain")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # In a dictionary the TrustChain instances themselves are kept, otherwise their dumps
+        self._objects = isinstance(self.backend, DictBackend)
+        # issuer -> entity IDs with trust chains containing a statement by the issuer. Only
+        # kept when no one else can change the backend.
+        self._by_issuer = {} if self._objects else None
+        self.evictions = 0
+        self.expired = 0
+        self.invalidated = 0
+        self._lock = threading.RLock()
+
+    def _record(self, trust_chains: List[TrustChain]) -> dict:
+        _dumps = [_chain.dump() for _chain in trust_chains]
+        if self._objects:
+            _value = list(trust_chains)
+            _size = len(json.dumps(_dumps)) if self.max_bytes else 0
+        else:
+            _value = _dumps
+            _size = len(json.dumps(_dumps))
+        # Kept as long as one of the trust chains is valid
+        _exp = [_chain.exp for _chain in trust_chains]
+        # trust anchor -> position of the trust chain that ends in it
+        _anchors = {}
+        for i, _chain in enumerate(trust_chains):
+            _anchors.setdefault(_chain.anchor, i)
+        _issuers = {_hop[0] for _chain in trust_chains for _hop in _hops(_chain)}
+        return {
+            "value": _value,
+            "exp": max(_exp) if _exp and all(_exp) else None,
+            "size": _size,
+            "anchors": _anchors,
+            "issuers": sorted(_issuers)
+        }
+
+    def _chains(self, record: dict) -> List[TrustChain]:
+        if self._objects:
+            return list(record["value"])
+        return [TrustChain().load(_info) for _info in record["value"]]
+
+    def _chain(self, record: dict, position: int) -> TrustChain:
+        if self._objects:
+            return record["value"][position]
+        return TrustChain().load(record["value"][position])
+
+    def _index(self, entity_id: str, old: Optional[dict], new: Optional[dict]):
+        if self._by_issuer is None:
+            return
+        for issuer in (old or {}).get("issuers", []):
+            _entity_ids = self._by_issuer.get(issuer)
+            if _entity_ids is not None:
+                _entity_ids.discard(entity_id)
+                if not _entity_ids:
+                    del self._by_issuer[issuer]
+        for issuer in (new or {}).get("issuers", []):
+            self._by_issuer.setdefault(issuer, set()).add(entity_id)
+
+    def _set(self, entity_id: str, record: dict):
+        with self._lock:
+            if self._by_issuer is not None:
+                self._index(entity_id, self.backend.get(entity_id), record)
+            self.backend.set(entity_id, record)
+
+    def _delete(self, entity_id: str) -> Optional[dict]:
+        with self._lock:
+            _record = self.backend.delete(entity_id)
+            self._index(entity_id, _record, None)
+            return _record
+
+    def __setitem__(self, entity_id: str, trust_chains: List[TrustChain]):
+        with self._lock:
+            self._set(entity_id, self._record(trust_chains))
+            self._make_room(keep=entity_id)
+
+    def update(self, entity_id: str, trust_chains: List[TrustChain]):
+        """
+        Add trust chains for an entity. Already stored trust chains that end in another
+        trust anchor are kept.
+        """
+        _anchors = {_chain.anchor for _chain in trust_chains}
+        with self._lock:
+            _kept = [_chain for _chain in self.get(entity_id, []) if _chain.anchor not in _anchors]
+            self[entity_id] = _kept + list(trust_chains)
+
+    def _over_limit(self) -> bool:
+        if self.max_entries and len(self.backend) > self.max_entries:
+            return True
+        if self.max_bytes and self.backend.size() > self.max_bytes:
+            return True
+        return False
+
+    def _make_room(self, keep: Optional[str] = None):
+        if not self._over_limit():
+            return
+
+        for entity_id in self.backend.expired(utc_time_sans_frac()):
+            if entity_id != keep and self._delete(entity_id) is not None:
+                self.expired += 1
+
+        while self._over_limit():
+            entity_id = self.backend.least_recently_used()
+            if entity_id is None or entity_id == keep:
+                break
+            self._delete(entity_id)
+            self.evictions += 1
+
+    def get(self, entity_id: str, default: Optional[list] = None) -> Optional[List[TrustChain]]:
+        """
+        :return: The trust chains for the entity that have not expired
+        """
+        with self._lock:
+            _record = self.backend.get(entity_id)
+            if _record is None:
+                return default
+            _trust_chains = self._chains(_record)
+            _now = utc_time_sans_frac()
+            _live = [_chain for _chain in _trust_chains if not _chain.exp or _chain.exp > _now]
+            if _trust_chains and not _live:
+                self._delete(entity_id)
+                self.expired += 1
+                return default
+            if len(_live) != len(_trust_chains):
+                self._set(entity_id, self._record(_live))
+            else:
+                self.backend.touch(entity_id)
+            return _live
+
+    def get_trust_chain(self, entity_id: str, anchor: str) -> Optional[TrustChain]:
+        """
+        :return: The entity's trust chain that ends in the trust anchor
+        """
+        with self._lock:
+            _record = self.backend.get(entity_id)
+            if _record is None:
+                return None
+            if "anchors" not in _record:
+                # Stored before the trust anchors were recorded
+                for _chain in self.get(entity_id, []):
+                    if _chain.anchor == anchor:
+                        return _chain
+                return None
+
+            _position = _record["anchors"].get(anchor)
+            if _position is None:
+                return None
+            _chain = self._chain(_record, _position)
+            if _chain.exp and _chain.exp <= utc_time_sans_frac():
+                # Weeds out the expired trust chains
+                self.get(entity_id)
+                return None
+            self.backend.touch(entity_id)
+            return _chain
+
+    def __getitem__(self, entity_id: str) -> List[TrustChain]:
+        _trust_chains = self.get(entity_id)
+        if _trust_chains is None:
+            raise KeyError(entity_id)
+        return _trust_chains
+
+    def pop(self, entity_id: str, default: Optional[list] = None) -> Optional[List[TrustChain]]:
+        _record = self._delete(entity_id)
+        if _record is None:
+            return default
+        return self._chains(_record)
+
+    def __delitem__(self, entity_id: str):
+        if self._delete(entity_id) is None:
+            raise KeyError(entity_id)
+
+    def __contains__(self, entity_id: str):
+        return self.get(entity_id) is not None
+
+    def __len__(self):
+        return len(self.backend)
+
+    def keys(self) -> List[str]:
+        return self.backend.keys()
+
+    def items(self) -> List[tuple]:
+        res = []
+        for entity_id in self.backend.keys():
+            _trust_chains = self.get(entity_id)
+            if _trust_chains is not None:
+                res.append((entity_id, _trust_chains))
+        return res
+
+    def invalidate(self, issuer: str, subject: Optional[str] = "") -> List[str]:
+        """
+        Remove the trust chains that contain a statement that has changed.
+
+        :param issuer: The issuer of the statement
+        :param subject: The subject of the statement. If not given every trust chain with a
+            statement issued by the issuer is removed.
+        :return: The entity IDs that lost trust chains
+        """
+        res = []
+        with self._lock:
+            if self._by_issuer is None:
+                _entity_ids = self.backend.keys()
+            else:
+                _entity_ids = list(self._by_issuer.get(issuer, []))
+            for entity_id in _entity_ids:
+                _record = self.backend.get(entity_id)
+                if _record is None or issuer not in _record.get("issuers", [issuer]):
+                    continue
+                _trust_chains = self._chains(_record)
+                _kept = []
+                for _chain in _trust_chains:
+                    _match = [_hop for _hop in _hops(_chain) if _hop[0] == issuer and (
+                            not subject or _hop[1] == subject)]
+                    if not _match:
+                        _kept.append(_chain)
+                if len(_kept) == len(_trust_chains):
+                    continue
+                if _kept:
+                    self._set(entity_id, self._record(_kept))
+                else:
+                    self._delete(entity_id)
+                res.append(entity_id)
+            self.invalidated += len(res)
+        if res:
+            logger.debug(f"Trust chains invalidated for: {res}")
+        return res
+
+    def sweep(self) -> List[str]:
+        """
+        Remove the trust chains that have expired.
+
+        :return: The entity IDs that have no valid trust chains left
+        """
+        res = []
+        _now = utc_time_sans_frac()
+        with self._lock:
+            for entity_id in self.backend.expired(_now):
+                if self._delete(entity_id) is not None:
+                    res.append(entity_id)
+            self.expired += len(res)
+        return res
+
+    def stats(self) -> dict:
+        return {
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "entries": len(self.backend),
+            "bytes": self.backend.size()
+        }
+
+
+def make_trust_chain_store(spec: Optional[Union[dict, TrustChainStore]] = None
+                           ) -> TrustChainStore:
+    """
+    :param spec: Either a backend, a backend specification with class and kwargs, or a
+        dictionary with the arguments to TrustChainStore: backend, max_entries and max_bytes.
+    :return: A TrustChainStore instance
+    """
+    if isinstance(spec, TrustChainStore):
+        return spec
+    if not spec:
+        return TrustChainStore()
+    if isinstance(spec, CacheBackend) or "class" in spec:
+        return TrustChainStore(backend=spec)
+    return TrustChainStore(**spec)
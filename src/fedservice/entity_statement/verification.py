@@ -0,0 +1,145 @@
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List
+from typing import Optional
+from typing import Union
+
+from cryptojwt import JWT
+from cryptojwt import KeyJar
+from cryptojwt.jws.jws import factory
+from cryptojwt.jwt import utc_time_sans_frac
+from idpyoidc.key_import import import_jwks
+
+from fedservice.entity_statement.signed_token import SignedToken
+from fedservice.entity_statement.signed_token import signed_token
+
+logger = logging.getLogger(__name__)
+
+# Used in place of a key thumbprint for statements verified with the keys they carry
+SELF_SIGNED = "self-signed"
+
+
+def key_thumbprint(key) -> str:
+    return key.thumbprint("SHA-256").decode()
+
+
+class VerificationMemo(object):
+    """
+    Remembers which signed statements have been verified with which keys, and what the
+    verified payload was, until the statements expire.
+    A statement issued by a trust anchor about an intermediate is part of the trust chain of
+    every entity below the intermediate but its signature only has to be verified once.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 10000):
+        """
+        :param max_entries: The maximum number of verification results kept. The least recently
+            used are forgotten first.
+        """
+        self.max_entries = max_entries
+        # (token digest, key thumbprint) -> (exp, payload)
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str, thumbprints: List[str]) -> Optional[dict]:
+        """
+        :param token: A signed statement
+        :param thumbprints: Thumbprints of the keys that may have been used to sign the statement
+        :return: A deep copy of the verified payload if the statement has been verified before
+            with one of the keys, otherwise None
+        """
+        _digest = self._digest(token)
+        _now = utc_time_sans_frac()
+        with self._lock:
+            for _thumbprint in thumbprints:
+                _key = (_digest, _thumbprint)
+                _entry = self._db.get(_key)
+                if _entry is None:
+                    continue
+                if _now >= _entry[0]:
+                    del self._db[_key]
+                    continue
+                self._db.move_to_end(_key)
+                self.hits += 1
+                return copy.deepcopy(_entry[1])
+            self.misses += 1
+        return None
+
+    def add(self, token: str, thumbprint: str, payload: dict):
+        """
+        Remember a verified statement. Statements without an expiration time are not
+        remembered. A deep copy of the payload is kept so changes to it don't leak.
+        """
+        _exp = payload.get("exp")
+        if not _exp:
+            return
+        with self._lock:
+            self._db[(self._digest(token), thumbprint)] = (int(_exp), copy.deepcopy(payload))
+            while self.max_entries and len(self._db) > self.max_entries:
+                self._db.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._db.clear()
+
+    def __len__(self):
+        return len(self._db)
+
+
+# Shared by everything that verifies federation statements in the process
+verification_memo = VerificationMemo()
+
+
+def verify_signature(token: Union[str, SignedToken], keys: list,
+                     memo: Optional[VerificationMemo] = None) -> dict:
+    """
+    Verify the signature of a signed statement using one of a set of keys.
+    Raises an exception if the signature can not be verified.
+
+    :param token: Signed JWT
+    :param keys: Keys that may have been used to sign the statement
+    :param memo: Where verification results are remembered
+    :return: The payload of the signed JWT
+    """
+    if memo is None:
+        memo = verification_memo
+    token = signed_token(token)
+    _payload = memo.get(token, [key_thumbprint(k) for k in keys])
+    if _payload is None:
+        # Verifying changes the JWS instance, the cached one may be used by other threads
+        _res = factory(str(token)).verify_compact_verbose(keys=keys)
+        _payload = _res["msg"]
+        memo.add(token, key_thumbprint(_res["key"]), _payload)
+    return _payload
+
+
+def verify_self_signed(token: Union[str, SignedToken],
+                       memo: Optional[VerificationMemo] = None) -> dict:
+    """
+    Verify the signature of a statement using only the keys in the statement.
+    Raises an exception if the signature verification fails.
+
+    :param token: Signed JWT
+    :param memo: Where verification results are remembered
+    :return: The payload of the signed JWT
+    """
+    if memo is None:
+        memo = verification_memo
+    token = signed_token(token)
+    _payload = memo.get(token, [SELF_SIGNED])
+    if _payload is None:
+        payload = token.payload
+        keyjar = KeyJar()
+        keyjar = import_jwks(keyjar, payload['jwks'], payload['iss'])
+        _payload = JWT(key_jar=keyjar).unpack(token)
+        memo.add(token, SELF_SIGNED, _payload)
+    return _payload
@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import logging
+import threading
+import weakref
+from typing import Callable
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# The key in httpc_params under which the connection pool is configured
+POOL_KEY = "pool"
+
+DEFAULT_POOL = {
+    "pool_connections": 10,  # Number of hosts a connection pool is kept for
+    "pool_maxsize": 10,  # Number of connections kept per host
+    "max_retries": 0,
+    "pool_block": False
+}
+
+
+class HTTPSessionPool(object):
+    """
+    A HTTP client with the same call signature as :py:func:`requests.request`.
+    Connections are kept alive and reused so the TCP and TLS handshakes are only done once per
+    connection. Sessions are thread local since a :py:class:`requests.Session` is not thread-safe.
+    All sessions share the same connection pools.
+    """
+
+    def __init__(self,
+                 pool_connections: Optional[int] = 10,
+                 pool_maxsize: Optional[int] = 10,
+                 max_retries: Optional[int] = 0,
+                 pool_block: Optional[bool] = False,
+                 timeout: Optional[Union[float, tuple]] = None,
+                 **kwargs):
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                   max_retries=max_retries, pool_block=pool_block)
+        self.timeout = timeout
+        self._local = threading.local()
+        # Weak references so the session of a thread that has ended can be garbage collected
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        _session = getattr(self._local, "session", None)
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", self.adapter)
+            _session.mount("http://", self.adapter)
+            self._local.session = _session
+            with self._lock:
+                self._sessions.add(_session)
+        return _session
+
+    def __call__(self, method, url, **kwargs):
+        if self.timeout is not None and "timeout" not in kwargs:
+            kwargs["timeout"] = self.timeout
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            _sessions = list(self._sessions)
+            self._sessions = weakref.WeakSet()
+        for _session in _sessions:
+            _session.close()
+        self.adapter.close()
+        self._local = threading.local()
+
+
+class AsyncHTTPClient(object):
+    """
+    An asynchronous HTTP client built on a synchronous one. The requests are run in the
+    default executor of the event loop so they don't block it.
+    """
+
+    def __init__(self, httpc: Optional[Callable] = None, **kwargs):
+        """
+        :param httpc: A HTTP client with the same call signature as :py:func:`requests.request`.
+            If not given a :py:class:`HTTPSessionPool` configured by the keyword arguments is
+            used.
+        """
+        if httpc is None:
+            _pool_conf = DEFAULT_POOL.copy()
+            _pool_conf.update(kwargs)
+            httpc = HTTPSessionPool(**_pool_conf)
+        self.httpc = httpc
+
+    async def __call__(self, method, url, **kwargs):
+        _loop = asyncio.get_running_loop()
+        return await _loop.run_in_executor(
+            None, functools.partial(self.httpc, method, url, **kwargs))
+
+
+def split_httpc_params(httpc_params: Optional[dict]) -> Tuple[Union[dict, bool], dict]:
+    """
+    Separates the connection pool configuration from the arguments that are passed on with
+    every request.
+
+    :param httpc_params: HTTP client parameters
+    :return: Tuple of connection pool configuration (False if pooling is turned off) and request
+        arguments
+    """
+    if not httpc_params:
+        return DEFAULT_POOL.copy(), {}
+
+    _params = dict(httpc_params)
+    _pool = _params.pop(POOL_KEY, None)
+    if _pool is False:
+        return False, _params
+
+    _pool_conf = DEFAULT_POOL.copy()
+    if _pool:
+        _pool_conf.update(_pool)
+    return _pool_conf, _params
+
+
+def make_httpc(pool_conf: Union[dict, bool]):
+    """
+    Creates the HTTP client.
+
+    :param pool_conf: Connection pool configuration. If False connections are not reused.
+    :return: A HTTP client with the same signature as :py:func:`requests.request`
+    """
+    if pool_conf is False:
+        return requests.request
+    return HTTPSessionPool(**pool_conf)
@@ -81,7 +81,10 @@ def build_entity_config(entity_id: str,
                 else:
                     func(args=_args, kwargs_spec=kwargs_spec, **federation_services(*items))
             elif name == "function":
-                func(args=_args, kwargs_spec=kwargs_spec, **federation_functions(*items))
+                if isinstance(items, dict):
+                    func(args=_args, kwargs_spec=kwargs_spec, **items)
+                else:
+                    func(args=_args, kwargs_spec=kwargs_spec, **federation_functions(*items))
             elif name == "endpoint":
                 if isinstance(items, dict):
                     # _filtered_spec = {k: v for k, v in items.items() if k in FEDERATION_ENDPOINTS}
@@ -118,7 +121,10 @@ def make_federation_entity(entity_id: str,
                            persistence: Optional[dict] = None,
                            trust_mark_entity: Optional[dict] = None,
                            client_authn_methods: Optional[list] = None,
-                           self_signed_trust_mark_entity: Optional[dict] = None
+                           self_signed_trust_mark_entity: Optional[dict] = None,
+                           trust_chain_store: Optional[dict] = None,
+                           executor: Optional[dict] = None,
+                           learned_keys: Optional[dict] = None
                            ):
     _config = build_entity_config(
         entity_id=entity_id,
@@ -134,7 +140,9 @@ def make_federation_entity(entity_id: str,
         persistence=persistence
     )
 
-    fe = FederationEntity(client_authn_methods=client_authn_methods, **_config)
+    fe = FederationEntity(client_authn_methods=client_authn_methods,
+                          trust_chain_store=trust_chain_store, executor=executor,
+                          learned_keys=learned_keys, **_config)
     if trust_anchors:
         if "class" in trust_anchors and "kwargs" in trust_anchors:
             trust_anchors = execute(trust_anchors)
@@ -142,7 +150,8 @@ def make_federation_entity(entity_id: str,
         for id, jwk in trust_anchors.items():
             fe.keyjar = import_jwks(fe.keyjar, jwk, id)
 
-        fe.function.trust_chain_collector.trust_anchors = trust_anchors
+        fe.function.trust_chain_collector.trust_anchors = dict(trust_anchors)
+        fe.key_store.pin(*trust_anchors.keys())
 
     if subordinate:
         if "class" in subordinate and "kwargs" in subordinate:
@@ -234,7 +243,8 @@ def make_federation_combo(entity_id: str,
         for id, jwk in trust_anchors.items():
             federation_entity.keyjar = import_jwks(federation_entity.keyjar, jwk, id)
 
-        federation_entity.function.trust_chain_collector.trust_anchors = trust_anchors
+        federation_entity.function.trust_chain_collector.trust_anchors = dict(trust_anchors)
+        federation_entity.key_store.pin(*trust_anchors.keys())
 
     if subordinate:
         if "class" in subordinate and "kwargs" in subordinate:
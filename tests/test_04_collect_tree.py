@@ -0,0 +1,101 @@
+from collections import Counter
+
+from cryptojwt import KeyJar
+import pytest
+
+from fedservice.entity.function import tree2chains
+from fedservice.entity.function.trust_chain_collector import TrustChainCollector
+
+LEAF = "https://example.com/rp"
+IM1 = "https://example.com/intermediate1"
+IM2 = "https://example.com/intermediate2"
+IM3 = "https://example.com/intermediate3"
+TA = "https://example.com/anchor"
+
+
+class GraphCollector(TrustChainCollector):
+    """Collects from an in-memory federation. Entity statements are just strings."""
+
+    def __init__(self, superiors, **kwargs):
+        TrustChainCollector.__init__(self, upstream_get=None, trust_anchors={},
+                                     keyjar=KeyJar(), **kwargs)
+        self.config_cache = {
+            _id: {"iss": _id, "authority_hints": _hints} for _id, _hints in superiors.items()
+        }
+        self.visited = Counter()
+
+    def _get_entity_statement(self, entity, authority):
+        return f"{authority}:{entity}"
+
+    def collect_tree(self, entity_id, entity_configuration, **kwargs):
+        self.visited[entity_id] += 1
+        return TrustChainCollector.collect_tree(self, entity_id, entity_configuration, **kwargs)
+
+
+DIAMOND = {
+    LEAF: [IM1, IM2],
+    IM1: [IM3],
+    IM2: [IM3],
+    IM3: [TA],
+    TA: []
+}
+
+
+@pytest.mark.parametrize("max_workers", [0, 4])
+def test_diamond_collected_once(max_workers):
+    _collector = GraphCollector(DIAMOND, max_workers=max_workers)
+    _tree = _collector.collect_tree(LEAF, _collector.config_cache[LEAF])
+
+    if not max_workers:
+        # Concurrent branches may both get to IM3 before either is done with it
+        assert _collector.visited[IM3] == 1
+        assert _collector.visited[TA] == 1
+
+    _chains = tree2chains(_tree)
+    assert sorted(_chains) == sorted([
+        [f"{TA}:{IM3}", f"{IM3}:{IM1}", f"{IM1}:{LEAF}"],
+        [f"{TA}:{IM3}", f"{IM3}:{IM2}", f"{IM2}:{LEAF}"],
+    ])
+
+
+def test_loop_is_cut():
+    # IM1 and IM2 claim each other as superiors
+    _superiors = {
+        LEAF: [IM1],
+        IM1: [IM2, TA],
+        IM2: [IM1, TA],
+        TA: []
+    }
+    _collector = GraphCollector(_superiors)
+    _tree = _collector.collect_tree(LEAF, _collector.config_cache[LEAF])
+
+    _chains = tree2chains(_tree)
+    assert sorted(_chains) == sorted([
+        [f"{TA}:{IM1}", f"{IM1}:{LEAF}"],
+        [f"{TA}:{IM2}", f"{IM2}:{IM1}", f"{IM1}:{LEAF}"],
+    ])
+
+
+def test_partial_subtree_not_reused():
+    # IM2's view from IM1 has the loop back to IM1 cut, reached directly it must not
+    _superiors = {
+        LEAF: [IM1, IM2],
+        IM1: [IM2, TA],
+        IM2: [IM1, TA],
+        TA: []
+    }
+    _collector = GraphCollector(_superiors)
+    _tree = _collector.collect_tree(LEAF, _collector.config_cache[LEAF])
+
+    _chains = tree2chains(_tree)
+    assert [f"{TA}:{IM1}", f"{IM1}:{IM2}", f"{IM2}:{LEAF}"] in _chains
+    assert [f"{TA}:{IM2}", f"{IM2}:{IM1}", f"{IM1}:{LEAF}"] in _chains
+    assert len(_chains) == 4
+
+
+def test_add_trust_anchor_to_empty_keyjar():
+    _collector = GraphCollector(DIAMOND)
+    _jwks = {"keys": [{"kty": "oct", "k": "c2VjcmV0", "kid": "k1"}]}
+    _collector.add_trust_anchor(TA, _jwks)
+    assert TA in _collector.keyjar
+    assert _collector.trust_anchors == {TA: _jwks}
@@ -2,7 +2,10 @@ from cryptojwt.jwt import utc_time_sans_frac
 import pytest
 
 from fedservice.entity_statement.constraints import calculate_path_length
+from fedservice.entity_statement.constraints import DomainTrie
 from fedservice.entity_statement.constraints import excluded
+from fedservice.entity_statement.constraints import meets_restrictions
+from fedservice.entity_statement.constraints import more_specific
 from fedservice.entity_statement.constraints import permitted
 from fedservice.entity_statement.constraints import update_naming_constraints
 from fedservice.exception import UnknownCriticalExtension
@@ -229,8 +232,50 @@ def test_naming_excluded_1():
     assert excluded('https://foo.example.org', naming_constraints['excluded']) == True
 
 
+SPECS = ["https://.example.com", "https://example.com", "https://foo.example.com",
+         "https://.foo.example.com", "https://bar.example.org", "https://.org", "https://"]
+
+ENTITY_IDS = ["https://example.com", "https://foo.example.com", "https://a.foo.example.com",
+              "https://bar.example.org", "https://example.org", "https://foo.example.net",
+              "https://a.b.c.example.com"]
+
+
+def test_domain_trie_same_as_more_specific():
+    _trie = DomainTrie(SPECS)
+    for entity_id in ENTITY_IDS:
+        _expected = [i for i, spec in enumerate(SPECS) if more_specific(entity_id, spec)]
+        assert _trie.matching(entity_id) == _expected
+        assert _trie.match(entity_id) == bool(_expected)
+
+
+def _statement(iss, sub, naming_constraints=None):
+    _statement = {"iss": iss, "sub": sub}
+    if naming_constraints:
+        _statement["constraints"] = {"naming_constraints": naming_constraints}
+    return _statement
+
+
 def test_meets_restriction():
-    pass
+    _ta = "https://ta.example.org"
+    _im = "https://im.example.com"
+    _chain = [
+        _statement(_ta, _im, {"permitted": ["https://.example.com"],
+                              "excluded": ["https://bad.example.com"]}),
+        _statement(_im, "https://rp.example.com", {"permitted": ["https://rp.example.com"]}),
+        _statement("https://rp.example.com", "https://rp.example.com")
+    ]
+    assert meets_restrictions(_chain)
+
+    _chain[1]["sub"] = _chain[2]["sub"] = "https://bad.example.com"
+    assert meets_restrictions(_chain) is False
+
+    # The intermediate can only make the permitted more specific
+    _chain = [
+        _statement(_ta, _im, {"permitted": ["https://.example.com"]}),
+        _statement(_im, "https://rp.example.org", {"permitted": ["https://.example.org"]}),
+        _statement("https://rp.example.org", "https://rp.example.org")
+    ]
+    assert meets_restrictions(_chain) is False
 
 
 def test_crit_known_unknown():
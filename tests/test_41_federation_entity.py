@@ -8,12 +8,14 @@ from fedservice import get_trust_chain
 from fedservice import save_trust_chains
 from fedservice.entity.function import collect_trust_chains
 from fedservice.entity.function import get_verified_trust_chains
+from fedservice.entity.function import tree2chains
 from fedservice.entity.function import verify_trust_chains
 from fedservice.entity.function.policy import TrustChainPolicy
 from fedservice.entity.function.trust_chain_collector import TrustChainCollector
 from fedservice.entity.function.trust_chain_collector import verify_self_signed_signature
 from fedservice.entity.function.trust_mark_verifier import TrustMarkVerifier
 from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity_statement.cache import ESCache
 from fedservice.message import EntityStatement
 from fedservice.message import ResolveResponse
 from tests import create_trust_chain_messages
@@ -352,6 +354,41 @@ class TestFunction:
         _trust_chains = verify_trust_chains(_federation_entity, _chains, _entity_conf)
         assert len(_trust_chains) == 2
 
+    def test_trust_chains_concurrent_collection(self):
+        _federation_entity = self.leaf
+        _collector = _federation_entity["federation_entity"].function.trust_chain_collector
+
+        _msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        _msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _serial_tree, _ = _collector(self.leaf.entity_id)
+
+        # Start from scratch and collect the same tree concurrently
+        _collector.config_cache = ESCache(allowed_delta=_collector.allowed_delta)
+        _collector.entity_statement_cache = ESCache(allowed_delta=_collector.allowed_delta)
+        _collector.max_workers = 4
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            _tree, _ = _collector(self.leaf.entity_id)
+
+        assert list(_tree.keys()) == [INTERMEDIATE_ID, TA2_ID]
+        assert _tree == _serial_tree
+
+        _chains = tree2chains(_tree)
+        assert len(_chains) == 2
+        _trust_chains = verify_trust_chains(_federation_entity, _chains,
+                                            _collector.config_cache[LEAF_ID]["_jws"])
+        assert len(_trust_chains) == 2
+
     def test_upstream_context_attribute(self):
         leaf_fe = self.leaf["federation_entity"]
         assert leaf_fe.client.upstream_get('context_attribute', 'entity_id') == LEAF_ID
@@ -390,7 +427,9 @@ class TestFunction:
         federation_context = self.leaf["federation_entity"].context
         save_trust_chains(federation_context, _trust_chains)
         assert set(federation_context.trust_chain.keys()) == {LEAF_ID}
-        assert set(federation_context.trust_chain[LEAF_ID].keys()) == {TA1_ID, TA2_ID}
+        assert {_tc.anchor for _tc in federation_context.trust_chain[LEAF_ID]} == {TA1_ID, TA2_ID}
+        # The federation entity's store
+        assert federation_context.trust_chain is self.leaf["federation_entity"].trust_chain
 
         trust_chain = get_trust_chain(federation_context, LEAF_ID, TA1_ID)
         assert trust_chain
@@ -0,0 +1,227 @@
+import asyncio
+import copy
+
+from cryptojwt.jws.jws import factory
+from idpyoidc.exception import MissingPage
+import pytest
+
+from fedservice.defaults import FEDERATION_ENTITY_FUNCTIONS
+from fedservice.entity.function import _get_async_collector
+from fedservice.entity.function import async_collect_trust_chains
+from fedservice.entity.function import async_get_verified_trust_chains
+from fedservice.entity.function import async_verify_trust_chains
+from fedservice.entity.function.async_trust_chain_collector import AsyncTrustChainCollector
+from fedservice.httpc import AsyncHTTPClient
+from tests import create_trust_chain_messages
+from tests.build_federation import build_federation
+
+TA1_ID = "https://ta.example.org"
+TA2_ID = "https://2nd.ta.example.org"
+LEAF_ID = "https://rp.example.org"
+INTERMEDIATE_ID = "https://intermediate.example.org"
+
+FEDERATION_CONFIG = {
+    TA1_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [INTERMEDIATE_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The 1st example federation operator",
+                "homepage_uri": "https://ta_one.example.org",
+                "contacts": "operations@ta_one.example.org"
+            },
+        }
+    },
+    TA2_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The 2nd example federation operator",
+                "homepage_uri": "https://ta_two.example.org",
+                "contacts": "operations@ta_two.example.org"
+            },
+        }
+    },
+    INTERMEDIATE_ID: {
+        "entity_type": "intermediate",
+        "trust_anchors": [TA1_ID],
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "authority_hints": [TA1_ID],
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA1_ID, TA2_ID],
+        "kwargs": {
+            "authority_hints": [INTERMEDIATE_ID, TA2_ID]
+        }
+    }
+}
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+def stub_transport(documents, calls):
+    async def httpc(method, url, **kwargs):
+        # give other tasks a chance to run
+        await asyncio.sleep(0)
+        calls.append(url)
+        _url = url.split("?")[0]
+        if _url in documents:
+            return StubResponse(200, documents[_url],
+                                {"Content-Type": "application/entity-statement+jwt"})
+        return StubResponse(404)
+
+    return httpc
+
+
+class TestAsyncCollection:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        #       TA1     TA2_ID
+        #       |      |
+        #      IM      |
+        #       \      |
+        #        +--- LEAF
+
+        self.federation_entity = build_federation(copy.deepcopy(FEDERATION_CONFIG))
+        self.ta1 = self.federation_entity[TA1_ID]
+        self.ta2 = self.federation_entity[TA2_ID]
+        self.leaf = self.federation_entity[LEAF_ID]
+        self.intermediate = self.federation_entity[INTERMEDIATE_ID]
+
+        self.msgs = create_trust_chain_messages(self.leaf, self.intermediate, self.ta1)
+        self.msgs.update(create_trust_chain_messages(self.leaf, self.ta2))
+
+    def test_collect_and_verify(self):
+        _calls = []
+        _httpc = stub_transport(self.msgs, _calls)
+
+        async def run():
+            _chains, _entity_conf = await async_collect_trust_chains(self.leaf, LEAF_ID,
+                                                                     httpc=_httpc)
+            _trust_chains = await async_verify_trust_chains(self.leaf, _chains, _entity_conf)
+            return _chains, _entity_conf, _trust_chains
+
+        _chains, _entity_conf, _trust_chains = asyncio.run(run())
+
+        assert _calls
+        _jws = factory(_entity_conf)
+        assert _jws.jwt.payload()['iss'] == LEAF_ID
+        assert len(_chains) == 2
+        assert len(_trust_chains) == 2
+        assert {tc.anchor for tc in _trust_chains} == {TA1_ID, TA2_ID}
+
+    def test_get_verified_trust_chains_concurrently(self):
+        _calls = []
+        _httpc = stub_transport(self.msgs, _calls)
+
+        async def run():
+            return await asyncio.gather(
+                async_get_verified_trust_chains(self.leaf, LEAF_ID, httpc=_httpc),
+                async_get_verified_trust_chains(self.intermediate, LEAF_ID, httpc=_httpc)
+            )
+
+        _leaf_chains, _im_chains = asyncio.run(run())
+        assert len(_leaf_chains) == 2
+        # The intermediate only trusts TA1
+        assert len(_im_chains) == 1
+        assert _im_chains[0].iss_path == [LEAF_ID, INTERMEDIATE_ID, TA1_ID]
+        assert _im_chains[0].metadata
+
+    def test_missing_page(self):
+        _calls = []
+        _httpc = stub_transport({}, _calls)
+
+        with pytest.raises(MissingPage):
+            asyncio.run(async_collect_trust_chains(self.leaf, LEAF_ID, httpc=_httpc))
+
+    def _async_collector(self, **kwargs):
+        _upstream_get = self.leaf["federation_entity"].function.trust_chain_collector.upstream_get
+        return AsyncTrustChainCollector(upstream_get=_upstream_get, **kwargs)
+
+    def test_default_httpc(self):
+        _collector = self._async_collector(
+            **FEDERATION_ENTITY_FUNCTIONS["async_trust_chain_collector"]["kwargs"])
+        assert isinstance(_collector.httpc, AsyncHTTPClient)
+
+    def test_single_flight(self):
+        _calls = []
+        _collector = self._async_collector(httpc=stub_transport(self.msgs, _calls))
+        _url = f"{TA1_ID}/.well-known/openid-federation"
+
+        async def run():
+            return await asyncio.gather(*[_collector.get_document(_url) for _ in range(3)])
+
+        _documents = asyncio.run(run())
+        assert len(set(_documents)) == 1
+        assert _calls == [_url]
+        assert _collector.shared == 2
+
+    def test_negative_cache(self):
+        _calls = []
+        _collector = self._async_collector(httpc=stub_transport({}, _calls))
+        _url = f"{TA1_ID}/.well-known/openid-federation"
+
+        for _ in range(2):
+            with pytest.raises(MissingPage):
+                asyncio.run(_collector.get_document(_url))
+        assert _calls == [_url]
+        assert _collector.collector.negative_cache.get(_url)
+
+    def test_collector_reused_per_httpc(self):
+        _calls = []
+        _httpc = stub_transport(self.msgs, _calls)
+        _federation_entity = self.leaf["federation_entity"]
+        _collector = _get_async_collector(_federation_entity, _httpc)
+        assert _get_async_collector(_federation_entity, _httpc) is _collector
+        assert _get_async_collector(_federation_entity, stub_transport({}, [])) is not _collector
+
+        _url = f"{TA1_ID}/.well-known/openid-federation"
+
+        async def run():
+            return await asyncio.gather(
+                *[_get_async_collector(_federation_entity, _httpc).get_document(_url)
+                  for _ in range(3)])
+
+        asyncio.run(run())
+        assert _calls == [_url]
+
+    def test_in_flight_per_event_loop(self):
+        _calls = []
+        _httpc = stub_transport(self.msgs, _calls)
+        _loop = asyncio.new_event_loop()
+        _blocked = _loop.create_future()
+
+        async def httpc(method, url, **kwargs):
+            # The request in the first event loop never finishes
+            if asyncio.get_running_loop() is _loop:
+                await _blocked
+            return await _httpc(method, url, **kwargs)
+
+        _collector = self._async_collector(httpc=httpc)
+        _url = f"{TA1_ID}/.well-known/openid-federation"
+
+        try:
+            _pending = _loop.create_task(_collector.get_document(_url))
+            _loop.run_until_complete(asyncio.sleep(0.01))
+            assert not _pending.done()
+
+            # Another event loop does not wait for it but makes a request of its own
+            assert asyncio.run(_collector.get_document(_url)) == self.msgs[_url]
+            assert _calls == [_url]
+        finally:
+            _tasks = asyncio.all_tasks(_loop)
+            for _task in _tasks:
+                _task.cancel()
+            _loop.run_until_complete(asyncio.gather(*_tasks, return_exceptions=True))
+            _loop.close()
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+from idpyoidc.exception import MissingPage
+
+from fedservice.entity.function.single_flight import SingleFlight
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.org",
+                "contacts": "operations@ta.example.org"
+            },
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "authority_hints": [TA_ID]
+        }
+    }
+}
+
+
+def run_concurrently(func, n):
+    res = [None] * n
+    err = [None] * n
+
+    def _run(i):
+        try:
+            res[i] = func()
+        except Exception as exc:
+            err[i] = exc
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return res, err
+
+
+def test_single_flight_shares_result():
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return "result"
+
+    single_flight = SingleFlight()
+    res, err = run_concurrently(lambda: single_flight.do("key", work), 5)
+    assert res == ["result"] * 5
+    assert err == [None] * 5
+    assert len(calls) == 1
+    assert single_flight.shared == 4
+    assert single_flight.in_flight() == []
+
+
+def test_single_flight_shares_exception():
+    def work():
+        time.sleep(0.2)
+        raise MissingPage("No such page")
+
+    single_flight = SingleFlight()
+    res, err = run_concurrently(lambda: single_flight.do("key", work), 3)
+    assert res == [None] * 3
+    assert all(isinstance(e, MissingPage) for e in err)
+    # Each waiter gets an exception of its own, chained to the one the first caller got
+    assert len({id(e) for e in err}) == 3
+    _leader = [e for e in err if e.__cause__ is None]
+    assert len(_leader) == 1
+    assert all(e.__cause__ is _leader[0] for e in err if e is not _leader[0])
+
+
+class Response(object):
+
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class TestCollector:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        self.federation_entity = build_federation(FEDERATION_CONFIG)
+        self.ta = self.federation_entity[TA_ID]
+        self.leaf = self.federation_entity[LEAF_ID]
+
+    def test_coalesced_entity_configuration(self):
+        _endpoint = self.ta.server.get_endpoint('entity_configuration')
+        _ec = _endpoint.process_request({})["response"]
+        calls = []
+
+        def httpc(method, url, **kwargs):
+            calls.append(url)
+            time.sleep(0.2)
+            return Response(200, _ec, {"Content-Type": "application/entity-statement+jwt"})
+
+        _federation_entity = self.leaf["federation_entity"]
+        # The collector gets the HTTP client from the function collection
+        _federation_entity.function.httpc = httpc
+        _collector = _federation_entity.function.trust_chain_collector
+
+        res, err = run_concurrently(lambda: _collector.get_entity_configuration(TA_ID), 5)
+        assert err == [None] * 5
+        assert res == [_ec] * 5
+        assert calls == ['https://ta.example.org/.well-known/openid-federation']
@@ -0,0 +1,150 @@
+import pytest
+from idpyoidc.exception import MissingPage
+from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+
+from fedservice.entity_statement import cache
+from fedservice.entity_statement.cache import NegativeCache
+from fedservice.exception import FailedConfigurationRetrieval
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+IM_ID = "https://intermediate.example.org"
+LEAF_ID = "https://rp.example.org"
+
+
+class TestNegativeCache:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.now = 1000
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: self.now)
+        self.cache = NegativeCache(ttl={"MissingPage": 100}, default_ttl=10, max_ttl=500)
+
+    def test_ttl_per_error_type(self):
+        assert self.cache.error_ttl(MissingPage()) == 100
+        assert self.cache.error_ttl(FailedConfigurationRetrieval()) == 60
+        # subclass of requests ConnectionError
+        assert self.cache.error_ttl(ConnectTimeout()) == 30
+        assert self.cache.error_ttl(ValueError()) == 10
+
+    def test_backoff(self):
+        url = "https://example.com/.well-known/openid-federation"
+        self.cache.add(url, MissingPage())
+        assert url in self.cache
+        assert isinstance(self.cache.get(url), MissingPage)
+
+        self.now += 101
+        assert url not in self.cache
+
+        # failed a second time, window doubles
+        self.cache.add(url, MissingPage())
+        self.now += 199
+        assert url in self.cache
+        self.now += 2
+        assert url not in self.cache
+
+        # capped by max_ttl
+        self.cache.add(url, MissingPage())
+        self.cache.add(url, MissingPage())
+        _info = dict(self.cache.items())[url]
+        assert _info["failures"] == 4
+        assert _info["until"] - _info["failed_at"] == 500
+
+    def test_purge(self):
+        self.cache.add("https://a.example.com", ConnectionError())
+        self.cache.add("https://b.example.com", ConnectionError())
+        assert set(self.cache.keys()) == {"https://a.example.com", "https://b.example.com"}
+        self.cache.purge("https://a.example.com")
+        assert self.cache.keys() == ["https://b.example.com"]
+        self.cache.purge()
+        assert len(self.cache) == 0
+
+    def test_bounded(self):
+        _cache = NegativeCache(max_entries=2)
+        _cache.add("https://a.example.com", ConnectionError())
+        self.now += 60
+        _cache.add("https://b.example.com", ConnectionError())
+        _cache.add("https://c.example.com", ConnectionError())
+        # a's backoff window has passed
+        assert _cache.keys() == ["https://b.example.com", "https://c.example.com"]
+        # b failed again so c is now the one that failed the longest time ago
+        _cache.add("https://b.example.com", ConnectionError())
+        _cache.add("https://d.example.com", ConnectionError())
+        assert _cache.keys() == ["https://b.example.com", "https://d.example.com"]
+
+    def test_check(self):
+        url = "https://example.com/.well-known/openid-federation"
+        self.cache.check(url)
+        _error = MissingPage("No such page")
+        self.cache.add(url, _error)
+        with pytest.raises(MissingPage) as err:
+            self.cache.check(url)
+        assert err.value is not _error
+        assert err.value.__cause__ is _error
+
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.org",
+                "contacts": "operations@ta.example.org"
+            },
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "authority_hints": [TA_ID, IM_ID]
+        }
+    }
+}
+
+
+class Response(object):
+
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class TestCollector:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        self.federation_entity = build_federation(FEDERATION_CONFIG)
+        self.leaf = self.federation_entity[LEAF_ID]
+
+    def test_dead_superior_not_contacted_again(self):
+        calls = []
+
+        def httpc(method, url, **kwargs):
+            calls.append(url)
+            raise ConnectionError(f"Can not connect to {url}")
+
+        _federation_entity = self.leaf["federation_entity"]
+        # The collector gets the HTTP client from the function collection
+        _federation_entity.function.httpc = httpc
+        _collector = _federation_entity.function.trust_chain_collector
+
+        with pytest.raises(ConnectionError):
+            _collector.get_entity_configuration(IM_ID)
+        assert len(calls) == 1
+
+        with pytest.raises(ConnectionError) as err:
+            _collector.get_entity_configuration(IM_ID)
+        assert len(calls) == 1
+        assert isinstance(err.value.__cause__, ConnectionError)
+        assert 'https://intermediate.example.org/.well-known/openid-federation' in \
+               _collector.negative_cache
+
+        _collector.negative_cache.purge()
+        with pytest.raises(ConnectionError):
+            _collector.get_entity_configuration(IM_ID)
+        assert len(calls) == 2
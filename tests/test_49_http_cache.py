@@ -0,0 +1,222 @@
+from concurrent.futures import Future
+
+import pytest
+
+from fedservice.entity.function.trust_chain_collector import cache_key
+from fedservice.entity_statement import cache
+from fedservice.entity_statement.cache import conditional_headers
+from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.cache import http_cache_info
+from tests import create_trust_chain_messages
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.org",
+                "contacts": "operations@ta.example.org"
+            },
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "authority_hints": [TA_ID]
+        }
+    }
+}
+
+
+class Response(object):
+
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class TestHTTPCacheInfo:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.now = 1000
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: self.now)
+
+    def test_headers(self):
+        _info = http_cache_info("https://example.com",
+                                Response(200, headers={"cache-control": "public, max-age=60",
+                                                       "ETag": '"abc"',
+                                                       "Last-Modified": "Fri, 16 Oct 2026"}))
+        assert _info["max_age"] == 60
+        assert _info["fetched_at"] == 1000
+        assert conditional_headers(_info) == {"If-None-Match": '"abc"',
+                                              "If-Modified-Since": "Fri, 16 Oct 2026"}
+
+    def test_no_store(self):
+        assert http_cache_info("https://example.com",
+                               Response(200, headers={"Cache-Control": "no-store"})) is None
+
+    def test_no_cache(self):
+        _info = http_cache_info("https://example.com",
+                                Response(200, headers={"Cache-Control": "no-cache"}))
+        assert _info["max_age"] == 0
+
+    def test_max_age_limits_freshness(self):
+        _cache = ESCache(allowed_delta=10)
+        _cache["foo"] = {"exp": 2000, "_jws": "jws"}
+        assert _cache["foo"]
+
+        _cache.set_http_info("foo", {"url": "https://example.com", "fetched_at": 1000,
+                                     "max_age": 100, "etag": '"abc"'})
+        self.now = 1099
+        assert _cache["foo"]
+        self.now = 1100
+        # stale but kept since it can be revalidated
+        assert _cache["foo"] is None
+        assert "foo" in _cache
+
+        _cache.not_modified("foo")
+        assert _cache["foo"]
+
+        # Revalidated or not, the safety margin is kept
+        _cache.set_http_info("foo", {"url": "https://example.com", "fetched_at": 1985,
+                                     "max_age": 100, "etag": '"abc"'})
+        self.now = 1990
+        assert _cache["foo"] is None
+        assert not _cache.revalidatable("foo", 2000)
+
+    def test_not_revalidatable(self):
+        _cache = ESCache(allowed_delta=10)
+        _cache["foo"] = {"exp": 2000, "_jws": "jws"}
+        # Without an ETag or Last-Modified max-age doesn't apply
+        _cache.set_http_info("foo", {"url": "https://example.com", "fetched_at": 1000,
+                                     "max_age": 0})
+        self.now = 1100
+        assert _cache["foo"]
+        self.now = 1990
+        assert _cache["foo"] is None
+        assert "foo" not in _cache
+
+
+class TestCollector:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        self.federation_entity = build_federation(FEDERATION_CONFIG)
+        self.ta = self.federation_entity[TA_ID]
+        self.leaf = self.federation_entity[LEAF_ID]
+
+    def test_conditional_request(self):
+        _msgs = create_trust_chain_messages(self.leaf, self.ta)
+        _es = _msgs[f"{TA_ID}/fetch"]
+        requests = []
+
+        def httpc(method, url, **kwargs):
+            requests.append((url, kwargs.get("headers", {})))
+            if "If-None-Match" in kwargs.get("headers", {}):
+                return Response(304, headers={"Cache-Control": "max-age=600"})
+            _headers = {
+                "Content-Type": "application/entity-statement+jwt",
+                "Cache-Control": "max-age=0",
+                "ETag": '"v1"'
+            }
+            return Response(200, _msgs[url.split("?")[0]], _headers)
+
+        _federation_entity = self.leaf["federation_entity"]
+        # The collector gets the HTTP client from the function collection
+        _federation_entity.function.httpc = httpc
+        _collector = _federation_entity.function.trust_chain_collector
+
+        assert _collector._get_entity_statement(LEAF_ID, TA_ID) == _es
+        _fetched = len(requests)
+        _key = cache_key(TA_ID, LEAF_ID)
+        assert _collector.entity_statement_cache.get_http_info(_key)["etag"] == '"v1"'
+
+        # max-age=0 so the next lookup has to revalidate
+        assert _collector._get_entity_statement(LEAF_ID, TA_ID) == _es
+        assert len(requests) == _fetched + 1
+        assert requests[-1][1]["If-None-Match"] == '"v1"'
+        assert _collector.entity_statement_cache.expires_at(_key)
+
+        # The 304 said max-age=600
+        assert _collector._get_entity_statement(LEAF_ID, TA_ID) == _es
+        assert len(requests) == _fetched + 1
+
+    def test_background_created_when_needed(self):
+        _collector = self.leaf["federation_entity"].function.trust_chain_collector
+        assert _collector._background is None
+        _executor = _collector._get_background()
+        assert _collector._get_background() is _executor
+        _collector.close()
+        assert _collector._background is None
+
+
+class Executor(object):
+    """Runs the job when told to."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, *args):
+        _future = Future()
+        self.jobs.append((func, args, _future))
+        return _future
+
+    def run(self):
+        for func, args, _future in self.jobs:
+            _future.set_result(func(*args))
+        self.jobs = []
+
+
+class TestStaleWhileRevalidate:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.now = 1000
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: self.now)
+        self.refreshed = []
+        self.executor = Executor()
+        self.cache = ESCache(allowed_delta=100, grace=60)
+        self.cache.set_refresher(self.refresh, self.executor)
+
+    def refresh(self, key):
+        self.refreshed.append(key)
+        self.cache[key] = {"exp": self.now + 1000, "_jws": "new"}
+
+    def test_serve_stale(self):
+        self.cache["foo"] = {"exp": 1200, "_jws": "old"}
+        # fresh until 1100
+        self.now = 1120
+        assert self.cache["foo"]["_jws"] == "old"
+        assert self.cache["foo"]["_jws"] == "old"
+        # Only one background refresh
+        assert len(self.executor.jobs) == 1
+        assert self.cache.stale_served == 2
+        assert self.cache.refreshing() == ["foo"]
+
+        self.executor.run()
+        assert self.refreshed == ["foo"]
+        assert self.cache.refreshing() == []
+        assert self.cache["foo"]["_jws"] == "new"
+
+    def test_outside_grace(self):
+        self.cache["foo"] = {"exp": 1200, "_jws": "old"}
+        self.now = 1160
+        assert self.cache["foo"] is None
+        assert self.executor.jobs == []
+
+    def test_never_past_exp(self):
+        self.cache = ESCache(allowed_delta=100, grace=600)
+        self.cache.set_refresher(self.refresh, self.executor)
+        self.cache["foo"] = {"exp": 1200, "_jws": "old"}
+        self.now = 1200
+        assert self.cache["foo"] is None
+        assert self.cache.stale_served == 0
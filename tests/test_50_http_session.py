@@ -0,0 +1,95 @@
+import gc
+import threading
+
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+import requests
+import responses
+
+from fedservice.httpc import HTTPSessionPool
+from fedservice.httpc import split_httpc_params
+from fedservice.utils import make_federation_entity
+from tests import create_trust_chain_messages
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://leaf.example.org"
+
+
+def test_split_httpc_params():
+    _pool, _params = split_httpc_params({"verify": False, "pool": {"pool_maxsize": 4}})
+    assert _params == {"verify": False}
+    assert _pool["pool_maxsize"] == 4
+    assert _pool["pool_connections"] == 10
+
+    _pool, _params = split_httpc_params({"verify": False, "pool": False})
+    assert _pool is False
+    assert _params == {"verify": False}
+
+
+class TestSessionPool:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        self.ta = make_federation_entity(
+            TA_ID,
+            preference={
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.com",
+                "contacts": "operations@ta.example.com"
+            },
+            key_config={"key_defs": DEFAULT_KEY_DEFS},
+            endpoints=["entity_configuration", "fetch", "list"]
+        )
+
+        self.leaf = make_federation_entity(
+            LEAF_ID,
+            key_config={"key_defs": DEFAULT_KEY_DEFS},
+            authority_hints=[TA_ID],
+            trust_anchors={TA_ID: self.ta.keyjar.export_jwks()},
+            httpc_params={"verify": False, "timeout": 5, "pool": {"pool_maxsize": 4}}
+        )
+
+        self.ta.server.subordinate[LEAF_ID] = {
+            "jwks": self.leaf.keyjar.export_jwks(),
+            'authority_hints': [TA_ID]
+        }
+
+    def test_shared_session(self):
+        _httpc = self.leaf.httpc
+        assert isinstance(_httpc, HTTPSessionPool)
+        assert _httpc.adapter._pool_maxsize == 4
+        # the pool configuration is not passed on with the requests
+        assert self.leaf.httpc_params == {"verify": False, "timeout": 5}
+
+        assert self.leaf.client.httpc is _httpc
+        _collector = self.leaf.function.trust_chain_collector
+        assert _collector.upstream_get("attribute", "httpc") is _httpc
+        assert self.leaf.client.get_service("entity_configuration").httpc is _httpc
+
+    def test_requests_use_session(self):
+        where_and_what = create_trust_chain_messages(LEAF_ID, self.ta)
+        _collector = self.leaf.function.trust_chain_collector
+        _url = f"{TA_ID}/.well-known/openid-federation"
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", _url, body=where_and_what[_url],
+                     adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                     status=200)
+
+            _ec = _collector.get_entity_configuration(TA_ID)
+
+        assert _ec == where_and_what[_url]
+        assert isinstance(self.leaf.httpc.session, requests.Session)
+        assert len(self.leaf.httpc._sessions) == 1
+
+        self.leaf.httpc.close()
+        assert len(self.leaf.httpc._sessions) == 0
+
+    def test_session_per_thread_released(self):
+        _httpc = HTTPSessionPool()
+        _threads = [threading.Thread(target=lambda: _httpc.session) for _ in range(5)]
+        for _thread in _threads:
+            _thread.start()
+        for _thread in _threads:
+            _thread.join()
+        gc.collect()
+        assert len(_httpc._sessions) == 0
@@ -8,6 +8,7 @@ from fedservice.appclient import ClientEntity
 from fedservice.defaults import DEFAULT_OIDC_FED_SERVICES
 from fedservice.defaults import LEAF_ENDPOINTS
 from fedservice.entity.function import apply_policies
+from fedservice.entity.function import get_verified_trust_chains
 from fedservice.entity.function import verify_trust_chains
 from fedservice.utils import make_federation_combo
 from fedservice.utils import make_federation_entity
@@ -112,3 +113,53 @@ class TestComboCollect(object):
 
         _trust_chains = apply_policies(self.rp, _trust_chains)
         assert _trust_chains[0].metadata == payload['metadata']
+
+    def test_resolver_first(self):
+        resolver = self.ta.server.endpoint["resolve"]
+        where_and_what = create_trust_chain_messages(self.rp, self.im, self.ta)
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in where_and_what.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+
+            response = resolver.process_request({'sub': RP_ID, 'anchor': TA_ID})
+
+        _collector = self.rp["federation_entity"].function.trust_chain_collector
+        _collector.trusted_resolvers = {TA_ID: {"anchor": TA_ID}}
+
+        _ta_ec_url = f"{TA_ID}/.well-known/openid-federation"
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", _ta_ec_url, body=where_and_what[_ta_ec_url],
+                     adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                     status=200)
+            rsps.add("GET", resolver.full_path, body=response["response_args"],
+                     adding_headers={"Content-Type": "application/resolve-response+jwt"},
+                     status=200)
+
+            _trust_chains = get_verified_trust_chains(self.rp, RP_ID)
+            # No walking of the tree
+            assert len(rsps.calls) == 2
+
+        assert len(_trust_chains) == 1
+        assert _trust_chains[0].anchor == TA_ID
+        assert _trust_chains[0].iss_path == [RP_ID, IM_ID, TA_ID]
+        assert _trust_chains[0].metadata
+
+    def test_resolver_fallback(self):
+        where_and_what = create_trust_chain_messages(self.rp, self.im, self.ta)
+        resolver = self.ta.server.endpoint["resolve"]
+
+        _collector = self.rp["federation_entity"].function.trust_chain_collector
+        _collector.trusted_resolvers = {TA_ID: {"anchor": TA_ID}}
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in where_and_what.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/json"}, status=200)
+            rsps.add("GET", resolver.full_path, status=500)
+
+            _trust_chains = get_verified_trust_chains(self.rp, RP_ID)
+
+        assert len(_trust_chains) == 1
+        assert _trust_chains[0].iss_path == [RP_ID, IM_ID, TA_ID]
@@ -0,0 +1,158 @@
+import pytest
+import responses
+
+from fedservice.entity.function import refresher
+from fedservice.entity.function.refresher import CONFIG
+from fedservice.entity.function.refresher import STATEMENT
+from fedservice.entity.function.refresher import StatementRefresher
+from fedservice.entity.function.refresher import trust_chain_dependencies
+from fedservice.entity.function.trust_chain_collector import cache_key
+from fedservice.entity_statement import cache
+from fedservice.entity_statement import trust_chain_store
+from tests import create_trust_chain_messages
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.org",
+                "contacts": "operations@ta.example.org"
+            },
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "authority_hints": [TA_ID]
+        }
+    }
+}
+
+
+class TestRefresher:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        self.federation_entity = build_federation(FEDERATION_CONFIG)
+        self.ta = self.federation_entity[TA_ID]
+        self.leaf = self.federation_entity[LEAF_ID]
+        self.fe = self.leaf["federation_entity"]
+        self.collector = self.fe.function.trust_chain_collector
+        self.refresher = StatementRefresher(upstream_get=self.collector.upstream_get, jitter=0)
+        self.msgs = create_trust_chain_messages(self.leaf, self.ta)
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in self.msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                         status=200)
+            self.trust_chains = self.fe.get_trust_chains(LEAF_ID)
+
+        yield
+        self.refresher.stop()
+
+    def test_dependencies(self):
+        assert trust_chain_dependencies(self.trust_chains[0]) == [
+            (CONFIG, LEAF_ID), (STATEMENT, cache_key(TA_ID, LEAF_ID))]
+
+    def test_nothing_due(self):
+        assert self.refresher.due() == []
+        assert self.refresher.run_once() == []
+
+    def test_refresh_ahead(self, monkeypatch):
+        _exp = [self.collector.entity_statement_cache.expires_at(cache_key(TA_ID, LEAF_ID))]
+        _exp.extend([self.collector.config_cache.expires_at(_id)
+                     for _id in self.collector.config_cache.keys()])
+        _delta = self.collector.allowed_delta
+        monkeypatch.setattr(refresher, "utc_time_sans_frac",
+                            lambda: max(_exp) - _delta - self.refresher.refresh_ahead)
+
+        _due = {(typ, key) for typ, key, _ in self.refresher.due()}
+        assert (STATEMENT, cache_key(TA_ID, LEAF_ID)) in _due
+        assert (CONFIG, LEAF_ID) in _due
+
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in self.msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                         status=200)
+            # The same statements are returned so nothing changed
+            assert self.refresher.run_once() == []
+            assert len(rsps.calls) == len(_due)
+
+        # Not tried again until there is a new version of the statement
+        assert self.refresher.due() == []
+
+    def test_retry_after_failure(self, monkeypatch):
+        _key = cache_key(TA_ID, LEAF_ID)
+        _exp = self.collector.entity_statement_cache.expires_at(_key)
+        _now = [_exp - self.collector.allowed_delta - self.refresher.refresh_ahead]
+        monkeypatch.setattr(refresher, "utc_time_sans_frac", lambda: _now[0])
+
+        def fail(*args, **kwargs):
+            raise ConnectionError("unreachable")
+
+        monkeypatch.setattr(self.collector, "refresh_entity_statement", fail)
+        assert self.refresher.refresh(STATEMENT, _key, _exp) is False
+
+        # Not tried again until the back off period has passed
+        assert (STATEMENT, _key, _exp) not in self.refresher.due()
+        _now[0] += self.refresher.retry_backoff
+        assert (STATEMENT, _key, _exp) in self.refresher.due()
+
+        # The wait is doubled after each failure
+        assert self.refresher.refresh(STATEMENT, _key, _exp) is False
+        _now[0] += self.refresher.retry_backoff
+        assert (STATEMENT, _key, _exp) not in self.refresher.due()
+        _now[0] += self.refresher.retry_backoff
+        assert (STATEMENT, _key, _exp) in self.refresher.due()
+
+    def test_reverify(self):
+        # Everything needed is cached
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            for _url, _jwks in self.msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                         status=200)
+            self.refresher.reverify([(STATEMENT, cache_key(TA_ID, LEAF_ID))])
+
+        assert self.fe.trust_chain[LEAF_ID][0].iss_path == [LEAF_ID, TA_ID]
+
+        # The statement is no longer cached and the TA can't be reached
+        self.collector.entity_statement_cache.pop(cache_key(TA_ID, LEAF_ID))
+        with responses.RequestsMock() as rsps:
+            rsps.add("GET", f"{TA_ID}/fetch", status=500)
+            self.refresher.reverify([(STATEMENT, cache_key(TA_ID, LEAF_ID))])
+
+        assert LEAF_ID not in self.fe.trust_chain
+
+    def test_start_stop(self):
+        self.refresher.interval = 0.01
+        self.refresher.start()
+        assert self.refresher.running
+        self.refresher.stop()
+        assert not self.refresher.running
+
+    def test_sweep(self, monkeypatch):
+        assert self.fe.sweep() == {"config_cache": [], "entity_statement_cache": [],
+                                   "keys": [], "trust_chain": []}
+
+        _later = max([_cache.expires_at(_key)
+                      for _cache in [self.collector.config_cache,
+                                     self.collector.entity_statement_cache]
+                      for _key in _cache.keys()]) + 1
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: _later)
+        monkeypatch.setattr(trust_chain_store, "utc_time_sans_frac", lambda: _later)
+        _removed = self.fe.sweep()
+        assert _removed["entity_statement_cache"] == [cache_key(TA_ID, LEAF_ID)]
+        assert _removed["trust_chain"] == [LEAF_ID]
+        assert LEAF_ID not in self.fe.trust_chain
+        assert len(self.collector.config_cache) == 0
@@ -0,0 +1,137 @@
+import pytest
+
+from fedservice.entity_statement import cache
+from fedservice.entity_statement.cache import ESCache
+
+
+class TestBoundedCache:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.now = 1000
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: self.now)
+
+    def test_one_record_per_statement(self):
+        _cache = ESCache(allowed_delta=10)
+        _http_info = {"etag": '"v1"', "fetched_at": 1000, "max_age": 100}
+        _cache.set("a!!b", "jws", exp=2000, http_info=_http_info)
+        assert list(_cache.keys()) == ["a!!b"]
+        assert _cache["a!!b"] == "jws"
+        assert _cache.expires_at("a!!b") == 2000
+        assert _cache.get_http_info("a!!b") == _http_info
+
+        # A dictionary carries its own expiration time
+        _cache["c"] = {"exp": 3000, "_jws": "jws"}
+        assert _cache.expires_at("c") == 3000
+
+        self.now = 1500
+        assert _cache["a!!b"] is None
+        # Kept since it can be revalidated
+        assert "a!!b" in _cache
+
+    def test_lru(self):
+        _cache = ESCache(max_entries=2)
+        _cache.set("a", "A", exp=2000)
+        _cache.set("b", "B", exp=2000)
+        # a is now the most recently used
+        assert _cache["a"] == "A"
+        _cache.set("c", "C", exp=2000)
+        assert set(_cache.keys()) == {"a", "c"}
+        assert _cache.stats()["evictions"] == 1
+
+    def test_expired_evicted_first(self):
+        _cache = ESCache(max_entries=2)
+        _cache.set("a", "A", exp=2000)
+        _cache.set("b", "B", exp=1500)
+        assert _cache["b"] == "B"
+        self.now = 1600
+        _cache.set("c", "C", exp=2000)
+        assert set(_cache.keys()) == {"a", "c"}
+
+    def test_max_bytes(self):
+        _cache = ESCache(max_bytes=10)
+        _cache.set("a", "x" * 4, exp=2000)
+        _cache.set("b", "x" * 4, exp=2000)
+        _cache.set("c", "x" * 4, exp=2000)
+        assert set(_cache.keys()) == {"b", "c"}
+        assert _cache.stats()["bytes"] == 8
+
+        # Too large on its own, is still kept
+        _cache.set("d", "x" * 20, exp=2000)
+        assert list(_cache.keys()) == ["d"]
+        _cache.pop("d")
+        assert _cache.stats()["bytes"] == 0
+
+    def test_stats(self):
+        _cache = ESCache()
+        _cache.set("a", "A", exp=2000)
+        assert _cache["a"] == "A"
+        assert _cache["b"] is None
+        assert _cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "expired": 0,
+                                  "stale_served": 0, "entries": 1, "bytes": 1}
+
+    def test_dump_load(self):
+        _cache = ESCache(max_entries=5)
+        _cache.set("a", "A", exp=2000, http_info={"etag": '"v1"'})
+        _cache2 = ESCache()
+        _cache2.load(_cache.dump())
+        assert _cache2.max_entries == 5
+        assert _cache2["a"] == "A"
+        assert _cache2.expires_at("a") == 2000
+        assert _cache2.get_http_info("a") == {"etag": '"v1"'}
+        assert _cache2.stats()["bytes"] == 1
+
+
+class TestSweep:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.now = 1000
+        monkeypatch.setattr(cache, "utc_time_sans_frac", lambda: self.now)
+
+    def test_sweep(self):
+        _cache = ESCache(sweep_interval=0)
+        for i in range(10):
+            _cache.set(f"k{i}", "x", exp=1100 + i * 10)
+        # replaced, so the first expiration time no longer counts
+        _cache.set("k0", "x", exp=2000)
+
+        self.now = 1135
+        assert set(_cache.sweep()) == {"k1", "k2", "k3"}
+        assert len(_cache) == 7
+        assert _cache.sweep() == []
+        assert _cache.stats()["expired"] == 3
+
+    def test_set_again_with_same_exp(self):
+        _cache = ESCache(max_entries=2, sweep_interval=0)
+        _cache.set("a", "A", exp=1100)
+        _cache.set("a", "A", exp=1100)
+        _cache.set_http_info("a", {"etag": '"1"'})
+        _cache.set("b", "B", exp=2000)
+
+        self.now = 1200
+        assert _cache.backend.expired(self.now) == ["a"]
+        _cache.set("a", "A", exp=1100)
+        _cache.set_http_info("a", {"etag": '"1"'})
+        _cache.set("c", "C", exp=2000)
+        assert set(_cache.keys()) == {"b", "c"}
+        assert _cache.stats()["expired"] == 1
+
+    def test_membership_checks_expiry(self):
+        _cache = ESCache(sweep_interval=0)
+        _cache.set("a", "A", exp=1100)
+        assert "a" in _cache
+        self.now = 1100
+        assert "a" not in _cache
+        assert _cache.get("a") is None
+        assert len(_cache) == 0
+
+    def test_periodic_sweep(self):
+        _cache = ESCache(sweep_interval=60)
+        _cache.set("a", "A", exp=1010)
+        self.now = 1030
+        _cache.set("b", "B", exp=2000)
+        assert len(_cache) == 2
+        self.now = 1060
+        _cache.set("c", "C", exp=2000)
+        assert set(_cache.keys()) == {"b", "c"}
@@ -0,0 +1,143 @@
+import os
+
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+import responses
+
+from fedservice.entity_statement.backend import DictBackend
+from fedservice.entity_statement.backend import SQLiteBackend
+from fedservice.entity_statement.cache import ESCache
+from fedservice.entity_statement.statement import TrustChain
+from fedservice.entity_statement.trust_chain_store import TrustChainStore
+from fedservice.utils import make_federation_entity
+from tests import create_trust_chain_messages
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://leaf.example.org"
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return os.path.join(str(tmp_path), "cache.db")
+
+
+@pytest.mark.parametrize("backend", ["dict", "sqlite"])
+def test_backend(backend, db_file):
+    if backend == "dict":
+        _backend = DictBackend()
+    else:
+        _backend = SQLiteBackend(db_file)
+
+    _backend.set("a", {"value": "A", "exp": 100, "size": 1})
+    _backend.set("b", {"value": {"x": 1}, "exp": None, "size": 2, "http": {"etag": '"v1"'}})
+    assert _backend.get("b") == {"value": {"x": 1}, "exp": None, "size": 2,
+                                 "http": {"etag": '"v1"'}}
+    assert "a" in _backend
+    assert len(_backend) == 2
+    assert _backend.size() == 3
+    assert _backend.expired(100) == ["a"]
+    assert _backend.least_recently_used() == "a"
+    _backend.touch("a")
+    assert _backend.least_recently_used() == "b"
+    assert _backend.delete("a")["value"] == "A"
+    assert _backend.delete("a") is None
+    assert _backend.keys() == ["b"]
+
+
+def test_touch_batched(db_file):
+    _backend = SQLiteBackend(db_file, touch_batch=10)
+    _other = SQLiteBackend(db_file)
+    _backend.set("a", {"value": "A", "exp": None, "size": 1})
+    _backend.set("b", {"value": "B", "exp": None, "size": 1})
+    _backend.touch("a")
+    # Not written yet
+    assert _other.least_recently_used() == "a"
+    assert _backend.least_recently_used() == "b"
+    assert _other.least_recently_used() == "b"
+
+
+def test_shared_between_caches(db_file):
+    _cache1 = ESCache(backend={"class": SQLiteBackend, "kwargs": {"path": db_file}})
+    _cache2 = ESCache(backend={"class": SQLiteBackend, "kwargs": {"path": db_file}})
+    _cache1.set("a!!b", "jws", exp=4000000000, http_info={"etag": '"v1"'})
+    assert _cache2["a!!b"] == "jws"
+    assert _cache2.get_http_info("a!!b") == {"etag": '"v1"'}
+
+    # Different namespaces are kept apart
+    _cache3 = ESCache(
+        backend={"class": SQLiteBackend, "kwargs": {"path": db_file, "namespace": "other"}})
+    assert _cache3["a!!b"] is None
+
+
+class TestSharedEntities:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self, db_file):
+        _backend = {"class": SQLiteBackend, "kwargs": {"path": db_file}}
+        _functions = {
+            "trust_chain_collector": {
+                "class": "fedservice.entity.function.trust_chain_collector.TrustChainCollector",
+                "kwargs": {"trust_anchors": {}, "cache_backend": _backend}
+            },
+            "verifier": {
+                "class": "fedservice.entity.function.verifier.TrustChainVerifier",
+                "kwargs": {}
+            },
+            "policy": {
+                "class": "fedservice.entity.function.policy.TrustChainPolicy",
+                "kwargs": {}
+            }
+        }
+        # As if in different processes
+        self.leaf = [
+            make_federation_entity(
+                LEAF_ID,
+                key_config={"key_defs": DEFAULT_KEY_DEFS},
+                authority_hints=[TA_ID],
+                functions=_functions,
+                trust_chain_store=_backend
+            ) for _ in range(2)]
+
+        self.ta = make_federation_entity(
+            TA_ID,
+            preference={
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.com",
+                "contacts": "operations@ta.example.com"
+            },
+            key_config={"key_defs": DEFAULT_KEY_DEFS},
+            endpoints=["entity_configuration", "fetch", "list"],
+            subordinate={
+                LEAF_ID: {
+                    "jwks": self.leaf[0].keyjar.export_jwks(),
+                    "authority_hints": [TA_ID]
+                }
+            }
+        )
+        for _leaf in self.leaf:
+            _leaf.add_trust_anchor(TA_ID, self.ta.keyjar.export_jwks())
+
+    def test_trust_chains_shared(self):
+        assert isinstance(self.leaf[0].trust_chain, TrustChainStore)
+
+        where_and_what = create_trust_chain_messages(self.leaf[0], self.ta)
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in where_and_what.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                         status=200)
+
+            _trust_chains = self.leaf[0].get_trust_chains(LEAF_ID)
+
+        assert len(_trust_chains) == 1
+
+        # No HTTP requests needed
+        with responses.RequestsMock(assert_all_requests_are_fired=False):
+            _shared = self.leaf[1].get_trust_chains(LEAF_ID)
+
+        assert isinstance(_shared[0], TrustChain)
+        assert _shared[0].iss_path == _trust_chains[0].iss_path
+        assert _shared[0].metadata == _trust_chains[0].metadata
+
+        _collector = self.leaf[1].function.trust_chain_collector
+        assert TA_ID in _collector.config_cache
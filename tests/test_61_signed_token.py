@@ -0,0 +1,69 @@
+import copy
+
+from cryptojwt.jwt import JWT
+from cryptojwt.jwt import utc_time_sans_frac
+from cryptojwt.key_jar import build_keyjar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity.function import get_payload
+from fedservice.entity.function import unverified_entity_statement
+from fedservice.entity.function import verify_self_signed_signature
+from fedservice.entity_statement import signed_token as st
+from fedservice.entity_statement.signed_token import SignedToken
+from fedservice.entity_statement.signed_token import signed_token
+
+ENTITY_ID = "https://entity.example.org"
+
+
+@pytest.fixture
+def token():
+    _keyjar = build_keyjar(DEFAULT_KEY_DEFS)
+    _keyjar.import_jwks(_keyjar.export_jwks(private=True), ENTITY_ID)
+    _payload = {
+        "iss": ENTITY_ID,
+        "sub": ENTITY_ID,
+        "jwks": _keyjar.export_jwks(issuer_id=ENTITY_ID),
+        "exp": utc_time_sans_frac() + 3600
+    }
+    _jwt = JWT(key_jar=_keyjar, iss=ENTITY_ID, sign_alg="RS256")
+    return _jwt.pack(payload=_payload, issuer_id=ENTITY_ID)
+
+
+def test_parsed_once(token, monkeypatch):
+    _calls = []
+
+    def factory(*args):
+        _calls.append(args)
+        return _factory(*args)
+
+    _factory = st.factory
+    monkeypatch.setattr(st, "factory", factory)
+
+    _token = signed_token(token)
+    assert _token == token
+    assert isinstance(_token, str)
+    assert signed_token(_token) is _token
+
+    assert _token.header["alg"] == "RS256"
+    assert unverified_entity_statement(_token)["iss"] == ENTITY_ID
+    assert get_payload(_token)["sub"] == ENTITY_ID
+    assert verify_self_signed_signature(_token)["iss"] == ENTITY_ID
+    assert len(_calls) == 1
+
+    # Returned payloads are copies
+    unverified_entity_statement(_token)["iss"] = "https://other.example.org"
+    assert _token.payload["iss"] == ENTITY_ID
+
+    # Copies start out unparsed
+    _copy = copy.deepcopy(_token)
+    assert isinstance(_copy, SignedToken)
+    assert _copy == _token
+    assert "_jws" not in _copy.__dict__
+
+
+def test_not_a_jwt():
+    _token = signed_token("not.a.jwt")
+    assert _token.jws is None
+    with pytest.raises(ValueError):
+        _token.payload
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+import responses
+
+from fedservice.entity.function import snapshot
+from fedservice.entity.function.snapshot import CacheSnapshot
+from fedservice.entity.function.trust_chain_collector import cache_key
+from tests import create_trust_chain_messages
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "homepage_uri": "https://ta.example.org",
+                "contacts": "operations@ta.example.org"
+            },
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "authority_hints": [TA_ID]
+        }
+    }
+}
+
+
+def _snapshot(leaf, path):
+    _collector = leaf["federation_entity"].function.trust_chain_collector
+    return CacheSnapshot(upstream_get=_collector.upstream_get, path=path)
+
+
+class TestSnapshot:
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self, tmp_path):
+        self.path = os.path.join(str(tmp_path), "snapshot.json")
+        federation_entity = build_federation(FEDERATION_CONFIG)
+        self.ta = federation_entity[TA_ID]
+        self.leaf = federation_entity[LEAF_ID]
+        self.fe = self.leaf["federation_entity"]
+
+        _msgs = create_trust_chain_messages(self.leaf, self.ta)
+        with responses.RequestsMock() as rsps:
+            for _url, _jwks in _msgs.items():
+                rsps.add("GET", _url, body=_jwks,
+                         adding_headers={"Content-Type": "application/entity-statement+jwt"},
+                         status=200)
+            self.trust_chains = self.fe.get_trust_chains(LEAF_ID)
+
+        _snapshot(self.leaf, self.path).save()
+        # As if restarted
+        self.restarted = build_federation(FEDERATION_CONFIG)[LEAF_ID]
+
+    def test_restore(self):
+        _snap = _snapshot(self.restarted, self.path)
+        assert _snap.restore() == 4
+        assert _snap.loaded.is_set()
+
+        _fe = self.restarted["federation_entity"]
+        _collector = _fe.function.trust_chain_collector
+        assert set(_collector.config_cache.keys()) == {LEAF_ID, TA_ID}
+        assert _collector.entity_statement_cache[cache_key(TA_ID, LEAF_ID)]
+
+        # No HTTP requests needed
+        with responses.RequestsMock(assert_all_requests_are_fired=False):
+            _trust_chains = _fe.get_trust_chains(LEAF_ID)
+        assert _trust_chains[0].iss_path == self.trust_chains[0].iss_path
+        assert _trust_chains[0].metadata == self.trust_chains[0].metadata
+
+    def test_known_not_replaced(self):
+        _fe = self.restarted["federation_entity"]
+        _fe.trust_chain[LEAF_ID] = []
+        _snapshot(self.restarted, self.path).restore()
+        assert _fe.trust_chain[LEAF_ID] == []
+
+    def test_expired_skipped(self, monkeypatch):
+        monkeypatch.setattr(snapshot, "utc_time_sans_frac",
+                            lambda: self.trust_chains[0].exp + 86400 * 365)
+        assert _snapshot(self.restarted, self.path).restore() == 0
+
+    def test_no_snapshot(self, tmp_path):
+        _snap = _snapshot(self.restarted, os.path.join(str(tmp_path), "missing.json"))
+        assert _snap.restore() == 0
+        assert _snap.loaded.is_set()
+
+    def test_start_stop(self):
+        _snap = _snapshot(self.restarted, self.path)
+        _snap.interval = 0.01
+        _snap.start()
+        assert _snap.loaded.wait(5)
+        _snap.stop()
+        assert LEAF_ID in self.restarted["federation_entity"].trust_chain
@@ -0,0 +1,123 @@
+from cryptojwt.jws.exception import NoSuitableSigningKeys
+from cryptojwt.jws.jws import JWS
+from cryptojwt.jwt import JWT
+from cryptojwt.jwt import utc_time_sans_frac
+from cryptojwt.key_jar import build_keyjar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity.function import verify_self_signed_signature
+from fedservice.entity_statement import verification
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.verification import VerificationMemo
+from fedservice.entity_statement.verification import verify_self_signed
+from fedservice.entity_statement.verification import verify_signature
+
+ANCHOR_ID = "https://anchor.example.org"
+ENTITY_ID = "https://entity.example.org"
+
+
+def _statement(keyjar, issuer, subject, lifetime=3600):
+    _payload = {
+        "iss": issuer,
+        "sub": subject,
+        "jwks": keyjar.export_jwks(issuer_id=issuer),
+    }
+    if lifetime:
+        _payload["exp"] = utc_time_sans_frac() + lifetime
+    _jwt = JWT(key_jar=keyjar, iss=issuer, sign_alg="RS256")
+    return _jwt.pack(payload=_payload, issuer_id=issuer)
+
+
+class TestVerificationMemo(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        self.keyjar = build_keyjar(DEFAULT_KEY_DEFS)
+        self.keyjar.import_jwks(self.keyjar.export_jwks(private=True), ANCHOR_ID)
+        self.memo = VerificationMemo()
+        self.calls = []
+        _verify = JWS.verify_compact_verbose
+
+        def verify_compact_verbose(jws, *args, **kwargs):
+            self.calls.append(1)
+            return _verify(jws, *args, **kwargs)
+
+        monkeypatch.setattr(JWS, "verify_compact_verbose", verify_compact_verbose)
+
+    def _keys(self, token):
+        return self.keyjar.get_jwt_verify_keys(signed_token(token).jws.jwt)
+
+    def test_verified_once(self):
+        _token = _statement(self.keyjar, ANCHOR_ID, ENTITY_ID)
+        _keys = self._keys(_token)
+        _payload = verify_signature(_token, _keys, self.memo)
+        assert _payload["sub"] == ENTITY_ID
+        assert verify_signature(_token, _keys, self.memo) == _payload
+        assert len(self.calls) == 1
+        assert self.memo.hits == 1
+
+        # Copies are handed out
+        _payload["sub"] = "https://other.example.org"
+        _payload["jwks"]["keys"].append({"kty": "oct"})
+        _again = verify_signature(_token, _keys, self.memo)
+        assert _again["sub"] == ENTITY_ID
+        assert {"kty": "oct"} not in _again["jwks"]["keys"]
+
+    def test_other_keys(self):
+        _token = _statement(self.keyjar, ANCHOR_ID, ENTITY_ID)
+        verify_signature(_token, self._keys(_token), self.memo)
+
+        _other = build_keyjar(DEFAULT_KEY_DEFS)
+        _keys = _other.get_issuer_keys("")
+        _keys = [k for k in _keys if k.kty == "RSA"]
+        with pytest.raises(NoSuitableSigningKeys):
+            verify_signature(_token, _keys, self.memo)
+
+    def test_expired(self, monkeypatch):
+        _token = _statement(self.keyjar, ANCHOR_ID, ENTITY_ID)
+        _keys = self._keys(_token)
+        verify_signature(_token, _keys, self.memo)
+
+        _now = utc_time_sans_frac()
+        monkeypatch.setattr(verification, "utc_time_sans_frac", lambda: _now + 3600)
+        verify_signature(_token, _keys, self.memo)
+        assert len(self.calls) == 2
+
+    def test_no_exp(self):
+        _token = _statement(self.keyjar, ANCHOR_ID, ENTITY_ID, lifetime=0)
+        _keys = self._keys(_token)
+        verify_signature(_token, _keys, self.memo)
+        verify_signature(_token, _keys, self.memo)
+        assert len(self.calls) == 2
+        assert len(self.memo) == 0
+
+    def test_bounded(self):
+        self.memo.max_entries = 2
+        for subject in ["https://a.example.org", "https://b.example.org",
+                        "https://c.example.org"]:
+            _token = _statement(self.keyjar, ANCHOR_ID, subject)
+            verify_signature(_token, self._keys(_token), self.memo)
+        assert len(self.memo) == 2
+
+    def test_self_signed(self, monkeypatch):
+        _token = _statement(self.keyjar, ANCHOR_ID, ANCHOR_ID)
+        _unpacked = []
+        _unpack = JWT.unpack
+
+        def unpack(jwt, *args, **kwargs):
+            _unpacked.append(1)
+            return _unpack(jwt, *args, **kwargs)
+
+        monkeypatch.setattr(JWT, "unpack", unpack)
+        monkeypatch.setattr(verification, "verification_memo", self.memo)
+
+        assert verify_self_signed(_token)["iss"] == ANCHOR_ID
+        _payload = verify_self_signed_signature(_token)
+        assert _payload["_jws"] == _token
+        assert len(_unpacked) == 1
+
+        # A self-signed check doesn't count as verified with the key it was signed with
+        self.calls = []
+        verify_signature(_token, self._keys(_token), self.memo)
+        assert len(self.calls) == 1
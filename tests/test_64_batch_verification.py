@@ -0,0 +1,95 @@
+from cryptojwt.key_jar import build_keyjar
+from cryptojwt.key_jar import KeyJar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity_statement.create import create_entity_statement
+
+TA_ID = "https://ta.example.org"
+IM_ID = "https://im.example.org"
+SUB1_ID = "https://sub1.example.org"
+SUB2_ID = "https://sub2.example.org"
+LEAF_ID = "https://leaf.example.org"
+
+
+class TestBatchVerification(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        #          TA
+        #          |
+        #          IM
+        #          |
+        #       +--+--+
+        #       |     |
+        #     SUB1   SUB2
+        #       |     |
+        #       +--+--+
+        #          |
+        #         LEAF
+        self.keyjar = {}
+        for entity_id in [TA_ID, IM_ID, SUB1_ID, SUB2_ID, LEAF_ID]:
+            _keyjar = build_keyjar(DEFAULT_KEY_DEFS)
+            _keyjar.import_jwks(_keyjar.export_jwks(private=True), entity_id)
+            self.keyjar[entity_id] = _keyjar
+
+        _ta_im = self._statement(TA_ID, IM_ID)
+        _leaf_ec = self._statement(LEAF_ID, LEAF_ID)
+        self.chains = [
+            [_ta_im, self._statement(IM_ID, SUB1_ID), self._statement(SUB1_ID, LEAF_ID),
+             _leaf_ec],
+            [_ta_im, self._statement(IM_ID, SUB2_ID, constraints={
+                "naming_constraints": {"excluded": [LEAF_ID]}}),
+             self._statement(SUB2_ID, LEAF_ID), _leaf_ec],
+        ]
+
+    def _statement(self, iss, sub, **kwargs):
+        return create_entity_statement(iss, sub, self.keyjar[iss],
+                                       jwks=self.keyjar[sub].export_jwks(), **kwargs)
+
+    def _verifier(self):
+        _keyjar = KeyJar()
+        _keyjar.import_jwks(self.keyjar[TA_ID].export_jwks(), TA_ID)
+
+        def upstream_get(what, *args):
+            if what == "attribute" and args[0] == "keyjar":
+                return _keyjar
+            return None
+
+        return TrustChainVerifier(upstream_get)
+
+    def test_same_as_one_at_a_time(self):
+        _expected = [self._verifier()(_chain) for _chain in self.chains]
+        assert _expected[0]
+        assert _expected[1] is None
+
+        _res = self._verifier().verify_trust_chains(self.chains)
+        assert len(_res) == 2
+        assert _res[1] is None
+        assert _res[0].verified_chain == _expected[0].verified_chain
+        assert _res[0].iss_path == _expected[0].iss_path
+        assert _res[0].anchor == TA_ID
+        assert _res[0].exp == _expected[0].exp
+
+    def test_verified_once(self, monkeypatch):
+        _verified = []
+        _verify_statement = TrustChainVerifier.verify_statement
+
+        def verify_statement(verifier, entity_statement, keyjar):
+            _verified.append(entity_statement)
+            return _verify_statement(verifier, entity_statement, keyjar)
+
+        monkeypatch.setattr(TrustChainVerifier, "verify_statement", verify_statement)
+
+        self._verifier().verify_trust_chains(self.chains)
+        # The statement issued by the trust anchor is shared by the chains
+        assert len(_verified) == 7
+        assert _verified.count(self.chains[0][0]) == 1
+
+    def test_unknown_anchor(self):
+        _verifier = self._verifier()
+        _chain = [self._statement(IM_ID, SUB1_ID), self._statement(SUB1_ID, LEAF_ID)]
+        _res = _verifier.verify_trust_chains([_chain] + self.chains)
+        assert _res[0] is None
+        assert _res[1]
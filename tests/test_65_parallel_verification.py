@@ -0,0 +1,126 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptojwt.key_jar import build_keyjar
+from cryptojwt.key_jar import KeyJar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity.function.parallel import apply_chain_policies
+from fedservice.entity.function.parallel import make_executor
+from fedservice.entity.function.parallel import verify_chains
+from fedservice.entity.function.policy import TrustChainPolicy
+from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity_statement.create import create_entity_statement
+
+TA_ID = "https://ta.example.org"
+TA2_ID = "https://ta2.example.org"
+IM_ID = "https://im.example.org"
+LEAF_IDS = [f"https://leaf{i}.example.org" for i in range(4)]
+
+METADATA_POLICY = {
+    "federation_entity": {
+        "contacts": {
+            "add": ["ops@ta.example.org"]
+        }
+    }
+}
+
+
+class TestParallelVerification(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.keyjar = {}
+        for entity_id in [TA_ID, TA2_ID, IM_ID] + LEAF_IDS:
+            _keyjar = build_keyjar(DEFAULT_KEY_DEFS)
+            _keyjar.import_jwks(_keyjar.export_jwks(private=True), entity_id)
+            self.keyjar[entity_id] = _keyjar
+
+        _ta_im = self._statement(TA_ID, IM_ID, metadata_policy=METADATA_POLICY)
+        self.chains = []
+        for leaf_id in LEAF_IDS:
+            self.chains.append([
+                _ta_im,
+                self._statement(IM_ID, leaf_id),
+                self._statement(leaf_id, leaf_id, metadata={
+                    "federation_entity": {"contacts": [f"ops@{leaf_id[8:]}"]}})
+            ])
+
+    def _statement(self, iss, sub, **kwargs):
+        return create_entity_statement(iss, sub, self.keyjar[iss],
+                                       jwks=self.keyjar[sub].export_jwks(), **kwargs)
+
+    def _verifier(self):
+        _keyjar = KeyJar()
+        _keyjar.import_jwks(self.keyjar[TA_ID].export_jwks(), TA_ID)
+
+        def upstream_get(what, *args):
+            if what == "attribute" and args[0] == "keyjar":
+                return _keyjar
+            return None
+
+        return TrustChainVerifier(upstream_get), _keyjar
+
+    def _serial(self):
+        _verifier, _keyjar = self._verifier()
+        _trust_chains = [_verifier(_chain) for _chain in self.chains]
+        _policy = TrustChainPolicy(None)
+        for _trust_chain in _trust_chains:
+            _policy(_trust_chain)
+        return _trust_chains
+
+    @pytest.mark.parametrize("spec", [{"class": "thread", "kwargs": {"max_workers": 2}},
+                                      {"class": "process", "kwargs": {"max_workers": 2}}])
+    def test_same_as_serial(self, spec):
+        _expected = self._serial()
+
+        _executor = make_executor(spec)
+        try:
+            _verifier, _keyjar = self._verifier()
+            _trust_chains = verify_chains(_verifier, _keyjar, self.chains, _executor)
+            apply_chain_policies(TrustChainPolicy(None), _trust_chains, _executor)
+        finally:
+            _executor.shutdown()
+
+        assert len(_trust_chains) == len(_expected)
+        for _trust_chain, _serial in zip(_trust_chains, _expected):
+            assert _trust_chain.verified_chain == _serial.verified_chain
+            assert _trust_chain.iss_path == _serial.iss_path
+            # "add" is a set union so the order of the values may differ between processes
+            _contacts = _trust_chain.metadata["federation_entity"]["contacts"]
+            assert set(_contacts) == set(_serial.metadata["federation_entity"]["contacts"])
+            assert "ops@ta.example.org" in _contacts
+
+        # The keys of the entities in the chains are known afterwards
+        for entity_id in [IM_ID] + LEAF_IDS:
+            assert entity_id in _keyjar
+
+    @pytest.mark.parametrize("spec", [{"class": "thread", "kwargs": {"max_workers": 2}},
+                                      {"class": "process", "kwargs": {"max_workers": 2}}])
+    def test_several_trust_anchors(self, spec):
+        # The intermediate is a subordinate of two trust anchors, which gives two subtrees
+        _ta2_im = self._statement(TA2_ID, IM_ID)
+        _chains = self.chains + [[_ta2_im] + _chain[1:] for _chain in self.chains]
+
+        _executor = make_executor(spec)
+        try:
+            _verifier, _keyjar = self._verifier()
+            _keyjar.import_jwks(self.keyjar[TA2_ID].export_jwks(), TA2_ID)
+            _trust_chains = verify_chains(_verifier, _keyjar, _chains, _executor)
+        finally:
+            _executor.shutdown()
+
+        assert len(_trust_chains) == len(_chains)
+        for _trust_chain, _leaf_id in zip(_trust_chains, LEAF_IDS + LEAF_IDS):
+            assert _trust_chain.iss_path[0] == _leaf_id
+        assert [_t.anchor for _t in _trust_chains] == [TA_ID] * 4 + [TA2_ID] * 4
+
+    def test_make_executor(self):
+        assert make_executor() is None
+        _executor = ThreadPoolExecutor(max_workers=1)
+        assert make_executor(_executor) is _executor
+        _executor.shutdown()
+        _executor = make_executor({"class": "process", "kwargs": {"max_workers": 1}})
+        assert isinstance(_executor, ProcessPoolExecutor)
+        _executor.shutdown()
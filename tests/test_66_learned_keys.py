@@ -0,0 +1,96 @@
+from cryptojwt.jwt import utc_time_sans_frac
+from cryptojwt.key_jar import build_keyjar
+from cryptojwt.key_jar import KeyJar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity.function.verifier import TrustChainVerifier
+from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.key_store import LearnedKeyStore
+
+TA_ID = "https://ta.example.org"
+IM_ID = "https://im.example.org"
+LEAF_ID = "https://leaf.example.org"
+
+
+def _jwks():
+    return build_keyjar(DEFAULT_KEY_DEFS).export_jwks()
+
+
+class TestLearnedKeyStore(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.keyjar = KeyJar()
+        self.keyjar.import_jwks(_jwks(), TA_ID)
+        self.store = LearnedKeyStore(max_issuers=2)
+
+    def _learn(self, entity_id, exp=None):
+        _introduced = entity_id not in self.keyjar
+        self.keyjar.import_jwks(_jwks(), entity_id)
+        self.store.learned(self.keyjar, entity_id, exp, _introduced)
+
+    def test_configured_keys_are_pinned(self):
+        self._learn(TA_ID)
+        assert self.store.is_pinned(TA_ID)
+        for n in range(3):
+            self._learn(f"https://{n}.example.org")
+        assert TA_ID in self.keyjar
+        assert self.store.issuers() == ["https://1.example.org", "https://2.example.org"]
+
+    def test_least_recently_used_evicted(self):
+        self._learn(IM_ID)
+        self._learn(LEAF_ID)
+        self.store.used(IM_ID)
+        self._learn("https://other.example.org")
+        assert LEAF_ID not in self.keyjar
+        assert IM_ID in self.keyjar
+        assert self.store.stats()["evictions"] == 1
+
+    def test_sweep(self):
+        _now = utc_time_sans_frac()
+        self._learn(IM_ID, _now + 10)
+        self._learn(LEAF_ID, _now + 100)
+        # Introduced again by a statement that lives longer
+        self._learn(IM_ID, _now + 1000)
+        assert self.store.sweep(self.keyjar, _now + 200) == [LEAF_ID]
+        assert LEAF_ID not in self.keyjar
+        assert IM_ID in self.keyjar
+        assert TA_ID in self.keyjar
+
+    def test_pin(self):
+        self._learn(IM_ID, utc_time_sans_frac() + 10)
+        self.store.pin(IM_ID)
+        assert self.store.sweep(self.keyjar, utc_time_sans_frac() + 100) == []
+        assert IM_ID in self.keyjar
+
+
+def test_verifier_reports_keys():
+    _keyjar = {}
+    for entity_id in [TA_ID, IM_ID, LEAF_ID]:
+        _kj = build_keyjar(DEFAULT_KEY_DEFS)
+        _kj.import_jwks(_kj.export_jwks(private=True), entity_id)
+        _keyjar[entity_id] = _kj
+
+    def statement(iss, sub):
+        return create_entity_statement(iss, sub, _keyjar[iss], jwks=_keyjar[sub].export_jwks())
+
+    _federation_keyjar = KeyJar()
+    _federation_keyjar.import_jwks(_keyjar[TA_ID].export_jwks(), TA_ID)
+    _store = LearnedKeyStore(pinned=[TA_ID])
+
+    def upstream_get(what, *args):
+        if what == "attribute" and args[0] == "keyjar":
+            return _federation_keyjar
+        if what == "attribute" and args[0] == "key_store":
+            return _store
+        return None
+
+    _verifier = TrustChainVerifier(upstream_get)
+    _trust_chain = _verifier([statement(TA_ID, IM_ID), statement(IM_ID, LEAF_ID),
+                              statement(LEAF_ID, LEAF_ID)])
+    assert _trust_chain
+    assert set(_store.issuers()) == {IM_ID, LEAF_ID}
+
+    _store.sweep(_federation_keyjar, _trust_chain.exp + 1)
+    assert _federation_keyjar.owners() == [TA_ID]
@@ -0,0 +1,127 @@
+from cryptojwt.jwt import utc_time_sans_frac
+import pytest
+
+from fedservice.entity_statement import trust_chain_store
+from fedservice.entity_statement.backend import SQLiteBackend
+from fedservice.entity_statement.statement import TrustChain
+from fedservice.entity_statement.trust_chain_store import make_trust_chain_store
+from fedservice.entity_statement.trust_chain_store import TrustChainStore
+
+TA1_ID = "https://ta1.example.org"
+TA2_ID = "https://ta2.example.org"
+IM_ID = "https://im.example.org"
+
+
+def _chain(leaf_id, anchor, exp=0, intermediate=IM_ID):
+    return TrustChain(anchor=anchor, exp=exp, iss_path=[leaf_id, intermediate, anchor],
+                      metadata={"federation_entity": {"organization_name": leaf_id}})
+
+
+def _leaf(n):
+    return f"https://leaf{n}.example.org"
+
+
+@pytest.fixture(params=["dict", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "dict":
+        return TrustChainStore()
+    return TrustChainStore(backend={"class": SQLiteBackend,
+                                    "kwargs": {"path": str(tmp_path / "store.db")}})
+
+
+def test_expired_not_handed_out(store, monkeypatch):
+    _now = utc_time_sans_frac()
+    store[_leaf(0)] = [_chain(_leaf(0), TA1_ID, _now + 10), _chain(_leaf(0), TA2_ID, _now + 100)]
+    assert len(store[_leaf(0)]) == 2
+
+    monkeypatch.setattr(trust_chain_store, "utc_time_sans_frac", lambda: _now + 50)
+    assert [_tc.anchor for _tc in store[_leaf(0)]] == [TA2_ID]
+    assert store.get_trust_chain(_leaf(0), TA1_ID) is None
+
+    monkeypatch.setattr(trust_chain_store, "utc_time_sans_frac", lambda: _now + 200)
+    assert _leaf(0) not in store
+    assert store.get(_leaf(0)) is None
+    assert store.stats()["expired"] == 1
+
+
+def test_sweep(store, monkeypatch):
+    _now = utc_time_sans_frac()
+    store[_leaf(0)] = [_chain(_leaf(0), TA1_ID, _now + 10)]
+    store[_leaf(1)] = [_chain(_leaf(1), TA1_ID, _now + 100)]
+    monkeypatch.setattr(trust_chain_store, "utc_time_sans_frac", lambda: _now + 50)
+    assert store.sweep() == [_leaf(0)]
+    assert store.keys() == [_leaf(1)]
+
+
+def test_update_keeps_other_anchors(store):
+    store.update(_leaf(0), [_chain(_leaf(0), TA1_ID)])
+    store.update(_leaf(0), [_chain(_leaf(0), TA2_ID)])
+    store.update(_leaf(0), [_chain(_leaf(0), TA1_ID, intermediate="https://im2.example.org")])
+    assert {_tc.anchor for _tc in store[_leaf(0)]} == {TA1_ID, TA2_ID}
+    assert store.get_trust_chain(_leaf(0), TA1_ID).iss_path[1] == "https://im2.example.org"
+
+
+def test_least_recently_used_evicted():
+    _store = TrustChainStore(max_entries=2)
+    _store[_leaf(0)] = [_chain(_leaf(0), TA1_ID)]
+    _store[_leaf(1)] = [_chain(_leaf(1), TA1_ID)]
+    assert _store.get(_leaf(0))
+    _store[_leaf(2)] = [_chain(_leaf(2), TA1_ID)]
+    assert set(_store.keys()) == {_leaf(0), _leaf(2)}
+    assert _store.stats()["evictions"] == 1
+
+
+def test_bounded_by_size():
+    _store = TrustChainStore(max_bytes=1)
+    _store[_leaf(0)] = [_chain(_leaf(0), TA1_ID)]
+    # The trust chains just stored are always kept
+    _store[_leaf(1)] = [_chain(_leaf(1), TA1_ID)]
+    assert _store.keys() == [_leaf(1)]
+    assert _store.stats()["bytes"] > 1
+
+
+def test_invalidate(store):
+    store[_leaf(0)] = [_chain(_leaf(0), TA1_ID), _chain(_leaf(0), TA2_ID, intermediate=TA2_ID)]
+    store[_leaf(1)] = [_chain(_leaf(1), TA1_ID)]
+
+    # The statement the intermediate issued about leaf 1 has changed
+    assert store.invalidate(IM_ID, _leaf(1)) == [_leaf(1)]
+    assert _leaf(1) not in store
+    assert len(store[_leaf(0)]) == 2
+
+    # All statements issued by the intermediate
+    assert store.invalidate(IM_ID) == [_leaf(0)]
+    assert [_tc.anchor for _tc in store[_leaf(0)]] == [TA2_ID]
+    assert store.stats()["invalidated"] == 2
+
+
+def test_invalidate_uses_issuer_index(monkeypatch):
+    _store = TrustChainStore()
+    for n in range(10):
+        _store[_leaf(n)] = [_chain(_leaf(n), TA1_ID, intermediate=f"https://im{n}.example.org")]
+
+    _looked_at = []
+    _get = _store.backend.get
+    monkeypatch.setattr(_store.backend, "get", lambda key: _looked_at.append(key) or _get(key))
+    assert _store.invalidate("https://im3.example.org") == [_leaf(3)]
+    assert _looked_at == [_leaf(3)]
+
+    # Removed trust chains are removed from the index too
+    _store.pop(_leaf(4))
+    assert "https://im3.example.org" not in _store._by_issuer
+    assert "https://im4.example.org" not in _store._by_issuer
+    assert _store._by_issuer[TA1_ID] == {_leaf(n) for n in range(10) if n not in [3, 4]}
+
+
+def test_get_trust_chain_by_anchor(store):
+    store[_leaf(0)] = [_chain(_leaf(0), TA1_ID), _chain(_leaf(0), TA2_ID, intermediate=TA2_ID)]
+    assert store.get_trust_chain(_leaf(0), TA2_ID).iss_path == [_leaf(0), TA2_ID, TA2_ID]
+    assert store.get_trust_chain(_leaf(0), "https://ta3.example.org") is None
+    assert store.get_trust_chain(_leaf(1), TA1_ID) is None
+
+
+def test_make_trust_chain_store():
+    assert isinstance(make_trust_chain_store(), TrustChainStore)
+    _store = TrustChainStore()
+    assert make_trust_chain_store(_store) is _store
+    assert make_trust_chain_store({"max_entries": 10}).max_entries == 10
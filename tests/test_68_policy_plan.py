@@ -0,0 +1,212 @@
+import copy
+
+import pytest
+
+from fedservice.entity.function import PolicyError
+from fedservice.entity.function.policy import apply_policy_batch
+from fedservice.entity.function.policy import plan_key
+from fedservice.entity.function.policy import PolicyPlanCache
+from fedservice.entity.function.policy import TrustChainPolicy
+from fedservice.entity.function.policy_operator import POLICY_OPERATORS
+from fedservice.entity_statement.statement import TrustChain
+
+TA_ID = "https://ta.example.org"
+IM_ID = "https://im.example.org"
+
+TA_IM = {
+    "iss": TA_ID,
+    "sub": IM_ID,
+    "metadata_policy": {
+        "openid_relying_party": {
+            "grant_types": {"subset_of": ["authorization_code", "refresh_token"]},
+            "token_endpoint_auth_method": {"one_of": ["private_key_jwt"],
+                                           "default": "private_key_jwt"},
+            "contacts": {"add": ["ops@ta.example.org"]}
+        }
+    }
+}
+
+IM_LEAF = {
+    "iss": IM_ID,
+    "metadata_policy": {
+        "openid_relying_party": {
+            "application_type": {"value": "web"},
+            "grant_types": {"essential": True}
+        }
+    }
+}
+
+
+def _leaf(n):
+    _leaf_id = f"https://rp{n}.example.org"
+    return {
+        "iss": _leaf_id,
+        "sub": _leaf_id,
+        "metadata": {
+            "openid_relying_party": {
+                "grant_types": ["authorization_code", "implicit"],
+                "application_type": "native",
+                "contacts": [f"ops@rp{n}.example.org"]
+            }
+        }
+    }
+
+
+def _trust_chain(n, superior=None):
+    _im_leaf = dict(IM_LEAF, sub=f"https://rp{n}.example.org")
+    return TrustChain(verified_chain=[superior or TA_IM, _im_leaf, _leaf(n)])
+
+
+class TestPolicyPlan(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.policy = TrustChainPolicy(None)
+        self.policy.plan_cache = PolicyPlanCache()
+
+    def test_same_as_combined_policy(self):
+        _chain = _trust_chain(0)
+        _combined = self.policy.gather_policies(_chain.verified_chain[:-1],
+                                                "openid_relying_party")
+        _expected = self.policy.apply_policy(_leaf(0)["metadata"]["openid_relying_party"],
+                                             _combined)
+        self.policy(_chain)
+        _metadata = _chain.metadata["openid_relying_party"]
+        assert _metadata["grant_types"] == ["authorization_code"]
+        assert _metadata["application_type"] == "web"
+        assert _metadata["token_endpoint_auth_method"] == "private_key_jwt"
+        assert set(_metadata["contacts"]) == {"ops@ta.example.org", "ops@rp0.example.org"}
+        assert _metadata == _expected
+        assert _chain.combined_policy["openid_relying_party"] == _combined
+
+    def test_verified_chain_not_changed(self):
+        _chain = _trust_chain(0)
+        _before = copy.deepcopy(_chain.verified_chain)
+        self.policy(_chain)
+        assert _chain.verified_chain == _before
+
+    def test_results_not_aliased(self):
+        _chains = [_trust_chain(n) for n in range(2)]
+        for _chain in _chains:
+            del _chain.verified_chain[-1]["metadata"]["openid_relying_party"]["contacts"]
+            self.policy(_chain)
+        _chains[0].metadata["openid_relying_party"]["contacts"].append("ops@rp0.example.org")
+        _chains[0].combined_policy["openid_relying_party"]["metadata_policy"]["contacts"][
+            "add"].append("ops@rp0.example.org")
+        assert _chains[1].metadata["openid_relying_party"]["contacts"] == ["ops@ta.example.org"]
+
+        _chain = _trust_chain(2)
+        del _chain.verified_chain[-1]["metadata"]["openid_relying_party"]["contacts"]
+        self.policy(_chain)
+        assert _chain.metadata["openid_relying_party"]["contacts"] == ["ops@ta.example.org"]
+        assert _chain.combined_policy == _chains[1].combined_policy
+
+    def test_plan_shared_by_leaves(self):
+        for n in range(5):
+            self.policy(_trust_chain(n))
+        assert len(self.policy.plan_cache) == 1
+        assert self.policy.plan_cache.misses == 1
+        assert self.policy.plan_cache.hits == 4
+
+    def test_changed_superior(self):
+        self.policy(_trust_chain(0))
+        _ta_im = dict(TA_IM, metadata_policy={
+            "openid_relying_party": {"contacts": {"add": ["security@ta.example.org"]}}})
+        _other = _trust_chain(1, superior=_ta_im)
+        self.policy(_other)
+        assert len(self.policy.plan_cache) == 2
+        assert "security@ta.example.org" in _other.metadata["openid_relying_party"]["contacts"]
+
+    def test_key_ignores_other_entity_types(self):
+        _ta_im = dict(TA_IM, iat=1, metadata_policy=dict(
+            TA_IM["metadata_policy"], federation_entity={"contacts": {"add": ["a@b.org"]}}))
+        assert plan_key([TA_IM, IM_LEAF], "openid_relying_party") == plan_key(
+            [_ta_im, IM_LEAF], "openid_relying_party")
+        assert plan_key([TA_IM, IM_LEAF], "federation_entity") != plan_key(
+            [_ta_im, IM_LEAF], "federation_entity")
+
+    def test_not_shared_between_operator_sets(self):
+        class StrictValue(POLICY_OPERATORS["value"]):
+            def __call__(self, claim, metadata, metadata_policy):
+                raise PolicyError(f"{claim} has a value policy")
+
+        _strict = TrustChainPolicy(None)
+        _strict.plan_cache = self.policy.plan_cache
+        _strict.policy_operators = [StrictValue() if _op.name == "value" else _op
+                                    for _op in _strict.policy_operators]
+
+        class OtherPolicy(TrustChainPolicy):
+            pass
+
+        _other = OtherPolicy(None)
+        _other.plan_cache = self.policy.plan_cache
+
+        _chain = [TA_IM, IM_LEAF]
+        _plans = [_p.compile(_chain, "openid_relying_party")
+                  for _p in [self.policy, _strict, _other]]
+        assert len(self.policy.plan_cache) == 3
+        assert _plans[0] is not _plans[1]
+        assert _plans[0] is not _plans[2]
+        _metadata = _leaf(0)["metadata"]["openid_relying_party"]
+        assert _plans[0].apply(copy.deepcopy(_metadata))["application_type"] == "web"
+        with pytest.raises(PolicyError):
+            _plans[1].apply(copy.deepcopy(_metadata))
+
+    def test_policy_error_not_cached(self):
+        _im_leaf = dict(IM_LEAF, metadata_policy={
+            "openid_relying_party": {"token_endpoint_auth_method": {"default": "none"}}})
+        _chain = [TA_IM, _im_leaf]
+        with pytest.raises(PolicyError):
+            self.policy.compile(_chain, "openid_relying_party")
+        assert len(self.policy.plan_cache) == 0
+
+    def test_bounded(self):
+        _cache = PolicyPlanCache(max_entries=2)
+        for n in range(3):
+            _cache.add((str(n),), n)
+        assert _cache.get(("0",)) is None
+        assert _cache.get(("2",)) == 2
+
+
+def test_apply_policy_batch():
+    _policy = TrustChainPolicy(None)
+    _policy.plan_cache = PolicyPlanCache()
+    _plan = _policy.compile([TA_IM, dict(IM_LEAF, sub="https://rp.example.org")],
+                            "openid_relying_party")
+
+    _leaves = [_leaf(n)["metadata"]["openid_relying_party"] for n in range(3)]
+    # No grant type in common with the policy
+    _leaves[1]["grant_types"] = ["implicit"]
+    _before = [dict(_metadata) for _metadata in _leaves]
+
+    _results = list(apply_policy_batch(_plan, iter(_leaves)))
+    assert len(_results) == 3
+    assert _results[0][1] is None
+    assert _results[0][0]["grant_types"] == ["authorization_code"]
+    assert _results[1][0] is None
+    assert isinstance(_results[1][1], PolicyError)
+    assert set(_results[2][0]["contacts"]) == {"ops@ta.example.org", "ops@rp2.example.org"}
+    # The leaves' metadata is left as it was
+    assert _leaves == _before
+
+    # An uncompiled combined policy gives the same result
+    assert list(apply_policy_batch(_plan.policy, _leaves))[0] == _results[0]
+
+
+def test_apply_policy_batch_results_independent():
+    _policy = TrustChainPolicy(None)
+    _policy.plan_cache = PolicyPlanCache()
+    _plan = _policy.compile([TA_IM, dict(IM_LEAF, sub="https://rp.example.org")],
+                            "openid_relying_party")
+
+    _metadata = _leaf(0)["metadata"]["openid_relying_party"]
+    _metadata["redirect_uris"] = ["https://rp0.example.org/cb"]
+    del _metadata["contacts"]
+    _results = [_res for _res, _ in apply_policy_batch(_plan, [_metadata] * 3)]
+
+    _results[0]["redirect_uris"].append("https://evil.example.org/cb")
+    _results[0]["contacts"].append("ops@rp0.example.org")
+    for _res in _results[1:]:
+        assert _res["redirect_uris"] == ["https://rp0.example.org/cb"]
+        assert _res["contacts"] == ["ops@ta.example.org"]
+    assert _metadata["redirect_uris"] == ["https://rp0.example.org/cb"]
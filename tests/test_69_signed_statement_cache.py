@@ -0,0 +1,149 @@
+from cryptojwt.key_jar import build_keyjar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity_statement import statement_cache
+from fedservice.entity_statement.create import create_entity_statement
+from fedservice.entity_statement.signed_token import signed_token
+from fedservice.entity_statement.statement_cache import fingerprint
+from fedservice.entity_statement.statement_cache import SignedStatementCache
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "contacts": "operations@ta.example.org"
+            },
+            "endpoints": ["entity_configuration", "fetch", "list"]
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The leaf operator",
+                "contacts": "operations@rp.example.org"
+            },
+            "authority_hints": [TA_ID],
+            "endpoints": ["entity_configuration"]
+        }
+    }
+}
+
+
+class TestSignedStatementCache(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.keyjar = build_keyjar(DEFAULT_KEY_DEFS)
+        self.cache = SignedStatementCache(refresh_before=60)
+        self.signed = 0
+
+    def _sign(self, lifetime=3600):
+        def _do():
+            self.signed += 1
+            return create_entity_statement(TA_ID, LEAF_ID, self.keyjar, lifetime=lifetime)
+
+        return _do
+
+    def test_reused(self):
+        _fingerprint = fingerprint({"jwks": {}})
+        _first = self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign())
+        assert self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign()) == _first
+        assert self.signed == 1
+        assert self.cache.stats()["hits"] == 1
+
+    def test_changed(self):
+        self.cache(TA_ID, LEAF_ID, fingerprint({"jwks": {}}), self._sign())
+        self.cache(TA_ID, LEAF_ID, fingerprint({"jwks": {"keys": []}}), self._sign())
+        assert self.signed == 2
+        assert self.cache.stats()["changed"] == 1
+        assert self.cache.version(TA_ID, LEAF_ID) == 2
+
+    def test_expiring(self, monkeypatch):
+        _fingerprint = fingerprint({})
+        _first = self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign())
+        _exp = signed_token(_first).payload["exp"]
+        monkeypatch.setattr(statement_cache, "utc_time_sans_frac", lambda: _exp - 30)
+        self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign())
+        assert self.signed == 2
+        assert self.cache.stats()["expiring"] == 1
+
+    def test_version_kept_after_eviction(self):
+        _cache = SignedStatementCache(max_entries=1)
+        _cache(TA_ID, LEAF_ID, fingerprint({}), self._sign())
+        _cache(TA_ID, TA_ID, fingerprint({}), self._sign())
+        assert _cache.version(TA_ID, LEAF_ID) == 0
+        _cache(TA_ID, LEAF_ID, fingerprint({}), self._sign())
+        assert _cache.version(TA_ID, LEAF_ID) == 2
+
+    def test_versions_bounded(self):
+        _cache = SignedStatementCache(max_entries=1, max_versions=1)
+        _subjects = [f"https://rp{n}.example.org" for n in range(3)]
+        for _sub in _subjects:
+            _cache(TA_ID, _sub, fingerprint({}), self._sign())
+        assert len(_cache) == 1
+        # Only the version of the most recently evicted statement is remembered
+        assert list(_cache._version) == [(TA_ID, _subjects[1])]
+        _cache(TA_ID, _subjects[1], fingerprint({}), self._sign())
+        assert _cache.version(TA_ID, _subjects[1]) == 2
+        _cache(TA_ID, _subjects[0], fingerprint({}), self._sign())
+        assert _cache.version(TA_ID, _subjects[0]) == 1
+
+    def test_invalidate(self):
+        _fingerprint = fingerprint({})
+        self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign())
+        self.cache(TA_ID, TA_ID, _fingerprint, self._sign())
+        assert self.cache.invalidate(LEAF_ID) == [(TA_ID, LEAF_ID)]
+        assert len(self.cache) == 1
+        self.cache(TA_ID, LEAF_ID, _fingerprint, self._sign())
+        assert self.signed == 3
+        assert self.cache.invalidate() == [(TA_ID, TA_ID), (TA_ID, LEAF_ID)]
+        assert len(self.cache) == 0
+
+
+class TestFetch(object):
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        federation = build_federation(FEDERATION_CONFIG)
+        self.ta = federation[TA_ID]
+        self.endpoint = self.ta.get_endpoint('fetch')
+
+    def _fetch(self, sub=LEAF_ID):
+        _req = self.endpoint.parse_request({"sub": sub})
+        return self.endpoint.process_request(_req)["response_msg"]
+
+    def test_signed_once(self):
+        _first = self._fetch()
+        assert self._fetch() == _first
+        assert self._fetch(TA_ID) == self._fetch(TA_ID)
+        assert self.endpoint.statement_cache.stats()["signed"] == 2
+
+    def test_subordinate_changed(self):
+        _first = self._fetch()
+        self.ta.server.subordinate[LEAF_ID]["metadata_policy"] = {
+            "openid_relying_party": {"contacts": {"add": ["ops@ta.example.org"]}}}
+        _second = self._fetch()
+        assert _second != _first
+        assert "metadata_policy" in signed_token(_second).payload
+
+    def test_keys_changed(self):
+        self._fetch()
+        _new = build_keyjar(DEFAULT_KEY_DEFS)
+        self.ta.keyjar.import_jwks(_new.export_jwks(private=True), "")
+        self._fetch()
+        assert self.endpoint.statement_cache.stats()["changed"] == 1
+        assert self.endpoint.statement_cache.stats()["signed"] == 2
+
+    def test_not_cached(self):
+        self.endpoint.statement_cache = None
+        assert signed_token(self._fetch()).payload["sub"] == LEAF_ID
@@ -0,0 +1,89 @@
+from cryptojwt.key_jar import build_keyjar
+from idpyoidc.client.defaults import DEFAULT_KEY_DEFS
+import pytest
+
+from fedservice.entity_statement import statement_cache
+from fedservice.entity_statement.signed_token import signed_token
+from tests.build_federation import build_federation
+
+TA_ID = "https://ta.example.org"
+LEAF_ID = "https://rp.example.org"
+
+FEDERATION_CONFIG = {
+    TA_ID: {
+        "entity_type": "trust_anchor",
+        "subordinates": [LEAF_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The example federation operator",
+                "contacts": "operations@ta.example.org"
+            },
+            "endpoints": ["entity_configuration", "fetch", "list"]
+        }
+    },
+    LEAF_ID: {
+        "entity_type": "openid_relying_party",
+        "trust_anchors": [TA_ID],
+        "kwargs": {
+            "preference": {
+                "organization_name": "The leaf operator",
+                "contacts": "operations@rp.example.org"
+            },
+            "authority_hints": [TA_ID],
+            "endpoints": ["entity_configuration"]
+        }
+    }
+}
+
+
+class TestEntityConfiguration(object):
+
+    @pytest.fixture(autouse=True)
+    def create_entities(self):
+        federation = build_federation(FEDERATION_CONFIG)
+        self.ta = federation[TA_ID]
+        self.endpoint = self.ta.get_endpoint('entity_configuration')
+
+    def _entity_configuration(self):
+        return self.endpoint.process_request({})["response"]
+
+    def _version(self):
+        return self.endpoint.statement_cache.version(TA_ID, TA_ID)
+
+    def test_signed_once(self):
+        _first = self._entity_configuration()
+        assert self._entity_configuration() == _first
+        assert self._version() == 1
+        assert self.endpoint.statement_cache.stats()["hits"] == 1
+
+    def test_authority_hints_changed(self):
+        self._entity_configuration()
+        self.ta.context.authority_hints = ["https://superior.example.org"]
+        _ec = self._entity_configuration()
+        assert signed_token(_ec).payload["authority_hints"] == ["https://superior.example.org"]
+        assert self._version() == 2
+
+    def test_trust_marks_changed(self):
+        self._entity_configuration()
+        self._entity_configuration()
+        self.ta.context.trust_marks = [{"id": "https://tm.example.org", "trust_mark": "x.y.z"}]
+        _ec = self._entity_configuration()
+        assert signed_token(_ec).payload["trust_marks"][0]["id"] == "https://tm.example.org"
+        assert self._version() == 2
+
+    def test_keys_changed(self):
+        _first = self._entity_configuration()
+        _new = build_keyjar(DEFAULT_KEY_DEFS)
+        self.ta.keyjar.import_jwks(_new.export_jwks(private=True), "")
+        _ec = self._entity_configuration()
+        assert len(signed_token(_ec).payload["jwks"]["keys"]) > len(
+            signed_token(_first).payload["jwks"]["keys"])
+        assert self._version() == 2
+
+    def test_expiring(self, monkeypatch):
+        _first = self._entity_configuration()
+        _exp = signed_token(_first).payload["exp"]
+        monkeypatch.setattr(statement_cache, "utc_time_sans_frac", lambda: _exp - 10)
+        self._entity_configuration()
+        assert self._version() == 2
+        assert self.endpoint.statement_cache.stats()["expiring"] == 1